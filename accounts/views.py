@@ -6,6 +6,8 @@ from django.urls import reverse_lazy
 from django.views.generic import CreateView
 from django.views.decorators.http import require_http_methods
 from blog.forms import CustomUserCreationForm, UserProfileForm, CustomAuthenticationForm
+from blog.models import UserProfile
+from blog.viewer_state import invalidate_snapshot
 
 
 class RegisterView(CreateView):
@@ -72,13 +74,16 @@ def edit_profile(request):
     """
     Edit user profile view
     """
+    # A full row rather than the session snapshot's partial profile
+    profile = UserProfile.objects.select_related('user').get(user=request.user)
     if request.method == 'POST':
-        form = UserProfileForm(request.POST, request.FILES, instance=request.user.profile, user=request.user)
+        form = UserProfileForm(request.POST, request.FILES, instance=profile, user=profile.user)
         if form.is_valid():
             form.save()
+            invalidate_snapshot(request)
             messages.success(request, 'Your profile has been updated successfully!')
             return redirect('blog:user_profile', username=request.user.username)
     else:
-        form = UserProfileForm(instance=request.user.profile, user=request.user)
+        form = UserProfileForm(instance=profile, user=profile.user)
 
     return render(request, 'accounts/edit_profile.html', {'form': form})
\ No newline at end of file
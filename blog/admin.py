@@ -1,5 +1,7 @@
 from django.contrib import admin
+from django.db.models import Q
 from .models import Genre, Post, Comment, PostLike, CommentLike, Follow, UserProfile
+from . import search
 
 
 @admin.register(Genre)
@@ -11,7 +13,7 @@ class GenreAdmin(admin.ModelAdmin):
 
 @admin.register(Post)
 class PostAdmin(admin.ModelAdmin):
-    list_display = ['title', 'author', 'genre', 'is_published', 'created_at', 'likes_count']
+    list_display = ['title', 'author', 'genre', 'is_published', 'created_at', 'likes_count', 'comments_count']
     list_filter = ['genre', 'is_published', 'created_at', 'author']
     search_fields = ['title', 'content', 'author__username']
     prepopulated_fields = {'slug': ('title',)}
@@ -19,9 +21,17 @@ class PostAdmin(admin.ModelAdmin):
     date_hierarchy = 'created_at'
     ordering = ['-created_at']
 
-    def likes_count(self, obj):
-        return obj.likes_count
-    likes_count.short_description = 'Likes'
+    def get_search_results(self, request, queryset, search_term):
+        # Title and content go through the full-text index instead of icontains scans. As with
+        # search_fields, every word must match the title, the content or the author's username.
+        if not search_term or not search.is_supported():
+            return super().get_search_results(request, queryset, search_term)
+        terms = search.search_terms(search_term)
+        if not terms:
+            return queryset.none(), False
+        for term in terms:
+            queryset = queryset.filter(Q(pk__in=search.matching_ids(term)) | Q(author__username__icontains=term))
+        return queryset, False
 
 
 @admin.register(Comment)
@@ -32,10 +42,6 @@ class CommentAdmin(admin.ModelAdmin):
     raw_id_fields = ['author', 'post', 'parent']
     date_hierarchy = 'created_at'
 
-    def likes_count(self, obj):
-        return obj.likes_count
-    likes_count.short_description = 'Likes'
-
 
 @admin.register(PostLike)
 class PostLikeAdmin(admin.ModelAdmin):
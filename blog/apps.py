@@ -6,4 +6,7 @@ class BlogConfig(AppConfig):
     name = 'blog'
 
     def ready(self):
-        import blog.signals
\ No newline at end of file
+        import blog.signals
+        from blog import metrics
+        if metrics.ENABLED:
+            metrics.install()
\ No newline at end of file
@@ -0,0 +1,430 @@
+"""
+Streaming NDJSON archives of the blog's content, for backups, migrations
+and bulk loads.
+
+An archive is one JSON record per line, gzip-compressed when the file name
+ends in ``.gz``. Records come in import order: a ``meta`` line, then
+genres, users (with their profile), follows, posts, post likes and
+comments (with their likes). Rows refer to each other by natural key —
+username, genre slug, post slug — so an archive imports into a database
+that already has content. Comments are matched on their post, author,
+creation time and content; they are written thread by thread, in path
+order, and refer to their parent by its id in the source database.
+
+Export reads every table with ``.iterator()``; import buffers at most one
+chunk of records (plus the comment ids of the thread being imported), so
+memory stays flat however large the archive. Import writes a checkpoint
+after every committed chunk and skips what it already loaded when run
+again. Media files (avatars, featured images) are referenced, not copied.
+"""
+import gzip
+import json
+import os
+from contextlib import contextmanager
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import card_cache, genres as genre_registry, page_cache, search, timeline
+from .counters import recount_comments, recount_posts
+from .models import Comment, CommentLike, Follow, Genre, Post, PostLike, UserProfile
+
+FORMAT_VERSION = 1
+CHUNK_SIZE = 2000
+
+USER_FIELDS = (
+    'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser',
+    'date_joined', 'last_login',
+)
+PROFILE_FIELDS = ('bio', 'avatar', 'website', 'location', 'dark_mode', 'created_at')
+POST_FIELDS = ('slug', 'title', 'content', 'excerpt', 'created_at', 'updated_at', 'is_published', 'featured_image')
+
+
+class ArchiveError(ValueError):
+    """
+    An archive line that isn't a record this version can import
+    """
+
+
+def open_archive(path, mode='r'):
+    """
+    The archive at path as text, through gzip if it ends in ``.gz``
+    """
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _timestamp(value):
+    return value.isoformat() if value is not None else None
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _scopes(author):
+    """
+    The querysets to export: everything, or only what one author created
+    """
+    if author is None:
+        return {
+            'users': User.objects.all(),
+            'follows': Follow.objects.all(),
+            'posts': Post.objects.all(),
+            'post_likes': PostLike.objects.all(),
+            'comments': Comment.objects.all(),
+        }
+    return {
+        'users': User.objects.filter(pk=author.pk),
+        'follows': Follow.objects.filter(follower=author),
+        'posts': Post.objects.filter(author=author),
+        'post_likes': PostLike.objects.filter(user=author),
+        'comments': Comment.objects.filter(author=author),
+    }
+
+
+def records(author=None, include_passwords=True, chunk_size=CHUNK_SIZE):
+    """
+    Yield the archive's records, one dict per line. With an author, only
+    their own account, posts, comments, likes and follows (for a personal
+    export); passwords are then never included.
+    """
+    scopes = _scopes(author)
+    include_passwords = include_passwords and author is None
+    yield {'type': 'meta', 'version': FORMAT_VERSION, 'exported_at': _timestamp(timezone.now())}
+
+    for genre in Genre.objects.order_by('pk').values('name', 'slug', 'description', 'created_at').iterator(chunk_size):
+        yield {'type': 'genre', **genre, 'created_at': _timestamp(genre['created_at'])}
+
+    user_fields = USER_FIELDS + (('password',) if include_passwords else ())
+    users = scopes['users'].order_by('pk').values(
+        *user_fields, 'profile__id', *(f'profile__{name}' for name in PROFILE_FIELDS)
+    )
+    for user in users.iterator(chunk_size):
+        profile = None
+        if user.pop('profile__id') is not None:
+            profile = {name: user.pop(f'profile__{name}') for name in PROFILE_FIELDS}
+            profile['created_at'] = _timestamp(profile['created_at'])
+        else:
+            for name in PROFILE_FIELDS:
+                del user[f'profile__{name}']
+        user.update(date_joined=_timestamp(user['date_joined']), last_login=_timestamp(user['last_login']))
+        yield {'type': 'user', **user, 'profile': profile}
+
+    follows = scopes['follows'].order_by('pk').values_list('follower__username', 'following__username', 'created_at')
+    for follower, following, created_at in follows.iterator(chunk_size):
+        yield {'type': 'follow', 'follower': follower, 'following': following, 'created_at': _timestamp(created_at)}
+
+    posts = scopes['posts'].order_by('pk').values(*POST_FIELDS, 'author__username', 'genre__slug')
+    for post in posts.iterator(chunk_size):
+        yield {
+            'type': 'post', **post,
+            'author': post.pop('author__username'), 'genre': post.pop('genre__slug'),
+            'created_at': _timestamp(post['created_at']), 'updated_at': _timestamp(post['updated_at']),
+        }
+
+    likes = scopes['post_likes'].order_by('pk').values_list('user__username', 'post__slug', 'created_at')
+    for user, post, created_at in likes.iterator(chunk_size):
+        yield {'type': 'post_like', 'user': user, 'post': post, 'created_at': _timestamp(created_at)}
+
+    # Thread by thread and parents first, so import only ever looks back within one thread
+    comments = scopes['comments'].order_by('post_id', 'path').values_list(
+        'pk', 'post__slug', 'author__username', 'parent_id', 'content', 'created_at', 'updated_at'
+    )
+    for batch in _batched(comments.iterator(chunk_size), chunk_size):
+        liked_by = {}
+        comment_likes = (
+            CommentLike.objects.filter(comment_id__in=[row[0] for row in batch])
+            .order_by('pk').values_list('comment_id', 'user__username', 'created_at')
+        )
+        for comment_id, user, created_at in comment_likes:
+            liked_by.setdefault(comment_id, []).append({'user': user, 'created_at': _timestamp(created_at)})
+        for pk, post, author, parent_id, content, created_at, updated_at in batch:
+            yield {
+                'type': 'comment', 'id': pk, 'post': post, 'author': author, 'parent': parent_id,
+                'content': content, 'created_at': _timestamp(created_at), 'updated_at': _timestamp(updated_at),
+                'liked_by': liked_by.get(pk, []),
+            }
+
+
+def lines(records):
+    """
+    NDJSON lines for records
+    """
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+@contextmanager
+def preserving_timestamps():
+    """
+    Keep the archived created_at/updated_at values through bulk_create,
+    which would otherwise stamp auto_now(_add) fields with the current time
+    """
+    fields = [
+        field for model in (Genre, UserProfile, Follow, Post, PostLike, Comment, CommentLike)
+        for field in model._meta.concrete_fields if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def _datetime(value):
+    return parse_datetime(value) if value else timezone.now()
+
+
+def _ids(model, field, keys):
+    return dict(model.objects.filter(**{f'{field}__in': set(keys)}).values_list(field, 'pk'))
+
+
+class Importer:
+    """
+    Load an archive's records chunk by chunk with bulk_create.
+
+    Rows whose natural key already exists are left as they are, so running
+    an import again (or resuming one after a chunk committed but its
+    checkpoint was never written) never duplicates them. A comment's key
+    is its post, author, creation time and content.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.counts = {}
+        # Source id -> (new id, path, source parent id, post slug) of the
+        # comments of the thread that may continue in the next batch
+        self.thread_comments = {}
+
+    def state(self):
+        """
+        What a checkpoint must remember besides the line number
+        """
+        return {'thread_comments': self.thread_comments}
+
+    def restore(self, state):
+        self.thread_comments = {int(pk): tuple(value) for pk, value in state['thread_comments'].items()}
+
+    def load(self, kind, batch):
+        """
+        Import a batch of records of one kind in a single transaction
+        """
+        loader = getattr(self, f'load_{kind}', None)
+        if loader is None:
+            raise ArchiveError(f'Unknown record type {kind!r}')
+        with transaction.atomic(), preserving_timestamps():
+            loader(batch)
+        self.counts[kind] = self.counts.get(kind, 0) + len(batch)
+
+    def load_meta(self, batch):
+        for record in batch:
+            if record.get('version') != FORMAT_VERSION:
+                raise ArchiveError(f"Unsupported archive version {record.get('version')!r}")
+
+    def load_genre(self, batch):
+        Genre.objects.bulk_create([
+            Genre(name=record['name'], slug=record['slug'], description=record['description'],
+                  created_at=_datetime(record['created_at']))
+            for record in batch
+        ], ignore_conflicts=True)
+        genre_registry.bump()
+
+    def load_user(self, batch):
+        User.objects.bulk_create([
+            User(
+                **{name: record[name] for name in USER_FIELDS if name not in ('date_joined', 'last_login')},
+                # Personal exports carry no password; the account needs a reset
+                password=record.get('password') or make_password(None),
+                date_joined=_datetime(record['date_joined']),
+                last_login=parse_datetime(record['last_login']) if record['last_login'] else None,
+            )
+            for record in batch
+        ], ignore_conflicts=True)
+        user_ids = _ids(User, 'username', [record['username'] for record in batch])
+        profiles = []
+        for record in batch:
+            profile = record['profile'] or {}
+            profiles.append(UserProfile(
+                user_id=user_ids[record['username']],
+                **{name: profile.get(name, '') for name in ('bio', 'avatar', 'website', 'location')},
+                dark_mode=profile.get('dark_mode', False),
+                created_at=_datetime(profile.get('created_at')),
+            ))
+        UserProfile.objects.bulk_create(profiles, ignore_conflicts=True)
+
+    def load_follow(self, batch):
+        user_ids = _ids(User, 'username', [name for record in batch for name in (record['follower'], record['following'])])
+        Follow.objects.bulk_create([
+            Follow(follower_id=user_ids[record['follower']], following_id=user_ids[record['following']],
+                   created_at=_datetime(record['created_at']))
+            for record in batch
+            if record['follower'] in user_ids and record['following'] in user_ids
+            and record['follower'] != record['following']
+        ], ignore_conflicts=True)
+
+    def load_post(self, batch):
+        user_ids = _ids(User, 'username', [record['author'] for record in batch])
+        genre_ids = _ids(Genre, 'slug', [record['genre'] for record in batch])
+        Post.objects.bulk_create([
+            Post(
+                **{name: record[name] for name in POST_FIELDS if name not in ('created_at', 'updated_at')},
+                author_id=user_ids[record['author']], genre_id=genre_ids[record['genre']],
+                created_at=_datetime(record['created_at']), updated_at=_datetime(record['updated_at']),
+            )
+            for record in batch if record['author'] in user_ids and record['genre'] in genre_ids
+        ], ignore_conflicts=True)
+        search.index_posts(list(_ids(Post, 'slug', [record['slug'] for record in batch]).values()))
+
+    def load_post_like(self, batch):
+        user_ids = _ids(User, 'username', [record['user'] for record in batch])
+        post_ids = _ids(Post, 'slug', [record['post'] for record in batch])
+        PostLike.objects.bulk_create([
+            PostLike(user_id=user_ids[record['user']], post_id=post_ids[record['post']],
+                     created_at=_datetime(record['created_at']))
+            for record in batch if record['user'] in user_ids and record['post'] in post_ids
+        ], ignore_conflicts=True)
+        recount_posts(list(post_ids.values()))
+
+    def load_comment(self, batch):
+        user_ids = _ids(User, 'username', [
+            name for record in batch for name in [record['author'], *(like['user'] for like in record['liked_by'])]
+        ])
+        post_ids = _ids(Post, 'slug', [record['post'] for record in batch])
+        existing = self.existing_comments(batch, post_ids, user_ids)
+        # A reply can't be inserted before its parent has an id: insert the batch one depth at a time
+        levels = []
+        level_of = {}
+        for record in batch:
+            if record['post'] not in post_ids or record['author'] not in user_ids:
+                continue
+            level = level_of[record['parent']] + 1 if record['parent'] in level_of else 0
+            level_of[record['id']] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(record)
+
+        for level in levels:
+            comments = []
+            for record in level:
+                key = (post_ids[record['post']], user_ids[record['author']], _datetime(record['created_at']), record['content'])
+                if key in existing:
+                    # Imported (with its likes) by an earlier run
+                    self.thread_comments[record['id']] = (*existing[key], record['parent'], record['post'])
+                    continue
+                parent = self.thread_comments.get(record['parent'])
+                # Replies past the deepest level become siblings of their parent, as in Comment.save()
+                while parent is not None and len(parent[1]) // Comment.PATH_STEP >= Comment.MAX_DEPTH:
+                    parent = self.thread_comments.get(parent[2])
+                comments.append((record, parent, Comment(
+                    post_id=post_ids[record['post']], author_id=user_ids[record['author']],
+                    parent_id=parent[0] if parent is not None else None, content=record['content'],
+                    created_at=_datetime(record['created_at']), updated_at=_datetime(record['updated_at']),
+                )))
+            Comment.objects.bulk_create([comment for _, _, comment in comments])
+            likes = []
+            for record, parent, comment in comments:
+                # Replies to comments that weren't imported (e.g. in a personal export) become top-level
+                comment.path = (parent[1] if parent is not None else '') + Comment.path_segment(comment.pk)
+                comment.depth = len(comment.path) // Comment.PATH_STEP - 1
+                self.thread_comments[record['id']] = (comment.pk, comment.path, record['parent'], record['post'])
+                likes.extend(
+                    CommentLike(user_id=user_ids[like['user']], comment_id=comment.pk, created_at=_datetime(like['created_at']))
+                    for like in record['liked_by'] if like['user'] in user_ids
+                )
+            Comment.objects.bulk_update([comment for _, _, comment in comments], ['path', 'depth'])
+            CommentLike.objects.bulk_create(likes, ignore_conflicts=True)
+            recount_comments([comment.pk for _, _, comment in comments])
+
+        # Only the last thread can continue in the next batch
+        thread = batch[-1]['post']
+        self.thread_comments = {pk: entry for pk, entry in self.thread_comments.items() if entry[3] == thread}
+        recount_posts(list(post_ids.values()))
+
+    def existing_comments(self, batch, post_ids, user_ids):
+        """
+        ``{(post id, author id, created_at, content): (id, path)}`` of the
+        batch's comments that are already in the database
+        """
+        rows = Comment.objects.filter(
+            post_id__in=post_ids.values(), author_id__in=user_ids.values(),
+            created_at__in={_datetime(record['created_at']) for record in batch if record['created_at']},
+        ).values_list('post_id', 'author_id', 'created_at', 'content', 'pk', 'path')
+        return {tuple(row[:4]): tuple(row[4:]) for row in rows}
+
+    def finish(self):
+        """
+        Rebuild what signals would have maintained and batches couldn't:
+        timelines and caches
+        """
+        timeline.refresh_fanout_modes()
+        timeline.backfill_all()
+        genre_registry.bump()
+        card_cache.bump_generation()
+        page_cache.purge(page_cache.SITE_TAG)
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(temporary, path)
+
+
+def load(file, importer, checkpoint_path=None, progress=None):
+    """
+    Import the archive in file, one transaction per chunk of same-type
+    records. With checkpoint_path, resume after the last chunk it records
+    and record every chunk committed; the file is removed once the whole
+    archive is in. progress(kind, count, line) is called after every chunk.
+    """
+    checkpoint = read_checkpoint(checkpoint_path) if checkpoint_path else None
+    done = 0
+    if checkpoint is not None:
+        done = checkpoint['line']
+        importer.restore(checkpoint)
+
+    def flush(kind, batch, line):
+        importer.load(kind, batch)
+        if checkpoint_path:
+            write_checkpoint(checkpoint_path, {'line': line, **importer.state()})
+        if progress is not None:
+            progress(kind, len(batch), line)
+
+    kind, batch = None, []
+    line = done
+    for line, text in enumerate(file, 1):
+        if line <= done or not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            raise ArchiveError(f'Line {line} is not JSON: {e}') from e
+        if batch and (record.get('type') != kind or len(batch) >= importer.chunk_size):
+            flush(kind, batch, line - 1)
+            batch = []
+        kind = record.get('type')
+        batch.append(record)
+    if batch:
+        flush(kind, batch, line)
+
+    importer.finish()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
@@ -0,0 +1,285 @@
+"""
+View benchmarks over seeded datasets, for comparing runs.
+
+``run()`` drives every route in ``blog/urls.py`` and ``accounts/urls.py``
+through the test client, once anonymously and once signed in. For each
+route it records:
+
+- p50 and p95 latency over the measured iterations,
+- the queries, template render time and cache reads of the median run,
+- and the bytes allocated (tracemalloc peak) in one extra traced run.
+
+Datasets come from the ``populate_data`` command's bulk mode with a fixed
+seed, at the sizes in SCALES. ``compare()`` checks a run against a baseline run saved
+as JSON. The ``benchmark_views`` command wraps all of this on a throwaway
+test database.
+"""
+import platform
+import statistics
+import time
+import tracemalloc
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from accounts import urls as account_urls
+
+from . import like_buffer, metrics, session_store, urls as blog_urls
+from .models import Comment, CommentLike, Follow, Genre, Post, PostLike
+
+# name: populate_data options
+SCALES = {
+    '1k': {'users': 100, 'articles': 1_000},
+    '100k': {'users': 5_000, 'articles': 100_000},
+    '1m': {'users': 50_000, 'articles': 1_000_000, 'likes': 10_000_000},
+}
+ANONYMOUS = 'anonymous'
+SIGNED_IN = 'signed_in'
+AUDIENCES = (ANONYMOUS, SIGNED_IN)
+
+LOCAL_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'benchmark-{alias}'}
+    for alias in ('default', 'shared', 'sessions')
+}
+# Plain storages, so no collectstatic manifest is needed
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+# Development instrumentation that would only measure itself
+SKIPPED_MIDDLEWARE = ('blog.middleware.QueryBudgetMiddleware', 'blog.middleware.MetricsMiddleware')
+
+
+class Fixtures:
+    """
+    The objects a dataset's routes are requested with
+    """
+    def __init__(self):
+        self.viewer = (
+            User.objects.annotate(following_total=Count('following'), posts_total=Count('blog_posts'))
+            .filter(posts_total__gt=0).order_by('-following_total', 'pk').first()
+        )
+        # Staff, so the staff-only routes are measured rather than their redirects
+        User.objects.filter(pk=self.viewer.pk).update(is_staff=True)
+        self.own_post = Post.objects.filter(author=self.viewer).order_by('pk').first()
+        self.post = (
+            Post.objects.filter(is_published=True).exclude(author=self.viewer)
+            .order_by('-comments_count', 'pk').first()
+        )
+        self.comment = Comment.objects.filter(post=self.post, parent=None).order_by('pk').first()
+        if self.comment is None:
+            self.comment = Comment.objects.create(post=self.post, author=self.viewer, content='Benchmark comment')
+        self.genre = self.post.genre
+        self.author = self.post.author
+
+
+def build_dataset(users, articles, seed, stdout=None, **options):
+    """
+    Populate the current database with the seeded ``populate_data`` dataset;
+    options (likes, follows, ...) go to its bulk mode
+    """
+    call_command('populate_data', users=users, articles=articles, seed=seed, bulk=True, stdout=stdout, **options)
+    like_buffer.flush()
+
+
+def dataset_summary():
+    return {
+        'users': User.objects.count(),
+        'posts': Post.objects.count(),
+        'comments': Comment.objects.count(),
+        'post_likes': PostLike.objects.count(),
+        'comment_likes': CommentLike.objects.count(),
+        'follows': Follow.objects.count(),
+        'genres': Genre.objects.count(),
+    }
+
+
+def route_requests(fixtures):
+    """
+    ``{url name: (method, url, client kwargs)}`` for every blog and accounts URL
+    """
+    post, own_post, comment = fixtures.post, fixtures.own_post, fixtures.comment
+    actions = [
+        {'type': 'like_post', 'target': post.slug, 'desired_state': True},
+        {'type': 'like_comment', 'target': comment.pk, 'desired_state': True},
+        {'type': 'follow', 'target': fixtures.author.username, 'desired_state': True},
+    ]
+    requests = {
+        'blog:home': ('get', reverse('blog:home'), {}),
+        'blog:post_detail': ('get', reverse('blog:post_detail', args=[post.slug]), {}),
+        'blog:genre_posts': ('get', reverse('blog:genre_posts', args=[fixtures.genre.slug]), {}),
+        'blog:following_feed': ('get', reverse('blog:following_feed'), {}),
+        'blog:search': ('get', f"{reverse('blog:search')}?q={post.title.split()[0]}", {}),
+        'blog:site_feed': ('get', reverse('blog:site_feed', args=['rss']), {}),
+        'blog:genre_feed': ('get', reverse('blog:genre_feed', args=[fixtures.genre.slug, 'atom']), {}),
+        'blog:author_feed': ('get', reverse('blog:author_feed', args=[fixtures.author.username, 'rss']), {}),
+        'blog:home_posts': ('get', reverse('blog:home_posts'), {}),
+        'blog:genre_posts_fragment': ('get', reverse('blog:genre_posts_fragment', args=[fixtures.genre.slug]), {}),
+        'blog:following_feed_fragment': ('get', reverse('blog:following_feed_fragment'), {}),
+        'blog:create_post': ('get', reverse('blog:create_post'), {}),
+        'blog:edit_post': ('get', reverse('blog:edit_post', args=[own_post.slug]), {}),
+        'blog:delete_post': ('get', reverse('blog:delete_post', args=[own_post.slug]), {}),
+        'blog:user_profile': ('get', reverse('blog:user_profile', args=[fixtures.author.username]), {}),
+        'blog:export_author': ('get', reverse('blog:export_author', args=[fixtures.viewer.username]), {}),
+        'blog:like_post': ('post', reverse('blog:like_post', args=[post.slug]), {}),
+        'blog:like_comment': ('post', reverse('blog:like_comment', args=[comment.pk]), {}),
+        'blog:follow_user': ('post', reverse('blog:follow_user', args=[fixtures.author.username]), {}),
+        'blog:bulk_actions': ('post', reverse('blog:bulk_actions'), {
+            'data': {'actions': actions}, 'content_type': 'application/json',
+        }),
+        'blog:toggle_dark_mode': ('post', reverse('blog:toggle_dark_mode'), {
+            'data': {'dark_mode': False}, 'content_type': 'application/json',
+        }),
+        'blog:cache_stats': ('get', reverse('blog:cache_stats'), {}),
+        'blog:add_comment': ('post', reverse('blog:add_comment', args=[post.slug]), {'data': {'content': 'Benchmark reply'}}),
+        'blog:comment_page': ('get', reverse('blog:comment_page', args=[post.slug]), {}),
+        'blog:comment_replies': ('get', reverse('blog:comment_replies', args=[post.slug, comment.pk]), {}),
+        'blog:metrics': ('get', reverse('blog:metrics'), {}),
+        'accounts:register': ('get', reverse('accounts:register'), {}),
+        'accounts:login': ('get', reverse('accounts:login'), {}),
+        'accounts:logout': ('post', reverse('accounts:logout'), {}),
+        'accounts:edit_profile': ('get', reverse('accounts:edit_profile'), {}),
+    }
+    names = {
+        f'{module.app_name}:{pattern.name}'
+        for module in (blog_urls, account_urls) for pattern in module.urlpatterns
+    }
+    missing = names - set(requests)
+    if missing:
+        raise LookupError(f'No benchmark request for {", ".join(sorted(missing))}')
+    return requests
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a non-empty list
+    """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def _request(client, method, url, kwargs):
+    sample = metrics.Sample()
+    with metrics.measuring(sample):
+        response = getattr(client, method)(url, **kwargs)
+        if response.streaming:
+            # A streamed body does its work while being read
+            b''.join(response.streaming_content)
+    return response, sample
+
+
+def measure(client, method, url, kwargs, iterations, warmup, before_request):
+    """
+    Timings of one route for one client
+    """
+    samples = []
+    status = None
+    for iteration in range(warmup + iterations):
+        before_request()
+        response, sample = _request(client, method, url, kwargs)
+        status = response.status_code
+        if iteration >= warmup:
+            samples.append(sample)
+
+    before_request()
+    tracemalloc.start()
+    try:
+        _request(client, method, url, kwargs)
+        allocated = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies = [sample.seconds * 1000 for sample in samples]
+    median = sorted(samples, key=lambda sample: sample.seconds)[len(samples) // 2]
+    return {
+        'status': status,
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'queries': median.queries,
+        'query_ms': round(median.query_seconds * 1000, 3),
+        'template_ms': round(median.template_seconds * 1000, 3),
+        'cache_hits': median.cache_hits,
+        'cache_misses': median.cache_misses,
+        'allocated_bytes': allocated,
+    }
+
+
+def run(iterations=20, warmup=2, routes=None, stdout=None):
+    """
+    Benchmark every route (or the named ones) against the current database
+    """
+    fixtures = Fixtures()
+    requests = route_requests(fixtures)
+    if routes:
+        requests = {name: request for name, request in requests.items() if name in routes}
+
+    middleware = [name for name in settings.MIDDLEWARE if name not in SKIPPED_MIDDLEWARE]
+    results = {}
+    with override_settings(CACHES=LOCAL_CACHES, MIDDLEWARE=middleware, STORAGES=STORAGES):
+        for alias in LOCAL_CACHES:
+            caches[alias].clear()
+        for name, (method, url, kwargs) in requests.items():
+            results[name] = {}
+            for audience in AUDIENCES:
+                client = Client()
+
+                def before_request():
+                    # Routes such as logout end the session; every request starts signed in again
+                    if audience == SIGNED_IN and '_auth_user_id' not in client.session:
+                        client.force_login(fixtures.viewer)
+
+                results[name][audience] = measure(client, method, url, kwargs, iterations, warmup, before_request)
+                if stdout is not None:
+                    result = results[name][audience]
+                    stdout.write(
+                        f"  {name:32} {audience:10} {result['status']}  p50 {result['p50_ms']:8.2f} ms  "
+                        f"p95 {result['p95_ms']:8.2f} ms  {result['queries']:3} queries  "
+                        f"{result['allocated_bytes'] / 1024:8.1f} KiB"
+                    )
+        session_store.flush()
+        like_buffer.flush()
+
+    return {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'iterations': iterations,
+            'warmup': warmup,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+        },
+        'dataset': dataset_summary(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.2, min_delta_ms=1.0):
+    """
+    Regressions of current against baseline, as messages.
+
+    A route regresses when its p95 latency, query count or allocated bytes
+    grow by more than threshold (a fraction); latency must also grow by at
+    least min_delta_ms, so sub-millisecond noise can't fail a run.
+    """
+    regressions = []
+    for name, audiences in current['results'].items():
+        for audience, result in audiences.items():
+            base = baseline['results'].get(name, {}).get(audience)
+            if base is None:
+                continue
+            label = f'{name} ({audience})'
+            if result['p95_ms'] > base['p95_ms'] * (1 + threshold) and result['p95_ms'] - base['p95_ms'] >= min_delta_ms:
+                regressions.append(f"{label}: p95 {base['p95_ms']:.2f} ms -> {result['p95_ms']:.2f} ms")
+            if result['queries'] > base['queries'] * (1 + threshold):
+                regressions.append(f"{label}: {base['queries']} -> {result['queries']} queries")
+            if result['allocated_bytes'] > base['allocated_bytes'] * (1 + threshold):
+                regressions.append(f"{label}: {base['allocated_bytes']} -> {result['allocated_bytes']} bytes allocated")
+    return regressions
@@ -0,0 +1,152 @@
+"""
+Fragment cache for rendered post cards.
+
+A card is cached under the post id plus a version stamp made of the post's
+own ``updated_at`` and counters (which move on every edit, like and
+comment), the author's profile version and a global generation (bumped
+when genres change). Stale entries are never read again and simply age out.
+
+The cached HTML is viewer independent: the like icon and the relative
+timestamp are rendered as placeholders and patched in on every lookup.
+"""
+import time
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.timesince import timesince
+
+from . import tiered_cache
+
+CACHE_PREFIX = 'post_card'
+CARD_TIMEOUT = 60 * 60 * 24
+TEMPLATE_NAME = 'partials/post_card.html'
+
+# Private-use characters, which titles, slugs and class names never need, stand in for the per-viewer parts
+LIKE_ICON_PLACEHOLDER = '\ue002'
+CREATED_AGO_PLACEHOLDER = '\ue003'
+# Part of every card key: bumped whenever the placeholders change, so older cards are never patched
+FORMAT_VERSION = 2
+LIKED_ICON_CLASS = 'fas fa-heart text-red-500'
+UNLIKED_ICON_CLASS = 'far fa-heart'
+
+GENERATION_KEY = f'{CACHE_PREFIX}:generation'
+HITS_KEY = f'{CACHE_PREFIX}:stats:hits'
+MISSES_KEY = f'{CACHE_PREFIX}:stats:misses'
+
+
+def _author_key(user_id):
+    return f'{CACHE_PREFIX}:author:{user_id}'
+
+
+def bump_author(user_id):
+    """
+    Invalidate every card by this author (profile, avatar or name changed)
+    """
+    cache.set(_author_key(user_id), time.time_ns(), None)
+
+
+def bump_generation():
+    """
+    Invalidate every card (e.g. a genre was renamed)
+    """
+    cache.set(GENERATION_KEY, time.time_ns(), None)
+
+
+def card_key(post, author_version, generation):
+    stamp = f'{generation}.{author_version}.{post.updated_at.timestamp()}.{post.likes_count}.{post.comments_count}'
+    return f'{CACHE_PREFIX}:{post.pk}:{FORMAT_VERSION}.{stamp}'
+
+
+def prime(posts):
+    """
+    Look up the cached cards of a list of posts with two cache round trips.
+
+    Sets ``_card_key`` and ``_card_html`` (None on a miss) on each post; the
+    ``post_card`` template tag renders and stores the misses.
+    """
+    posts = [post for post in posts if post is not None and not hasattr(post, '_card_key')]
+    if not posts:
+        return
+    version_keys = [GENERATION_KEY] + [_author_key(user_id) for user_id in {post.author_id for post in posts}]
+    versions = cache.get_many(version_keys)
+    generation = versions.get(GENERATION_KEY, 0)
+    for post in posts:
+        post._card_key = card_key(post, versions.get(_author_key(post.author_id), 0), generation)
+
+    cards = cache.get_many([post._card_key for post in posts])
+    for post in posts:
+        post._card_html = cards.get(post._card_key)
+    hits = sum(1 for post in posts if post._card_html is not None)
+    _record(HITS_KEY, hits)
+    _record(MISSES_KEY, len(posts) - hits)
+
+
+def _record(key, count):
+    if not count:
+        return
+    try:
+        cache.incr(key, count)
+    except ValueError:
+        # First event (or the key was evicted); races here only lose a few counts
+        cache.set(key, count, None)
+
+
+def _render_shared(post):
+    """
+    The viewer-independent card HTML, or '' when the post's own text
+    contains a placeholder character and the card must be rendered per viewer
+    """
+    html = render_to_string(TEMPLATE_NAME, {
+        'post': post,
+        'like_icon_class': LIKE_ICON_PLACEHOLDER,
+        'created_ago': CREATED_AGO_PLACEHOLDER,
+    })
+    if html.count(LIKE_ICON_PLACEHOLDER) != 1 or html.count(CREATED_AGO_PLACEHOLDER) != 1:
+        return ''
+    return html
+
+
+def render_card(post):
+    """
+    The card HTML for a post, from the cache when possible, with the
+    viewer's like state and the current relative time patched in.
+
+    A missing card is rendered by one request at a time (see
+    ``tiered_cache.get_or_compute``); concurrent requests wait for it.
+    """
+    if not hasattr(post, '_card_key'):
+        prime([post])
+    if post._card_html is None:
+        post._card_html = tiered_cache.get_or_compute(post._card_key, lambda: _render_shared(post), CARD_TIMEOUT)
+
+    liked = getattr(post, 'liked_by_viewer', False)
+    if not post._card_html:
+        return render_to_string(TEMPLATE_NAME, {
+            'post': post,
+            'like_icon_class': LIKED_ICON_CLASS if liked else UNLIKED_ICON_CLASS,
+            'created_ago': timesince(post.created_at),
+        })
+    html = post._card_html.replace(LIKE_ICON_PLACEHOLDER, LIKED_ICON_CLASS if liked else UNLIKED_ICON_CLASS)
+    html = html.replace(CREATED_AGO_PLACEHOLDER, escape(timesince(post.created_at)))
+    return mark_safe(html)
+
+
+def stats():
+    """
+    Shared hit/miss counters for card lookups since they were last reset
+    """
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits = counts.get(HITS_KEY, 0)
+    misses = counts.get(MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / lookups, 4) if lookups else None,
+    }
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
@@ -0,0 +1,133 @@
+from datetime import datetime
+from functools import reduce
+from operator import or_
+
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber, Substr
+
+from .models import Comment
+from .pagination import decode_cursor, encode_cursor
+
+COMMENTS_PAGE_SIZE = 10
+REPLY_PREVIEW_SIZE = 3
+REPLIES_PAGE_SIZE = 20
+
+
+def thread_queryset(post):
+    """
+    Every comment of a post in depth-first order, with author display data joined in
+    """
+    return (
+        Comment.objects.filter(post_id=getattr(post, 'pk', post))
+        .select_related('author', 'author__profile')
+        .order_by('path')
+    )
+
+
+def author_display_name(user):
+    full_name = f'{user.first_name} {user.last_name}'.strip()
+    return full_name or user.username
+
+
+def build_tree(comments):
+    """
+    Assemble comments ordered by path into a forest.
+
+    Each comment gets a ``children`` list and an ``author_name``; the root
+    comments are returned in order. Comments whose parent is not in the
+    list are treated as roots, so partial threads still render.
+    """
+    by_id = {}
+    roots = []
+    for comment in comments:
+        comment.children = []
+        comment.author_name = author_display_name(comment.author)
+        by_id[comment.pk] = comment
+        parent = by_id.get(comment.parent_id)
+        if parent is None:
+            roots.append(comment)
+        else:
+            parent.children.append(comment)
+    return roots
+
+
+def load_comment_tree(post):
+    """
+    Load a post's whole comment thread in a single query.
+
+    Returns ``(roots, comments)``: the top-level comments with their
+    ``children`` filled in to any depth, and the flat list of every comment.
+    """
+    comments = list(thread_queryset(post))
+    return build_tree(comments), comments
+
+
+def _descendants_of(roots):
+    return reduce(or_, (Q(path__startswith=root.path) for root in roots)) & Q(depth__gt=0)
+
+
+def load_comment_page(post, cursor=None, page_size=COMMENTS_PAGE_SIZE, preview_size=REPLY_PREVIEW_SIZE):
+    """
+    Load one keyset page of top-level comments with a preview of their replies.
+
+    Top-level comments are ordered by ``(created_at, id)``; ``cursor`` is the
+    token returned as ``next_cursor`` by the previous page. Each root gets up
+    to ``preview_size`` replies (depth-first) in ``children``, plus a
+    ``replies_cursor`` when more replies remain. Always two queries.
+
+    Returns ``(roots, comments, next_cursor)`` where ``comments`` is the flat
+    list of every comment loaded.
+    """
+    roots = thread_queryset(post).filter(parent__isnull=True).order_by('created_at', 'id')
+    if cursor:
+        created_at, pk = decode_cursor(cursor, datetime, int)
+        roots = roots.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+    roots = list(roots[:page_size + 1])
+    next_cursor = None
+    if len(roots) > page_size:
+        roots = roots[:page_size]
+        next_cursor = encode_cursor(roots[-1].created_at, roots[-1].pk)
+    if not roots:
+        return [], [], None
+
+    # First preview_size + 1 descendants of every root, numbered per thread
+    replies = list(
+        thread_queryset(post)
+        .filter(_descendants_of(roots))
+        .annotate(
+            thread=Substr('path', 1, Comment.PATH_STEP),
+            position=Window(RowNumber(), partition_by=F('thread'), order_by=F('path').asc()),
+        )
+        .filter(position__lte=preview_size + 1)
+    )
+    shown = [reply for reply in replies if reply.position <= preview_size]
+    truncated = {reply.thread for reply in replies if reply.position > preview_size}
+    build_tree(roots + shown)
+
+    # More replies are loaded from the last path shown in each thread
+    last_shown = {root.path: root.path for root in roots}
+    for reply in shown:
+        last_shown[reply.thread] = reply.path
+    for root in roots:
+        root.replies_cursor = encode_cursor(last_shown[root.path]) if root.path in truncated else None
+    return roots, roots + shown, next_cursor
+
+
+def load_more_replies(root, cursor, page_size=REPLIES_PAGE_SIZE):
+    """
+    Load the next depth-first batch of a top-level comment's replies.
+
+    Returns ``(roots, comments, next_cursor)`` like load_comment_page. Replies
+    whose parent was sent in an earlier batch are the roots of this batch;
+    the page re-attaches them under that parent.
+    """
+    (after,) = decode_cursor(cursor, str)
+    replies = list(
+        thread_queryset(root.post_id)
+        .filter(_descendants_of([root]), path__gt=after)[:page_size + 1]
+    )
+    next_cursor = None
+    if len(replies) > page_size:
+        replies = replies[:page_size]
+        next_cursor = encode_cursor(replies[-1].path)
+    return build_tree(replies), replies, next_cursor
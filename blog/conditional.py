@@ -0,0 +1,149 @@
+"""
+Conditional GET for the main pages: ETag and Last-Modified validators
+that are checked before any queryset or template work.
+
+A page's validators come from the versions of the page_cache tags it
+depends on (``post:<id>``, ``genre:<slug>``, ...). Those versions are the
+times the tags were last purged, so they change exactly when the page's
+content may have. For signed-in viewers the tag of their own likes,
+follows and theme (``viewer:<id>``) is added. The tags of a page's last
+render are remembered per URL. When a revalidation arrives, ConditionalPageMiddleware
+reads their versions from the cache and answers ``304 Not Modified`` if
+nothing changed, without touching the database.
+
+The ETag also covers the viewer's id, theme and CSRF secret, and
+responses carry ``Vary: Cookie``, so shared caches keep one copy per
+visitor. Pages about to show a flash message are always rendered.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.messages.storage.session import SessionStorage
+from django.core.cache import cache
+from django.urls import Resolver404, resolve
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
+from django.utils.http import http_date, parse_http_date_safe
+
+from . import page_cache
+
+CACHE_PREFIX = 'validators'
+TIMEOUT = getattr(settings, 'CONDITIONAL_TIMEOUT', 60 * 60 * 24)
+URL_NAMES = frozenset(getattr(settings, 'CONDITIONAL_URL_NAMES', (
+    'blog:home',
+    'blog:genre_posts',
+    'blog:post_detail',
+    'blog:user_profile',
+)))
+
+
+def applies(request):
+    """
+    Whether the request is for a page with validators
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if page_cache.MESSAGES_COOKIE_NAME in request.COOKIES or SessionStorage.session_key in request.session:
+        return False
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return False
+    return match.view_name in URL_NAMES
+
+
+def _tags_key(request):
+    digest = hashlib.sha256(request.get_full_path().encode()).hexdigest()
+    return f'{CACHE_PREFIX}:{digest}'
+
+
+def _viewer(request):
+    user = request.user
+    if not user.is_authenticated:
+        return None, False
+    profile = getattr(user, 'profile', None)
+    return user.pk, bool(profile is not None and profile.dark_mode)
+
+
+def _viewer_tags(request, tags):
+    tags = set(tags)
+    if request.user.is_authenticated:
+        tags.add(page_cache.viewer_tag(request.user.pk))
+    return tags
+
+
+def _validators(request, tags, versions=None):
+    """
+    ``(etag, newest version)`` of the page for this viewer, or None when a
+    tag's version is unknown
+    """
+    user_id, dark_mode = _viewer(request)
+    tags = _viewer_tags(request, tags)
+    if versions is None:
+        versions = page_cache.tag_versions(tags)
+    if len(versions) != len(tags):
+        return None
+    fingerprint = repr((
+        request.get_full_path(), user_id, dark_mode,
+        request.META.get('CSRF_COOKIE'), sorted(versions.items()),
+    ))
+    return quote_etag(hashlib.sha256(fingerprint.encode()).hexdigest()[:32]), max(versions.values())
+
+
+def not_modified(request):
+    """
+    A 304 for a revalidation of an unchanged page, else None
+    """
+    if 'HTTP_IF_NONE_MATCH' not in request.META and 'HTTP_IF_MODIFIED_SINCE' not in request.META:
+        return None
+    tags = cache.get(_tags_key(request))
+    if tags is None:
+        return None
+    validators = _validators(request, tags)
+    if validators is None:
+        return None
+    etag, version = validators
+    return get_conditional_response(request, etag=etag, last_modified=version // 10 ** 9)
+
+
+def respond(request, response):
+    """
+    The stored response, or a 304 when the reader's copy matches its validators
+    """
+    last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+    return get_conditional_response(request, etag=response.get('ETag'), last_modified=last_modified, response=response)
+
+
+def start(request):
+    """
+    Collect the tags of the page about to be rendered (page_cache may already be)
+    """
+    if getattr(request, '_page_cache_tags', None) is None:
+        request._page_cache_tags = {page_cache.SITE_TAG}
+    # Same start as page_cache's, or the tags it versions look newer than its copy
+    started_at = getattr(request, '_page_cache_started_at', None)
+    request._conditional_started_at = started_at if started_at is not None else time.time_ns()
+
+
+def finish(request, response):
+    """
+    Remember the rendered page's tags and set its validators
+    """
+    patch_vary_headers(response, ('Cookie',))
+    if response.status_code != 200 or response.streaming:
+        return
+    # Browsers and proxies may keep the page, but must revalidate it on every use
+    patch_cache_control(response, no_cache=True, **({'private': True} if request.user.is_authenticated else {}))
+    tags = sorted(request._page_cache_tags)
+    versions = page_cache.version_tags(_viewer_tags(request, tags), request._conditional_started_at)
+    # Most renders of a URL carry the same tags: only write them when they change
+    tags_key = _tags_key(request)
+    if cache.get(tags_key) != tags:
+        cache.set(tags_key, tags, TIMEOUT)
+    validators = _validators(request, tags, versions)
+    # Skip pages whose tags were purged mid-render: the validators would claim newer content
+    if validators is None or validators[1] > request._conditional_started_at:
+        return
+    etag, version = validators
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(version // 10 ** 9)
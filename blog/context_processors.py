@@ -1,3 +1,9 @@
+from . import genres
+
+SITE_NAME = "Tori's Blog"
+SITE_DESCRIPTION = 'A modern blog platform inspired by Substack'
+
+
 def theme_context(request):
     """
     Add theme-related context to all templates
@@ -6,6 +12,15 @@ def theme_context(request):
 
     return {
         'theme_mode': theme_mode,
-        'SITE_NAME': "Tori's Blog",
-        'SITE_DESCRIPTION': 'A modern blog platform inspired by Substack',
-    }
\ No newline at end of file
+        'SITE_NAME': SITE_NAME,
+        'SITE_DESCRIPTION': SITE_DESCRIPTION,
+    }
+
+
+def genre_context(request):
+    """
+    Add every genre (with published post counts) to all templates
+    """
+    return {
+        'genres': genres.registry().genres,
+    }
@@ -0,0 +1,64 @@
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Comment, CommentLike, Post, PostLike
+
+
+def adjust_counter(model, pk, field, delta):
+    """
+    Atomically add delta to a denormalized counter column, never going below zero
+    """
+    model.objects.filter(pk=pk).update(**{field: Greatest(F(field) + delta, Value(0))})
+
+
+def count_subquery(model, fk, **filters):
+    """
+    Correlated COUNT(*) of model rows pointing at the outer row through fk
+    """
+    rows = (
+        model.objects.filter(**{fk: OuterRef('pk')}, **filters)
+        .order_by()
+        .values(fk)
+        .annotate(total=Count('*'))
+        .values('total')
+    )
+    return Coalesce(Subquery(rows), Value(0))
+
+
+def post_counter_expressions():
+    return {
+        'likes_count': count_subquery(PostLike, 'post'),
+        'comments_count': count_subquery(Comment, 'post', parent__isnull=True),
+    }
+
+
+def comment_counter_expressions():
+    return {
+        'likes_count': count_subquery(CommentLike, 'comment'),
+    }
+
+
+def recount(queryset, expressions):
+    """
+    Repair drifted counters for the rows in queryset.
+
+    Returns the number of rows whose stored counters did not match. The
+    repair itself is a single UPDATE ... SET col = (SELECT COUNT(*) ...)
+    so concurrent F() updates are never lost.
+    """
+    actual = {f'actual_{name}': expression for name, expression in expressions.items()}
+    drifted = [
+        row['pk'] for row in queryset.annotate(**actual).values('pk', *expressions, *actual)
+        if any(row[name] != row[f'actual_{name}'] for name in expressions)
+    ]
+    if drifted:
+        queryset.model.objects.filter(pk__in=drifted).update(**expressions)
+    return len(drifted)
+
+
+def recount_posts(post_ids):
+    return recount(Post.objects.filter(pk__in=post_ids), post_counter_expressions())
+
+
+def recount_comments(comment_ids):
+    return recount(Comment.objects.filter(pk__in=comment_ids), comment_counter_expressions())
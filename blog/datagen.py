@@ -0,0 +1,179 @@
+"""
+Sample content and distributions for ``populate_data``.
+
+Nothing here touches Django, so the text generators can run in a process
+pool without setting it up. Each chunk of rows gets its own Faker and
+random seed derived from the run's seed, the kind of row and the chunk
+number. A seeded run therefore produces the same rows whatever the number
+of workers or the order they finish in.
+"""
+import random
+
+import numpy as np
+from faker import Faker
+
+# Steepness of the popularity and activity curves: weight of rank k is 1 / k**exponent
+POWER_LAW_EXPONENT = 1.1
+
+ARTICLE_TEMPLATES = {
+    'Technology': [
+        ('The Future of Artificial Intelligence', 'Exploring how AI is revolutionizing industries and changing the way we work and live.'),
+        ('Cybersecurity in 2026', 'Essential security practices every internet user should know to protect their digital life.'),
+        ('The Rise of Quantum Computing', 'Understanding quantum technology and its potential impact on computing.'),
+        ('Sustainable Tech Solutions', 'How technology companies are going green and reducing their environmental footprint.'),
+        ('5G and Beyond: The Next Generation', 'Examining the latest developments in telecommunications technology.'),
+    ],
+    'Health & Wellness': [
+        ('Mental Health in the Digital Age', 'Strategies for maintaining mental wellness while staying connected.'),
+        ('The Science of Sleep', 'Understanding sleep cycles and how to improve your rest quality.'),
+        ('Nutrition Myths Debunked', 'Separating fact from fiction in popular diet trends.'),
+        ('Exercise for Busy Professionals', 'Simple workout routines that fit into a hectic schedule.'),
+        ('Mindfulness and Meditation', 'Practical approaches to reducing stress and finding inner peace.'),
+    ],
+    'Travel': [
+        ('Hidden Gems of Southeast Asia', 'Discovering off-the-beaten-path destinations for the adventurous traveler.'),
+        ('Solo Travel Safety Tips', 'Essential advice for traveling alone with confidence.'),
+        ('Budget Travel Hacks', 'How to see the world without breaking the bank.'),
+        ('Cultural Etiquette Around the World', 'Avoiding common cultural mistakes when traveling abroad.'),
+        ('Sustainable Tourism Practices', 'How to travel responsibly and protect the places we visit.'),
+    ],
+    'Food & Cooking': [
+        ('Farm-to-Table Movement', 'Exploring the benefits of locally sourced ingredients.'),
+        ('International Street Food Guide', 'A culinary journey through global street food cultures.'),
+        ('Plant-Based Cooking for Beginners', 'Simple and delicious recipes for a healthier lifestyle.'),
+        ('The Art of Fermentation', 'Traditional fermentation techniques and their health benefits.'),
+        ('Seasonal Cooking Tips', 'Making the most of fresh, seasonal ingredients.'),
+    ],
+    'Business & Finance': [
+        ('Personal Finance in Your 20s', 'Building a strong financial foundation early in life.'),
+        ('The Gig Economy Revolution', 'Understanding the changing landscape of work and employment.'),
+        ('Investing for Beginners', 'Simple strategies for growing your wealth over time.'),
+        ('Remote Work Best Practices', 'Maximizing productivity while working from home.'),
+        ('Cryptocurrency Explained', 'A beginner\'s guide to digital currencies and blockchain technology.'),
+    ],
+}
+
+# For genres without their own templates
+GENERIC_TEMPLATES = [
+    ('Lessons Learned', 'Reflecting on important life experiences and the wisdom they provide.'),
+    ('Breaking Down Barriers', 'Overcoming challenges and obstacles in pursuit of our goals.'),
+    ('The Power of Community', 'How building connections can transform our lives and society.'),
+    ('Finding Your Voice', 'Discovering your unique perspective and sharing it with the world.'),
+    ('Innovation and Creativity', 'Exploring new ideas and thinking outside the box.'),
+]
+
+TITLE_VARIANTS = ['Personal', 'Professional', 'Deep', 'Comprehensive', 'Practical']
+
+COMMENT_TEMPLATES = [
+    "Great article! Thanks for sharing your insights.",
+    "This really resonates with me. I had a similar experience.",
+    "Interesting perspective! I never thought about it that way.",
+    "Thanks for the detailed explanation. Very helpful!",
+    "I disagree with some points, but appreciate the discussion.",
+    "Could you elaborate more on this topic?",
+    "This is exactly what I needed to read today.",
+    "Fantastic writing! Looking forward to more posts.",
+    "I learned something new. Thank you for this!",
+    "Well researched and thoughtfully written.",
+]
+
+BIO_TEMPLATES = [
+    "Passionate {profession} sharing insights and experiences.",
+    "Welcome to my corner of the internet! I'm a {profession} who loves to write.",
+    "{Profession} by day, writer by passion. Sharing stories that matter.",
+    "Experienced {profession} with a love for storytelling.",
+    "Join me as I explore life as a {profession} and share my journey.",
+]
+
+SIX_MONTHS = 182 * 24 * 60 * 60
+TWO_YEARS = 730 * 24 * 60 * 60
+
+
+def bio(rng, profession):
+    return rng.choice(BIO_TEMPLATES).format(profession=profession.lower(), Profession=profession)
+
+
+def article(rng, fake, genre_name):
+    """
+    ``(title, content)`` of an article in the genre
+    """
+    title_base, content_base = rng.choice(ARTICLE_TEMPLATES.get(genre_name, GENERIC_TEMPLATES))
+    title = f"{title_base}: A {rng.choice(TITLE_VARIANTS)} Perspective"
+    content = "".join([
+        content_base,
+        "\n\n" + fake.text(max_nb_chars=800),
+        "\n\n" + fake.text(max_nb_chars=600),
+        "\n\n" + "What are your thoughts on this topic? I'd love to hear your experiences in the comments below!",
+    ])
+    return title, content
+
+
+def _seeded(seed, kind, chunk):
+    key = f'{seed}:{kind}:{chunk}'
+    fake = Faker()
+    fake.seed_instance(key)
+    return random.Random(key), fake
+
+
+def user_rows(seed, chunk, count):
+    """
+    ``(first_name, last_name, bio, location, has_website, dark_mode, joined_seconds_ago)``
+    for one chunk of users
+    """
+    rng, fake = _seeded(seed, 'users', chunk)
+    rows = []
+    for _ in range(count):
+        profession = fake.job()
+        rows.append((
+            fake.first_name(), fake.last_name(), bio(rng, profession), fake.city(),
+            rng.random() < 0.5, rng.random() < 0.5, rng.randrange(TWO_YEARS),
+        ))
+    return rows
+
+
+def post_rows(seed, chunk, count, genre_names):
+    """
+    ``(genre_index, title, content, created_seconds_ago)`` for one chunk of posts
+    """
+    rng, fake = _seeded(seed, 'posts', chunk)
+    rows = []
+    for _ in range(count):
+        genre_index = rng.randrange(len(genre_names))
+        title, content = article(rng, fake, genre_names[genre_index])
+        rows.append((genre_index, title, content, rng.randrange(SIX_MONTHS)))
+    return rows
+
+
+def power_law_weights(count, rng, exponent=POWER_LAW_EXPONENT):
+    """
+    Probabilities for count items: a few get most of the weight, most get
+    little. Ranks are shuffled, so popularity doesn't follow row order.
+    """
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def sample_pairs(rng, count, left_weights, right_weights, exclude=None):
+    """
+    Up to count distinct ``(left, right)`` index pairs, each side drawn by
+    its weights. exclude(left, right) returns a mask of pairs to drop,
+    e.g. users liking their own posts.
+    """
+    right_size = len(right_weights)
+    count = min(count, len(left_weights) * right_size)
+    keys = np.empty(0, dtype=np.int64)
+    # Popular pairs repeat, so draw more until enough are distinct (or it stops helping)
+    for _ in range(5):
+        missing = count - len(keys)
+        if missing <= 0:
+            break
+        size = int(missing * 1.2) + 16
+        left = rng.choice(len(left_weights), size=size, p=left_weights)
+        right = rng.choice(right_size, size=size, p=right_weights)
+        if exclude is not None:
+            kept = ~exclude(left, right)
+            left, right = left[kept], right[kept]
+        keys = np.union1d(keys, left.astype(np.int64) * right_size + right)
+    keys = rng.permutation(keys)[:count]
+    return keys // right_size, keys % right_size
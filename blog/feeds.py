@@ -0,0 +1,183 @@
+"""
+RSS and Atom feeds of the latest posts: site-wide, per genre and per author.
+
+Feed readers poll every few minutes, so each feed is rendered once and
+kept in the cache as a finished document with its ETag and Last-Modified.
+The document carries the same dependency tags as cached pages (``home``,
+``genre:<slug>``, ``author:<id>`` and ``site``, see blog.page_cache), so
+the post signals that expire pages expire feeds too. Until then a poll
+costs a cache read and no database work, and a reader sending
+``If-None-Match`` or ``If-Modified-Since`` gets a 304.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.syndication.views import Feed
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.feedgenerator import Atom1Feed, Rss201rev2Feed
+from django.utils.http import http_date
+
+from . import page_cache, tiered_cache
+from .context_processors import SITE_DESCRIPTION, SITE_NAME
+from .models import Genre, Post
+
+CACHE_PREFIX = 'feed'
+ITEMS = getattr(settings, 'FEED_ITEMS', 20)
+TIMEOUT = getattr(settings, 'FEED_CACHE_TIMEOUT', 60 * 60 * 24)
+# How long readers and proxies may reuse a feed without asking again
+MAX_AGE = getattr(settings, 'FEED_MAX_AGE', 60 * 5)
+FORMATS = {'rss': Rss201rev2Feed, 'atom': Atom1Feed}
+
+
+class PostFeed(Feed):
+    """
+    The newest published posts of some queryset
+    """
+    def posts(self, obj):
+        return Post.objects.all()
+
+    def tags(self, obj):
+        """
+        page_cache tags whose purge makes this feed stale
+        """
+        return ()
+
+    def items(self, obj):
+        return (
+            self.posts(obj).filter(is_published=True).select_related('author', 'genre')
+            .order_by('-created_at', '-id')[:ITEMS]
+        )
+
+    def subtitle(self, obj):
+        return self._get_dynamic_attr('description', obj)
+
+    def item_title(self, post):
+        return post.title
+
+    def item_description(self, post):
+        return post.excerpt
+
+    def item_pubdate(self, post):
+        return post.created_at
+
+    def item_updateddate(self, post):
+        return post.updated_at
+
+    def item_author_name(self, post):
+        return post.author.get_full_name() or post.author.username
+
+    def item_categories(self, post):
+        return (post.genre.name,)
+
+
+class SiteFeed(PostFeed):
+    title = SITE_NAME
+    description = SITE_DESCRIPTION
+
+    def link(self):
+        return reverse('blog:home')
+
+    def tags(self, obj):
+        return ('home',)
+
+
+class GenreFeed(PostFeed):
+    def get_object(self, request, slug):
+        return get_object_or_404(Genre, slug=slug)
+
+    def posts(self, genre):
+        return Post.objects.filter(genre=genre)
+
+    def tags(self, genre):
+        return (f'genre:{genre.slug}',)
+
+    def title(self, genre):
+        return f'{genre.name} - {SITE_NAME}'
+
+    def description(self, genre):
+        return genre.description or f'The latest {genre.name} posts on {SITE_NAME}'
+
+    def link(self, genre):
+        return genre.get_absolute_url()
+
+
+class AuthorFeed(PostFeed):
+    def get_object(self, request, username):
+        return get_object_or_404(User.objects.select_related('profile'), username=username)
+
+    def posts(self, author):
+        return Post.objects.filter(author=author)
+
+    def tags(self, author):
+        return (f'author:{author.pk}',)
+
+    def title(self, author):
+        return f'{author.get_full_name() or author.username} - {SITE_NAME}'
+
+    def description(self, author):
+        profile = getattr(author, 'profile', None)
+        return (profile.bio if profile is not None else '') or f'The latest posts by {author.username}'
+
+    def link(self, author):
+        return reverse('blog:user_profile', args=[author.username])
+
+
+def _cache_key(request):
+    digest = hashlib.sha256(f'{request.get_host()}{request.path}'.encode()).hexdigest()
+    return f'{CACHE_PREFIX}:{digest}'
+
+
+def _render(request, key, feed_class, feed_format, kwargs):
+    started = time.time_ns()
+    # The copy being replaced, when the feed went stale rather than missing
+    previous = cache.get(key)
+    feed = feed_class()
+    feed.feed_type = FORMATS[feed_format]
+    obj = feed.get_object(request, **kwargs)
+    generator = feed.get_feed(obj, request)
+    content = generator.writeString('utf-8').encode()
+    etag = quote_etag(hashlib.sha256(content).hexdigest()[:32])
+    last_modified = int(generator.latest_post_date().timestamp())
+    if previous is not None:
+        # A post leaving the feed changes it without changing its newest date
+        last_modified = previous['last_modified'] if previous['etag'] == etag else max(last_modified, int(time.time()))
+    tags = (page_cache.SITE_TAG, *feed.tags(obj))
+    page_cache.version_tags(tags, started)
+    return {
+        'content': content,
+        'content_type': generator.content_type,
+        'etag': etag,
+        'last_modified': last_modified,
+        'tags': tags,
+        'rendered_at': started,
+    }
+
+
+def serve(request, feed_class, feed_format, **kwargs):
+    """
+    The feed as an RSS or Atom response, from the cache when it's current;
+    a 304 when the reader already has it
+    """
+    if feed_format not in FORMATS:
+        raise Http404(f'No {feed_format} feeds')
+    key = _cache_key(request)
+    # One request renders a missing or stale feed; the others wait for it, or serve the old copy meanwhile
+    entry = tiered_cache.get_or_compute(
+        key, lambda: _render(request, key, feed_class, feed_format, kwargs),
+        timeout=TIMEOUT, stale_timeout=page_cache.REVALIDATE_TIMEOUT,
+        is_stale=lambda entry: not page_cache.is_current(entry['tags'], entry['rendered_at']),
+    )
+
+    response = HttpResponse(entry['content'], content_type=entry['content_type'])
+    response['ETag'] = entry['etag']
+    response['Last-Modified'] = http_date(entry['last_modified'])
+    response['Cache-Control'] = f'public, max-age={MAX_AGE}'
+    return get_conditional_response(
+        request, etag=entry['etag'], last_modified=entry['last_modified'], response=response,
+    )
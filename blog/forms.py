@@ -2,6 +2,7 @@ from django import forms
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from .models import Post, Comment, UserProfile, Genre
+from . import genres
 
 
 class PostForm(forms.ModelForm):
@@ -34,6 +35,11 @@ class PostForm(forms.ModelForm):
             }),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Render the select from the in-memory registry instead of querying genres
+        self.fields['genre'].choices = [('', self.fields['genre'].empty_label)] + genres.registry().choices()
+
 
 class CommentForm(forms.ModelForm):
     """
@@ -0,0 +1,91 @@
+"""
+Process-wide registry of genres with their published post counts.
+
+Genres change rarely but are read on every page (navbar, footer, forms), so
+each worker keeps them in memory. A generation stamp in the shared cache is
+bumped after any Genre or Post change commits; a worker whose copy was
+built for an older generation reloads it with a single query.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.http import Http404
+
+from .models import Genre
+
+GENERATION_KEY = 'genres:generation'
+
+
+class GenreRegistry:
+    """
+    Immutable snapshot of every genre, ordered by name.
+
+    Each Genre carries ``post_count``, its number of published posts.
+    """
+    def __init__(self, genres, generation):
+        self.genres = list(genres)
+        self.generation = generation
+        self._by_slug = {genre.slug: genre for genre in self.genres}
+        self._by_id = {genre.pk: genre for genre in self.genres}
+
+    def __iter__(self):
+        return iter(self.genres)
+
+    def __len__(self):
+        return len(self.genres)
+
+    def get(self, slug):
+        return self._by_slug.get(slug)
+
+    def get_by_id(self, genre_id):
+        return self._by_id.get(genre_id)
+
+    def get_or_404(self, slug):
+        genre = self.get(slug)
+        if genre is None:
+            raise Http404('No genre matches the given query.')
+        return genre
+
+    def choices(self):
+        return [(genre.pk, genre.name) for genre in self.genres]
+
+
+_registry = None
+_lock = threading.Lock()
+
+
+def _load(generation):
+    genres = Genre.objects.annotate(
+        post_count=Count('posts', filter=Q(posts__is_published=True))
+    ).order_by('name')
+    return GenreRegistry(genres, generation)
+
+
+def registry():
+    """
+    The current GenreRegistry, reloaded when the generation has moved on
+    """
+    global _registry
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # First use, or the stamp was evicted: start a new generation
+        generation = time.time_ns()
+        if not cache.add(GENERATION_KEY, generation, None):
+            generation = cache.get(GENERATION_KEY, generation)
+    current = _registry
+    if current is not None and current.generation == generation:
+        return current
+    with _lock:
+        if _registry is None or _registry.generation != generation:
+            _registry = _load(generation)
+        return _registry
+
+
+def bump():
+    """
+    Invalidate every worker's registry once the current transaction commits
+    """
+    transaction.on_commit(lambda: cache.set(GENERATION_KEY, time.time_ns(), None))
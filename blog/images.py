@@ -0,0 +1,238 @@
+"""
+Responsive derivatives of featured images and avatars.
+
+Originals are served as uploaded, so a 6 MB camera photo could end up
+filling a card thumbnail or a 32px avatar. Once an upload is committed, the
+image is resized in the background to each configured width narrower than
+it and encoded as WebP and JPEG, without its EXIF metadata (see
+blog.imaging). The derivatives are stored next to the original
+(``post_images/photo-640w.webp``). Their widths and names go in the model's
+``<field>_derivatives`` JSON field, along with the source name they were
+rendered from. The ``responsive_image`` and ``avatar`` template tags build
+``srcset`` and ``sizes`` from that field, and show the original until the
+field matches the current image.
+
+Decoding and encoding run in a process pool, off the request path. Reading
+the original and writing the derivatives happen in a small thread pool of
+the web process. ``build_image_derivatives`` backfills existing media and
+content created without signals (bulk imports, ``populate_data --bulk``).
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+
+from . import card_cache, imaging, page_cache
+from .models import Post, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Processes decoding and encoding images per web process; 0 renders inline when the upload commits
+WORKERS = getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2)
+QUALITY = getattr(settings, 'IMAGE_DERIVATIVE_QUALITY', 80)
+BATCH_SIZE = 1000
+
+
+class Target:
+    """
+    An image field with derivatives, and whose pages show it
+    """
+    def __init__(self, kind, model, field, widths, owner_field, tags):
+        self.kind = kind
+        self.model = model
+        self.field = field
+        self.derivatives_field = f'{field}_derivatives'
+        self.widths = tuple(widths)
+        self.owner_field = owner_field
+        self.tags = tags
+
+    @property
+    def storage(self):
+        return self.model._meta.get_field(self.field).storage
+
+
+TARGETS = {
+    'post': Target(
+        'post', Post, 'featured_image', getattr(settings, 'POST_IMAGE_WIDTHS', (320, 640, 960, 1280, 1920)),
+        owner_field='author_id', tags=lambda pk, owner_id: (f'post:{pk}',),
+    ),
+    'avatar': Target(
+        'avatar', UserProfile, 'avatar', getattr(settings, 'AVATAR_WIDTHS', (32, 64, 128, 256)),
+        owner_field='user_id', tags=lambda pk, owner_id: (f'author:{owner_id}', page_cache.viewer_tag(owner_id)),
+    ),
+}
+
+_lock = threading.Lock()
+_threads = None
+_processes = None
+
+
+def _pools():
+    """
+    The thread and process pools of this process, started on first use
+    """
+    global _threads, _processes
+    with _lock:
+        if _threads is None:
+            # Forking a threaded web server can copy held locks into the child; spawn starts clean
+            _processes = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _threads = ThreadPoolExecutor(WORKERS, thread_name_prefix='image-derivatives')
+    return _threads, _processes
+
+
+def is_current(image, derivatives):
+    """
+    Whether derivatives were rendered from the image as it is now
+    """
+    return bool(image) and bool(derivatives) and derivatives.get('source') == image.name
+
+
+def _derivative_name(source, width, fmt):
+    root, _ = os.path.splitext(source)
+    return f'{root}-{width}w.{imaging.FORMATS[fmt][0]}'
+
+
+def _delete_files(storage, derivatives):
+    for fmt in imaging.FORMATS:
+        for _, name in (derivatives or {}).get(fmt, ()):
+            try:
+                storage.delete(name)
+            except OSError:
+                logger.warning('Could not delete image derivative %s', name, exc_info=True)
+
+
+def _invalidate(target, pk, owner_id):
+    card_cache.bump_author(owner_id)
+    page_cache.purge(*target.tags(pk, owner_id))
+
+
+def store(target, pk, source, result):
+    """
+    Save rendered derivatives and record them on the instance, unless its
+    image changed meanwhile; returns whether they were recorded
+    """
+    width, height, files = result
+    storage = target.storage
+    derivatives = {'source': source, 'width': width, 'height': height, **{fmt: [] for fmt in imaging.FORMATS}}
+    for fmt, derivative_width, content in files:
+        name = storage.save(_derivative_name(source, derivative_width, fmt), ContentFile(content))
+        derivatives[fmt].append([derivative_width, name])
+
+    row = target.model.objects.filter(pk=pk).values_list(target.derivatives_field, target.owner_field).first()
+    updated = target.model.objects.filter(pk=pk, **{target.field: source}).update(**{target.derivatives_field: derivatives})
+    if not updated or row is None:
+        _delete_files(storage, derivatives)
+        return False
+    previous, owner_id = row
+    _delete_files(storage, previous)
+    _invalidate(target, pk, owner_id)
+    return True
+
+
+def clear(target, pk):
+    """
+    Drop the derivatives of a removed image
+    """
+    row = target.model.objects.filter(pk=pk).values_list(target.derivatives_field, target.owner_field).first()
+    if row is None or not row[0]:
+        return
+    previous, owner_id = row
+    if target.model.objects.filter(pk=pk, **{target.derivatives_field: previous}).update(**{target.derivatives_field: {}}):
+        _delete_files(target.storage, previous)
+        _invalidate(target, pk, owner_id)
+
+
+def read(target, source):
+    with target.storage.open(source, 'rb') as file:
+        return file.read()
+
+
+def derive(target, pk, source, processes=None):
+    """
+    Render and store the derivatives of one image, in the process pool when given
+    """
+    try:
+        data = read(target, source)
+        if processes is None:
+            result = imaging.render(data, target.widths, QUALITY)
+        else:
+            result = processes.submit(imaging.render, data, target.widths, QUALITY).result()
+        store(target, pk, source, result)
+    except Exception:
+        # A corrupt upload only loses its derivatives: pages keep showing the original
+        logger.warning('Could not render derivatives of %s', source, exc_info=True)
+
+
+def _derive_in_background(target, pk, source):
+    _, processes = _pools()
+    try:
+        derive(target, pk, source, processes)
+    finally:
+        close_old_connections()
+
+
+def schedule(kind, instance):
+    """
+    Render the instance's derivatives in the background once the current
+    transaction commits, if its image changed since they were last rendered
+    """
+    target = TARGETS[kind]
+    image = getattr(instance, target.field)
+    derivatives = getattr(instance, target.derivatives_field)
+    pk = instance.pk
+    if not image:
+        if derivatives:
+            transaction.on_commit(lambda: clear(target, pk))
+        return
+    if is_current(image, derivatives):
+        return
+    source = image.name
+    if WORKERS <= 0:
+        transaction.on_commit(lambda: derive(target, pk, source))
+    else:
+        transaction.on_commit(lambda: _pools()[0].submit(_derive_in_background, target, pk, source))
+
+
+def stale(target, force=False):
+    """
+    ``(pk, source)`` of every image whose derivatives are missing or out of
+    date; of every image with force
+    """
+    rows = (
+        target.model.objects.exclude(**{target.field: ''}).exclude(**{f'{target.field}__isnull': True})
+        .order_by('pk').values_list('pk', target.field, target.derivatives_field)
+    )
+    # Pages by pk rather than one open cursor: the caller updates the rows it is given
+    last_pk = 0
+    while batch := list(rows.filter(pk__gt=last_pk)[:BATCH_SIZE]):
+        last_pk = batch[-1][0]
+        for pk, source, derivatives in batch:
+            if force or not derivatives or derivatives.get('source') != source:
+                yield pk, source
+
+
+def sources(image, derivatives):
+    """
+    ``src``, ``srcset`` per format and intrinsic size for an ``<img>`` of the
+    image: its derivatives when current, else the original
+    """
+    if not is_current(image, derivatives):
+        return {'src': image.url if image else '', 'srcset': {}, 'width': None, 'height': None}
+    storage = image.storage
+    srcset = {
+        fmt: ', '.join(f'{storage.url(name)} {width}w' for width, name in derivatives.get(fmt, ()))
+        for fmt in imaging.FORMATS
+    }
+    # Browsers without srcset get the largest JPEG, which is still stripped and no larger than the original
+    widest = max(derivatives['jpeg'], default=None)
+    return {
+        'src': storage.url(widest[1]) if widest else image.url,
+        'srcset': srcset,
+        'width': derivatives['width'],
+        'height': derivatives['height'],
+    }
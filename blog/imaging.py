@@ -0,0 +1,73 @@
+"""
+Resizing and re-encoding of uploaded images for ``blog.images``.
+
+Nothing here touches Django, so ``render`` can run in a process pool
+started without setting it up.
+"""
+import io
+
+from PIL import Image, ImageOps
+
+# File extension and Pillow format of each derivative format, best first
+FORMATS = {'webp': ('webp', 'WEBP'), 'jpeg': ('jpg', 'JPEG')}
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+ORIENTATION_TAG = 0x0112
+
+
+def _has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def _encode(image, fmt, quality, icc_profile):
+    buffer = io.BytesIO()
+    # Nothing is copied from the original but the colour profile: EXIF (GPS, camera) is dropped
+    options = {'quality': quality, 'icc_profile': icc_profile}
+    if fmt == 'jpeg':
+        if image.mode == 'RGBA':
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        options.update(optimize=True, progressive=True)
+    else:
+        options.update(method=4)
+    image.save(buffer, FORMATS[fmt][1], **{key: value for key, value in options.items() if value is not None})
+    return buffer.getvalue()
+
+
+def derivative_widths(width, widths):
+    """
+    The widths to render for an image width pixels wide: each of widths
+    narrower than it, and the largest fitting one at the original size
+    """
+    narrower = sorted(w for w in set(widths) if w < width)
+    if width <= max(widths):
+        narrower.append(width)
+    return narrower
+
+
+def render(data, widths, quality):
+    """
+    Resize an encoded image to the widths it is wider than, in every format.
+
+    Returns ``(width, height, [(format, width, bytes), ...])`` where width
+    and height are those of the upright original.
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if image.getexif().get(ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    targets = derivative_widths(width, widths)
+    # Let the JPEG decoder scale down by up to 8x while decoding; both sides stay above the largest target
+    image.draft('RGB', (targets[-1], targets[-1]))
+    icc_profile = image.info.get('icc_profile')
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+
+    files = []
+    for target in targets:
+        size = (target, max(round(height * target / width), 1))
+        resized = image if image.size == size else image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        for fmt in FORMATS:
+            files.append((fmt, target, _encode(resized, fmt, quality, icc_profile)))
+    return width, height, files
@@ -0,0 +1,387 @@
+"""
+Write-behind buffer for post and comment likes.
+
+A like toggle appends one LikeEvent row instead of creating or deleting a
+PostLike/CommentLike and updating the target's counter. That removes the
+row-level contention on a hot post's counter during a traffic spike. Every
+``LIKE_BUFFER_FLUSH_INTERVAL_MS`` milliseconds at most, one process
+applies the buffered events in batches:
+
+- the last event per (user, target) wins,
+- new likes are written with one ``bulk_create``,
+- removed likes are deleted in bulk DELETEs,
+- the affected counters are recounted exactly,
+- and the events are deleted.
+
+A toggle applies at most one batch, at most once per interval across
+processes, so its request never pays for a whole backlog; the
+``flush_like_events`` command drains the rest on a timer. Each batch runs
+in one transaction holding the ``likes:flush`` Lock row, so batches are
+applied one at a time and in event order across processes.
+
+A toggle reads the user's state, the stored count and the pending deltas
+in one query, then appends its event. Each event records the id of the
+user's latest pending event for the target it was based on
+(``previous_id``), which is unique per user and target: when a double
+click races, the second insert fails and is retried on the new state, so
+it records one like and one unlike rather than two likes.
+
+Until then, readers see optimistic values: a viewer's like state is their
+latest pending event, if any, and ``likes_count`` is the stored count plus
+the pending deltas, so users always see their own writes.
+"""
+import logging
+from collections import defaultdict
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Exists, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from . import page_cache
+from .counters import recount_comments, recount_posts
+from .models import Comment, CommentLike, LikeEvent, Lock, Post, PostLike
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_MS = getattr(settings, 'LIKE_BUFFER_FLUSH_INTERVAL_MS', 500)
+BATCH_SIZE = getattr(settings, 'LIKE_BUFFER_BATCH_SIZE', 1000)
+THROTTLE_KEY = 'likes:flush:throttle'
+FLUSH_LOCK = 'likes:flush'
+# Targets per lookup and rows per DELETE statement, keeping the WHERE clauses small
+DELETE_CHUNK = 200
+# Attempts at recording a toggle while concurrent toggles of the same user and target win the race
+RECORD_ATTEMPTS = 5
+
+
+class LikeTarget:
+    """
+    How likes of one kind of object are stored and counted
+    """
+    def __init__(self, kind, model, like_model, field, recount):
+        self.kind = kind
+        self.model = model
+        self.like_model = like_model
+        self.field = field
+        self.recount = recount
+
+    def post_ids(self, target_ids):
+        if self.model is Post:
+            return set(target_ids)
+        return set(Comment.objects.filter(pk__in=target_ids).values_list('post_id', flat=True))
+
+
+TARGETS = {
+    LikeEvent.POST: LikeTarget(LikeEvent.POST, Post, PostLike, 'post_id', recount_posts),
+    LikeEvent.COMMENT: LikeTarget(LikeEvent.COMMENT, Comment, CommentLike, 'comment_id', recount_comments),
+}
+KINDS = {target.model: kind for kind, target in TARGETS.items()}
+
+
+def _kind(obj):
+    return KINDS[type(obj)]
+
+
+def hold(name, wait=True):
+    """
+    Lock the named Lock row until the current transaction ends. Without
+    wait, return False instead of waiting when another process holds it.
+    """
+    if not wait and connection.features.has_select_for_update_skip_locked:
+        locked = Lock.objects.select_for_update(skip_locked=True).filter(name=name)
+        if locked.values_list('name', flat=True).first() is not None:
+            return True
+        if Lock.objects.filter(name=name).exists():
+            return False
+    # An upsert always writes the row, so it waits for and then keeps its
+    # row lock (the database's write lock on SQLite), creating it if needed
+    Lock.objects.bulk_create(
+        [Lock(name=name, acquired_at=timezone.now())],
+        update_conflicts=True, unique_fields=['name'], update_fields=['acquired_at'],
+    )
+    return True
+
+
+def is_liked(user, kind, target_id):
+    """
+    Whether the user likes the target, counting their pending events
+    """
+    latest = (
+        LikeEvent.objects.filter(user=user, kind=kind, target_id=target_id)
+        .order_by('-id').values_list('liked', flat=True).first()
+    )
+    if latest is not None:
+        return latest
+    target = TARGETS[kind]
+    return target.like_model.objects.filter(user=user, **{target.field: target_id}).exists()
+
+
+def _latest_events(user, kind, target_ids):
+    """
+    ``{target_id: (event id, liked)}`` of the user's latest pending event per target
+    """
+    latest = {}
+    events = LikeEvent.objects.filter(user=user, kind=kind, target_id__in=target_ids).order_by('id')
+    for event_id, target_id, liked in events.values_list('id', 'target_id', 'liked'):
+        latest[target_id] = (event_id, liked)
+    return latest
+
+
+def current_states(user, kind, target_ids):
+    """
+    The user's like state for each target id, counting their pending events
+    """
+    target = TARGETS[kind]
+    states = dict.fromkeys(target_ids, False)
+    liked = target.like_model.objects.filter(user=user, **{f'{target.field}__in': states})
+    states.update(dict.fromkeys(liked.values_list(target.field, flat=True), True))
+    states.update({target_id: liked for target_id, (_, liked) in _latest_events(user, kind, states).items()})
+    return states
+
+
+def _record(build):
+    """
+    Save the events ``build()`` returns, building them again on the new
+    state while a concurrent toggle of the same user and target wins the
+    ``previous_id`` race; returns the events
+    """
+    for attempt in range(RECORD_ATTEMPTS):
+        events = build()
+        try:
+            # Inside a transaction, a savepoint keeps the failed insert from aborting it
+            with transaction.atomic() if connection.in_atomic_block else nullcontext():
+                LikeEvent.objects.bulk_create(events)
+            return events
+        except IntegrityError:
+            if attempt == RECORD_ATTEMPTS - 1:
+                raise
+
+
+def set_states(user, wanted):
+    """
+    Buffer the events that bring the user's likes to ``wanted`` (kind to a
+    dict of target id to desired state); targets already in that state are
+    left alone
+    """
+    def build():
+        events = []
+        for kind, states in wanted.items():
+            if not states:
+                continue
+            target = TARGETS[kind]
+            latest = _latest_events(user, kind, states)
+            liked_rows = set(
+                target.like_model.objects.filter(user=user, **{f'{target.field}__in': states})
+                .values_list(target.field, flat=True)
+            ) if len(latest) < len(states) else set()
+            for target_id, liked in states.items():
+                previous_id, current = latest.get(target_id, (0, target_id in liked_rows))
+                if current != liked:
+                    events.append(LikeEvent(
+                        kind=kind, user=user, target_id=target_id, liked=liked, delta=1 if liked else -1,
+                        previous_id=previous_id,
+                    ))
+        return events
+
+    if _record(build):
+        # The viewer's like markers changed before the counters are flushed
+        page_cache.purge(page_cache.viewer_tag(user.pk))
+
+
+def optimistic_counts(kind, target_ids):
+    """
+    Stored likes_count plus pending deltas for each existing target id
+    """
+    target = TARGETS[kind]
+    counts = dict(target.model.objects.filter(pk__in=target_ids).values_list('pk', 'likes_count'))
+    deltas = (
+        LikeEvent.objects.filter(kind=kind, target_id__in=counts).order_by()
+        .values('target_id').annotate(delta=Sum('delta')).values_list('target_id', 'delta')
+    )
+    for target_id, delta in deltas:
+        counts[target_id] = max(counts[target_id] + delta, 0)
+    return counts
+
+
+def _toggle_state(user, kind, target_id):
+    """
+    ``(latest event id or 0, liked, optimistic likes_count)`` of the user and
+    target in one query, or None when the target is gone
+    """
+    target = TARGETS[kind]
+    events = LikeEvent.objects.filter(kind=kind, target_id=OuterRef('pk'))
+    latest = events.filter(user=user).order_by('-id')
+    row = target.model.objects.filter(pk=target_id).annotate(
+        latest_id=Subquery(latest.values('id')[:1]),
+        latest_liked=Subquery(latest.values('liked')[:1]),
+        liked_row=Exists(target.like_model.objects.filter(user=user, **{target.field: OuterRef('pk')})),
+        pending=Subquery(events.order_by().values('target_id').annotate(total=Sum('delta')).values('total')),
+    ).values_list('latest_id', 'latest_liked', 'liked_row', 'likes_count', 'pending').first()
+    if row is None:
+        return None
+    latest_id, latest_liked, liked_row, likes_count, pending = row
+    liked = liked_row if latest_id is None else latest_liked
+    return latest_id or 0, liked, max(likes_count + (pending or 0), 0)
+
+
+def toggle(user, obj):
+    """
+    Like or unlike a post or comment for the user.
+
+    Returns ``(liked, likes_count)``, where likes_count is the optimistic
+    count: the stored counter plus every pending delta, this toggle's included.
+    """
+    kind = _kind(obj)
+    state = {}
+
+    def build():
+        current = _toggle_state(user, kind, obj.pk)
+        if current is None:
+            # Deleted meanwhile: the event is skipped when flushed
+            current = (0, getattr(obj, 'liked_by_viewer', False), obj.likes_count)
+        previous_id, liked, likes_count = current
+        state.update(liked=not liked, likes_count=max(likes_count + (-1 if liked else 1), 0))
+        return [LikeEvent(
+            kind=kind, user=user, target_id=obj.pk, liked=not liked, delta=-1 if liked else 1,
+            previous_id=previous_id,
+        )]
+
+    _record(build)
+    page_cache.purge(page_cache.viewer_tag(user.pk))
+    try:
+        maybe_flush()
+    except DatabaseError:
+        # The events stay buffered for the next flush; the toggle itself is recorded
+        logger.warning('Could not flush buffered likes', exc_info=True)
+    return state['liked'], state['likes_count']
+
+
+def overlay_pending(user, posts=(), comments=()):
+    """
+    Apply pending events to objects already marked with ``liked_by_viewer``.
+
+    The viewer's own latest event decides their like state, and every
+    pending delta is added to ``likes_count``. One query for both lists.
+    """
+    by_key = defaultdict(list)
+    for kind, objects in ((LikeEvent.POST, posts), (LikeEvent.COMMENT, comments)):
+        for obj in objects:
+            by_key[kind, obj.pk].append(obj)
+    if not by_key:
+        return
+    condition = Q()
+    for kind, objects in ((LikeEvent.POST, posts), (LikeEvent.COMMENT, comments)):
+        if objects:
+            condition |= Q(kind=kind, target_id__in={obj.pk for obj in objects})
+    deltas = defaultdict(int)
+    events = LikeEvent.objects.filter(condition).order_by('id').values_list('kind', 'target_id', 'user_id', 'liked', 'delta')
+    for kind, target_id, user_id, liked, delta in events:
+        deltas[kind, target_id] += delta
+        if user_id == user.pk:
+            for obj in by_key[kind, target_id]:
+                obj.liked_by_viewer = liked
+    for key, delta in deltas.items():
+        for obj in by_key[key]:
+            obj.likes_count = max(obj.likes_count + delta, 0)
+
+
+def maybe_flush():
+    """
+    Apply the oldest batch of events, unless any process has done so in the
+    last interval; returns whether this call applied one. The rest of a
+    backlog is left to later toggles and the ``flush_like_events`` command.
+    """
+    if cache.add(THROTTLE_KEY, 1, FLUSH_INTERVAL_MS / 1000):
+        return _apply_batch(BATCH_SIZE) is not None
+    return False
+
+
+def flush(batch_size=BATCH_SIZE):
+    """
+    Apply every buffered event; returns the number of events applied, or
+    None when another process is already flushing.
+
+    Batches are applied one at a time under the flush lock, oldest events
+    first, so the last event for a (user, target) pair is also the last
+    one applied.
+    """
+    applied = 0
+    while True:
+        count = _apply_batch(batch_size)
+        if count is None:
+            # Another process holds the lock and will drain the rest
+            return applied or None
+        applied += count
+        if count < batch_size:
+            return applied
+
+
+def _apply_batch(batch_size):
+    """
+    Apply the oldest batch of events; None when another process is flushing
+    """
+    with transaction.atomic():
+        if not hold(FLUSH_LOCK, wait=False):
+            return None
+        events = list(
+            LikeEvent.objects.order_by('id')
+            .values_list('id', 'kind', 'user_id', 'target_id', 'liked')[:batch_size]
+        )
+        if not events:
+            return 0
+        final = defaultdict(dict)
+        for event_id, kind, user_id, target_id, liked in events:
+            final[kind][(user_id, target_id)] = liked
+
+        purged_posts = set()
+        for kind, states in final.items():
+            purged_posts |= _apply(TARGETS[kind], states)
+        LikeEvent.objects.filter(id__in=[event[0] for event in events]).delete()
+        if purged_posts:
+            page_cache.purge(*(f'post:{post_id}' for post_id in purged_posts))
+        return len(events)
+
+
+def _apply(target, states):
+    """
+    Write the final like states of one kind; returns the posts affected
+    """
+    target_ids = {target_id for _, target_id in states}
+    # Targets deleted since the event was recorded have no likes to keep
+    target_ids &= set(target.model.objects.filter(pk__in=target_ids).values_list('pk', flat=True))
+
+    liked = [(user_id, target_id) for (user_id, target_id), state in states.items() if state and target_id in target_ids]
+    target.like_model.objects.bulk_create(
+        [target.like_model(user_id=user_id, **{target.field: target_id}) for user_id, target_id in liked],
+        ignore_conflicts=True,
+    )
+
+    unliked = defaultdict(list)
+    for (user_id, target_id), state in states.items():
+        if not state and target_id in target_ids:
+            unliked[target_id].append(user_id)
+    _delete_likes(target, unliked)
+
+    target.recount(target_ids)
+    return target.post_ids(target_ids)
+
+
+def _delete_likes(target, unliked):
+    """
+    Delete like rows in bulk, without the per-row delete signals; the
+    counters they maintain are recounted by the caller instead
+    """
+    like_model = target.like_model
+    target_ids = list(unliked)
+    for start in range(0, len(target_ids), DELETE_CHUNK):
+        condition = Q()
+        for target_id in target_ids[start:start + DELETE_CHUNK]:
+            condition |= Q(user_id__in=unliked[target_id], **{target.field: target_id})
+        ids = list(like_model.objects.filter(condition).values_list('pk', flat=True))
+        table = connection.ops.quote_name(like_model._meta.db_table)
+        with connection.cursor() as cursor:
+            for offset in range(0, len(ids), DELETE_CHUNK):
+                chunk = ids[offset:offset + DELETE_CHUNK]
+                cursor.execute(f'DELETE FROM {table} WHERE id IN ({", ".join(["%s"] * len(chunk))})', chunk)
@@ -0,0 +1,104 @@
+import random
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from blog import session_store
+
+DB_ENGINE = 'django.contrib.sessions.backends.db'
+
+
+class SessionWriteCounter:
+    """
+    connection.execute_wrapper counting statements that write django_session
+    """
+    def __init__(self):
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if 'django_session' in sql and sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')):
+            self.writes += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Compare session write load of the database engine and the write-behind engine'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=200, help='Distinct visitors (default: 200)')
+        parser.add_argument('--requests', type=int, default=5000, help='Page views to simulate (default: 5000)')
+        parser.add_argument(
+            '--write-ratio',
+            type=float,
+            default=0.05,
+            help='Share of page views that change the session (default: 0.05)',
+        )
+        parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS(
+            f"⏱️  Simulating {options['requests']} page views over {options['sessions']} sessions "
+            f"({options['write_ratio']:.0%} change the session)..."
+        ))
+        engines = [DB_ENGINE]
+        if settings.SESSION_ENGINE != DB_ENGINE:
+            engines.append(settings.SESSION_ENGINE)
+
+        results = {}
+        for engine in engines:
+            results[engine] = self.run(engine, options)
+            writes, elapsed = results[engine]
+            self.stdout.write(
+                f'  ✓ {engine}: {writes} session writes, {writes / options["requests"]:.3f} per request, '
+                f'{writes / elapsed:.1f} writes/s at {options["requests"] / elapsed:.0f} requests/s'
+            )
+
+        if len(results) == 2:
+            baseline, candidate = (results[engine][0] for engine in engines)
+            reduction = 1 - candidate / baseline if baseline else 0
+            self.stdout.write(self.style.SUCCESS(f'✅ {reduction:.2%} fewer session writes with {engines[1]}'))
+        else:
+            self.stdout.write(self.style.WARNING(f'⚠️  SESSION_ENGINE is already {DB_ENGINE}; nothing to compare'))
+
+    def run(self, engine, options):
+        """
+        Replay the same page views through SessionMiddleware; returns (writes, seconds)
+        """
+        rng = random.Random(options['seed'])
+        store_class = import_module(engine).SessionStore
+        session_keys = []
+        for visitor in range(options['sessions']):
+            store = store_class()
+            store['visits'] = 0
+            store.create()
+            session_keys.append(store.session_key)
+
+        def view(request):
+            visits = request.session.get('visits', 0)
+            if rng.random() < options['write_ratio']:
+                request.session['visits'] = visits + 1
+            return HttpResponse()
+
+        factory = RequestFactory()
+        counter = SessionWriteCounter()
+        try:
+            with override_settings(SESSION_ENGINE=engine, SESSION_SAVE_EVERY_REQUEST=True):
+                middleware = SessionMiddleware(view)
+                with connection.execute_wrapper(counter):
+                    started = time.perf_counter()
+                    for _ in range(options['requests']):
+                        request = factory.get('/')
+                        request.COOKIES[settings.SESSION_COOKIE_NAME] = rng.choice(session_keys)
+                        middleware(request)
+                    session_store.flush()
+                    elapsed = time.perf_counter() - started
+        finally:
+            for session_key in session_keys:
+                store_class(session_key).delete()
+        return counter.writes, elapsed
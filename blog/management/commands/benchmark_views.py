@@ -0,0 +1,91 @@
+import json
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from blog import benchmark
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every view on a seeded test database and compare against a baseline run'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale',
+            choices=benchmark.SCALES,
+            default='1k',
+            help='Dataset size (default: 1k posts)',
+        )
+        parser.add_argument('--seed', type=int, default=1, help='Dataset seed (default: 1)')
+        parser.add_argument('--iterations', type=int, default=20, help='Measured requests per route (default: 20)')
+        parser.add_argument('--warmup', type=int, default=2, help='Unmeasured requests per route first (default: 2)')
+        parser.add_argument('--route', action='append', dest='routes', help='Only this URL name (repeatable)')
+        parser.add_argument('--output', help='Results file (default: .cache/benchmarks/views-<scale>-<time>.json)')
+        parser.add_argument('--baseline', help='Earlier results file to compare against')
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=0.2,
+            help='Relative growth in p95, queries or allocations that fails the run (default: 0.2)',
+        )
+        parser.add_argument(
+            '--keepdb',
+            action='store_true',
+            help='Keep the test database, and reuse a dataset left by an earlier run',
+        )
+
+    def handle(self, *args, **options):
+        scale = benchmark.SCALES[options['scale']]
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = json.loads(Path(options['baseline']).read_text())
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Cannot read baseline: {e}')
+
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            if options['keepdb'] and Post.objects.exists():
+                self.stdout.write('♻️  Reusing the dataset in the kept test database')
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    f"🌱 Building the {options['scale']} dataset (seed {options['seed']})..."
+                ))
+                started = time.perf_counter()
+                benchmark.build_dataset(seed=options['seed'], stdout=self.stdout, **scale)
+                self.stdout.write(f'  ✓ Built in {time.perf_counter() - started:.1f}s')
+
+            self.stdout.write(self.style.SUCCESS(
+                f"⏱️  Benchmarking routes ({options['iterations']} requests each, {options['warmup']} warmup)..."
+            ))
+            try:
+                results = benchmark.run(
+                    iterations=options['iterations'], warmup=options['warmup'],
+                    routes=options['routes'], stdout=self.stdout,
+                )
+            except LookupError as e:
+                raise CommandError(str(e))
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        results['meta'].update(scale=options['scale'], seed=options['seed'])
+        output = Path(options['output'] or (
+            Path(settings.BASE_DIR) / '.cache' / 'benchmarks' / f"views-{options['scale']}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        ))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS(f'💾 Results written to {output}'))
+
+        if baseline is not None:
+            regressions = benchmark.compare(baseline, results, options['threshold'])
+            if regressions:
+                for regression in regressions:
+                    self.stdout.write(self.style.ERROR(f'  ✗ {regression}'))
+                raise CommandError(f'{len(regressions)} regressions over {options["threshold"]:.0%}')
+            self.stdout.write(self.style.SUCCESS(f"✅ No regressions over {options['threshold']:.0%}"))
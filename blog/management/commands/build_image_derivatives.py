@@ -0,0 +1,82 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from blog import images, imaging
+
+
+class Command(BaseCommand):
+    help = 'Render responsive WebP/JPEG derivatives of featured images and avatars'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--kind',
+            choices=sorted(images.TARGETS),
+            action='append',
+            help='Only this kind of image (repeatable; default: all)',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-render images whose derivatives are already current',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Processes resizing images (default: one per CPU)',
+        )
+
+    def handle(self, *args, **options):
+        self.workers = max(options['workers'], 1)
+        pool = ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            for kind in options['kind'] or sorted(images.TARGETS):
+                self.build(pool, images.TARGETS[kind], options['force'])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.stdout.write(self.style.SUCCESS('✅ Image derivatives are up to date!'))
+
+    def build(self, pool, target, force):
+        self.stdout.write(f'🖼️  Rendering {target.kind} derivatives...')
+        stored = failed = 0
+        for pk, source, result in self.render(pool, target, images.stale(target, force)):
+            if isinstance(result, Exception):
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'  ⚠️  {source}: {result}'))
+            elif images.store(target, pk, source, result):
+                stored += 1
+        self.stdout.write(f'  ✓ Stored derivatives of {stored} images')
+        if failed:
+            self.stdout.write(self.style.WARNING(f'  ⚠️  {failed} images could not be read or decoded'))
+
+    def render(self, pool, target, rows):
+        """Yield (pk, source, result or exception) per image, keeping a few in flight"""
+        pending = deque()
+
+        def collect(pk, source, future):
+            try:
+                return pk, source, future.result()
+            except Exception as error:
+                return pk, source, error
+
+        for pk, source in rows:
+            try:
+                data = images.read(target, source)
+            except OSError as error:
+                yield pk, source, error
+                continue
+            if pool is None:
+                try:
+                    yield pk, source, imaging.render(data, target.widths, images.QUALITY)
+                except Exception as error:
+                    yield pk, source, error
+                continue
+            pending.append((pk, source, pool.submit(imaging.render, data, target.widths, images.QUALITY)))
+            if len(pending) > 2 * self.workers:
+                yield collect(*pending.popleft())
+        while pending:
+            yield collect(*pending.popleft())
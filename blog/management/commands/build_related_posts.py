@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from blog import related
+
+
+class Command(BaseCommand):
+    help = 'Compute content-similarity related posts (TF-IDF cosine neighbours)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stale',
+            action='store_true',
+            help='Only rebuild posts that are new or edited since their last build, against the stored matrix',
+        )
+        parser.add_argument(
+            '--top-k',
+            type=int,
+            default=related.TOP_K,
+            help=f'Neighbours stored per post (default: {related.TOP_K})',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=related.BATCH_SIZE,
+            help=f'Posts per similarity matrix product (default: {related.BATCH_SIZE})',
+        )
+
+    def handle(self, *args, **options):
+        if options['stale']:
+            stale = related.stale_posts().count()
+            if not stale:
+                self.stdout.write(self.style.SUCCESS('✅ Related posts are up to date!'))
+                return
+            self.stdout.write(self.style.SUCCESS(f'🔗 Rebuilding related posts for {stale} stale posts...'))
+        else:
+            self.stdout.write(self.style.SUCCESS('🔗 Rebuilding related posts for every post...'))
+
+        built = related.build_related_posts(
+            stale_only=options['stale'],
+            top_k=options['top_k'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(f'  ✓ Stored neighbours for {built} posts')
+        self.stdout.write(self.style.SUCCESS('✅ Related posts built!'))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from blog import like_buffer
+
+
+class Command(BaseCommand):
+    help = 'Apply buffered likes and unlikes to PostLike/CommentLike and their counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval-ms',
+            type=int,
+            default=None,
+            help='Keep running, flushing every this many milliseconds (default: flush once)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=like_buffer.BATCH_SIZE,
+            help=f'Events applied per transaction (default: {like_buffer.BATCH_SIZE})',
+        )
+
+    def handle(self, *args, **options):
+        interval = options['interval_ms']
+        if interval is None:
+            self.flush(options['batch_size'])
+            return
+        self.stdout.write(self.style.SUCCESS(f'❤️  Flushing buffered likes every {interval} ms (Ctrl+C to stop)...'))
+        try:
+            while True:
+                started = time.monotonic()
+                self.flush(options['batch_size'], quiet=True)
+                time.sleep(max(interval / 1000 - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('✅ Stopped'))
+
+    def flush(self, batch_size, quiet=False):
+        applied = like_buffer.flush(batch_size)
+        if applied is None:
+            if not quiet:
+                self.stdout.write(self.style.WARNING('⚠️  Another process is flushing likes; try again shortly'))
+        elif applied or not quiet:
+            self.stdout.write(f'  ✓ Applied {applied} like events')
@@ -0,0 +1,57 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from blog import archive
+
+
+class Command(BaseCommand):
+    help = 'Load an NDJSON archive written by export_blog, resuming an interrupted import'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='Archive to read, e.g. blog.ndjson.gz')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=archive.CHUNK_SIZE,
+            help=f'Records per bulk_create and transaction (default: {archive.CHUNK_SIZE})',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Progress file for resuming (default: <input>.checkpoint)',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore an existing checkpoint and import from the first line',
+        )
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['input']):
+            raise CommandError(f"No archive at {options['input']}")
+        checkpoint = options['checkpoint'] or f"{options['input']}.checkpoint"
+        if options['restart'] and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        resumed = archive.read_checkpoint(checkpoint)
+        if resumed is not None:
+            self.stdout.write(self.style.SUCCESS(f"📥 Resuming {options['input']} after line {resumed['line']}..."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"📥 Importing {options['input']}..."))
+
+        started = time.perf_counter()
+        importer = archive.Importer(chunk_size=options['chunk_size'])
+
+        def progress(kind, count, line):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'  ✓ {count} {kind} records (line {line})')
+
+        try:
+            with archive.open_archive(options['input']) as file:
+                archive.load(file, importer, checkpoint_path=checkpoint, progress=progress)
+        except archive.ArchiveError as e:
+            raise CommandError(str(e))
+
+        for kind, count in importer.counts.items():
+            if kind != 'meta':
+                self.stdout.write(f'  ✓ {count} {kind} records')
+        self.stdout.write(self.style.SUCCESS(f'✅ Import finished in {time.perf_counter() - started:.1f}s!'))
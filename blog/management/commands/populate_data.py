@@ -1,11 +1,21 @@
 from django.core.management.base import BaseCommand
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
 from blog.models import Genre, Post, UserProfile, Follow, PostLike, Comment
+from blog.counters import recount_posts
+from blog import card_cache, datagen, genres as genre_registry, page_cache, search, timeline
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from faker import Faker
+import numpy as np
+import os
 import random
+import time
 from django.utils import timezone
-from datetime import timedelta, datetime
-import pytz
+from django.utils.text import slugify
+from datetime import timedelta
 
 
 class Command(BaseCommand):
@@ -29,10 +39,52 @@ class Command(BaseCommand):
             action='store_true',
             help='Clear existing data before populating',
         )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            help='Random seed, for the same dataset on every run',
+        )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Generate rows in chunks with bulk_create, for datasets of millions of rows',
+        )
+        parser.add_argument(
+            '--likes',
+            type=int,
+            help='Post likes to create in bulk mode (default: 10 per article)',
+        )
+        parser.add_argument(
+            '--follows',
+            type=int,
+            help='Follows to create in bulk mode (default: 20 per user)',
+        )
+        parser.add_argument(
+            '--comments',
+            type=int,
+            help='Comments to create in bulk mode (default: 2 per article)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='Rows per bulk_create in bulk mode (default: 5000)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Processes generating text in bulk mode; 1 generates in this process (default: CPU count)',
+        )
 
     def handle(self, *args, **options):
         self.fake = Faker()
+        if options.get('seed') is not None:
+            random.seed(options['seed'])
+            self.fake.seed_instance(options['seed'])
         self.stdout.write(self.style.SUCCESS('🌱 Starting data population...'))
+        # Hashing is deliberately slow, so every sample user shares one hash
+        self.password = make_password('test')
 
         if options['clear']:
             self.clear_existing_data()
@@ -40,6 +92,10 @@ class Command(BaseCommand):
         # Ensure genres exist
         self.create_genres()
 
+        if options['bulk']:
+            self.bulk_populate(options)
+            return
+
         # Create users
         users = self.create_users(options['users'])
 
@@ -140,7 +196,7 @@ class Command(BaseCommand):
                     'first_name': first_name,
                     'last_name': last_name,
                     'email': email,
-                    'password': 'pbkdf2_sha256$600000$test$test',  # Password: 'test'
+                    'password': self.password,
                     'is_active': True,
                     'date_joined': timezone.make_aware(self.fake.date_time_between(start_date='-2y', end_date='now')),
                 }
@@ -148,18 +204,11 @@ class Command(BaseCommand):
 
             if created:
                 # Create user profile
-                bio_templates = [
-                    f"Passionate {profession.lower()} sharing insights and experiences.",
-                    f"Welcome to my corner of the internet! I'm a {profession.lower()} who loves to write.",
-                    f"{profession} by day, writer by passion. Sharing stories that matter.",
-                    f"Experienced {profession.lower()} with a love for storytelling.",
-                    f"Join me as I explore life as a {profession.lower()} and share my journey.",
-                ]
 
                 profile, _ = UserProfile.objects.get_or_create(
                     user=user,
                     defaults={
-                        'bio': random.choice(bio_templates),
+                        'bio': datagen.bio(random, profession),
                         'location': self.fake.city(),
                         'website': f"https://{username}.com" if random.choice([True, False]) else "",
                         'dark_mode': random.choice([True, False]),
@@ -183,80 +232,22 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR('No genres found! Please run setup_blog command first.'))
             return
 
-        # Article templates for different genres
-        article_templates = {
-            'Technology': [
-                ('The Future of Artificial Intelligence', 'Exploring how AI is revolutionizing industries and changing the way we work and live.'),
-                ('Cybersecurity in 2026', 'Essential security practices every internet user should know to protect their digital life.'),
-                ('The Rise of Quantum Computing', 'Understanding quantum technology and its potential impact on computing.'),
-                ('Sustainable Tech Solutions', 'How technology companies are going green and reducing their environmental footprint.'),
-                ('5G and Beyond: The Next Generation', 'Examining the latest developments in telecommunications technology.'),
-            ],
-            'Health & Wellness': [
-                ('Mental Health in the Digital Age', 'Strategies for maintaining mental wellness while staying connected.'),
-                ('The Science of Sleep', 'Understanding sleep cycles and how to improve your rest quality.'),
-                ('Nutrition Myths Debunked', 'Separating fact from fiction in popular diet trends.'),
-                ('Exercise for Busy Professionals', 'Simple workout routines that fit into a hectic schedule.'),
-                ('Mindfulness and Meditation', 'Practical approaches to reducing stress and finding inner peace.'),
-            ],
-            'Travel': [
-                ('Hidden Gems of Southeast Asia', 'Discovering off-the-beaten-path destinations for the adventurous traveler.'),
-                ('Solo Travel Safety Tips', 'Essential advice for traveling alone with confidence.'),
-                ('Budget Travel Hacks', 'How to see the world without breaking the bank.'),
-                ('Cultural Etiquette Around the World', 'Avoiding common cultural mistakes when traveling abroad.'),
-                ('Sustainable Tourism Practices', 'How to travel responsibly and protect the places we visit.'),
-            ],
-            'Food & Cooking': [
-                ('Farm-to-Table Movement', 'Exploring the benefits of locally sourced ingredients.'),
-                ('International Street Food Guide', 'A culinary journey through global street food cultures.'),
-                ('Plant-Based Cooking for Beginners', 'Simple and delicious recipes for a healthier lifestyle.'),
-                ('The Art of Fermentation', 'Traditional fermentation techniques and their health benefits.'),
-                ('Seasonal Cooking Tips', 'Making the most of fresh, seasonal ingredients.'),
-            ],
-            'Business & Finance': [
-                ('Personal Finance in Your 20s', 'Building a strong financial foundation early in life.'),
-                ('The Gig Economy Revolution', 'Understanding the changing landscape of work and employment.'),
-                ('Investing for Beginners', 'Simple strategies for growing your wealth over time.'),
-                ('Remote Work Best Practices', 'Maximizing productivity while working from home.'),
-                ('Cryptocurrency Explained', 'A beginner\'s guide to digital currencies and blockchain technology.'),
-            ],
-        }
-
-        # Generate additional generic templates for other genres
-        generic_templates = [
-            ('Lessons Learned', 'Reflecting on important life experiences and the wisdom they provide.'),
-            ('Breaking Down Barriers', 'Overcoming challenges and obstacles in pursuit of our goals.'),
-            ('The Power of Community', 'How building connections can transform our lives and society.'),
-            ('Finding Your Voice', 'Discovering your unique perspective and sharing it with the world.'),
-            ('Innovation and Creativity', 'Exploring new ideas and thinking outside the box.'),
-        ]
-
         created_articles = 0
+        used_slugs = set(Post.objects.values_list('slug', flat=True))
 
         for i in range(count):
             # Select random author and genre
             author = random.choice(users)
             genre = random.choice(genres)
 
-            # Get article template
-            if genre.name in article_templates:
-                template = random.choice(article_templates[genre.name])
-            else:
-                template = random.choice(generic_templates)
-
-            title_base, content_base = template
-
-            # Add variation to avoid duplicates
-            title = f"{title_base}: A {random.choice(['Personal', 'Professional', 'Deep', 'Comprehensive', 'Practical'])} Perspective"
-
-            # Generate comprehensive content
-            content_parts = [
-                content_base,
-                "\n\n" + self.fake.text(max_nb_chars=800),
-                "\n\n" + self.fake.text(max_nb_chars=600),
-                "\n\n" + "What are your thoughts on this topic? I'd love to hear your experiences in the comments below!",
-            ]
-            content = "".join(content_parts)
+            title, content = datagen.article(random, self.fake, genre.name)
+            # Templates repeat, so number the slugs of repeated titles
+            slug = base_slug = slugify(title)
+            suffix = 1
+            while slug in used_slugs:
+                suffix += 1
+                slug = f"{base_slug}-{suffix}"
+            used_slugs.add(slug)
 
             # Create the post with varied creation dates
             creation_date = timezone.make_aware(self.fake.date_time_between(
@@ -267,6 +258,7 @@ class Command(BaseCommand):
             try:
                 post = Post.objects.create(
                     title=title,
+                    slug=slug,
                     content=content,
                     author=author,
                     genre=genre,
@@ -323,18 +315,6 @@ class Command(BaseCommand):
 
         # Create comments
         comment_count = 0
-        comment_templates = [
-            "Great article! Thanks for sharing your insights.",
-            "This really resonates with me. I had a similar experience.",
-            "Interesting perspective! I never thought about it that way.",
-            "Thanks for the detailed explanation. Very helpful!",
-            "I disagree with some points, but appreciate the discussion.",
-            "Could you elaborate more on this topic?",
-            "This is exactly what I needed to read today.",
-            "Fantastic writing! Looking forward to more posts.",
-            "I learned something new. Thank you for this!",
-            "Well researched and thoughtfully written.",
-        ]
 
         for post in random.sample(posts, k=min(30, len(posts))):  # Add comments to 30 random posts
             # Each selected post gets 1-5 comments
@@ -345,7 +325,7 @@ class Command(BaseCommand):
                 comment = Comment.objects.create(
                     post=post,
                     author=commenter,
-                    content=random.choice(comment_templates),
+                    content=random.choice(datagen.COMMENT_TEMPLATES),
                     created_at=post.created_at + timedelta(
                         hours=random.randint(1, 168)  # Comments within a week of post
                     )
@@ -354,4 +334,176 @@ class Command(BaseCommand):
 
         self.stdout.write(f'  ✓ Created {follow_count} follow relationships')
         self.stdout.write(f'  ✓ Created {like_count} post likes')
-        self.stdout.write(f'  ✓ Created {comment_count} comments')
\ No newline at end of file
+        self.stdout.write(f'  ✓ Created {comment_count} comments')
+
+    def bulk_populate(self, options):
+        """Create users, articles and power-law distributed interactions in chunks"""
+        started = time.perf_counter()
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        self.stdout.write(f'⚡ Bulk mode (seed {seed}, {options["chunk_size"]} rows per chunk, {options["workers"]} workers)')
+        rng = np.random.default_rng(seed)
+        chunk_size = options['chunk_size']
+
+        self.workers = options['workers']
+        pool = ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            user_ids = self.bulk_create_users(pool, options, seed)
+            post_ids, post_authors = self.bulk_create_articles(pool, options, seed, rng, user_ids)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        # Few users are followed, liked and active a lot; most hardly at all
+        activity = datagen.power_law_weights(len(user_ids), rng)
+        popularity = datagen.power_law_weights(len(user_ids), rng)
+        post_popularity = datagen.power_law_weights(len(post_ids), rng)
+
+        follows = options['follows'] if options['follows'] is not None else 20 * len(user_ids)
+        self.stdout.write(f'🤝 Creating up to {follows} follows...')
+        followers, followed = datagen.sample_pairs(rng, follows, activity, popularity, exclude=lambda a, b: a == b)
+        self.bulk_insert(
+            Follow, lambda follower_id, following_id: Follow(follower_id=follower_id, following_id=following_id),
+            chunk_size, user_ids[followers], user_ids[followed],
+        )
+
+        likes = options['likes'] if options['likes'] is not None else 10 * len(post_ids)
+        self.stdout.write(f'❤️  Creating up to {likes} post likes...')
+        likers, liked = datagen.sample_pairs(
+            rng, likes, activity, post_popularity,
+            exclude=lambda users, posts: user_ids[users] == post_authors[posts],
+        )
+        self.bulk_insert(
+            PostLike, lambda user_id, post_id: PostLike(user_id=user_id, post_id=post_id),
+            chunk_size, user_ids[likers], post_ids[liked],
+        )
+
+        comments = options['comments'] if options['comments'] is not None else 2 * len(post_ids)
+        self.stdout.write(f'💬 Creating {comments} comments...')
+        self.bulk_create_comments(rng, comments, activity, post_popularity, user_ids, post_ids, chunk_size)
+
+        self.stdout.write('🔁 Rebuilding counters, timelines and caches...')
+        for start in range(0, len(post_ids), chunk_size):
+            with transaction.atomic():
+                recount_posts(post_ids[start:start + chunk_size].tolist())
+        timeline.refresh_fanout_modes()
+        timeline.backfill_all()
+        genre_registry.bump()
+        card_cache.bump_generation()
+        page_cache.purge(page_cache.SITE_TAG)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Bulk populated {len(user_ids)} users, {len(post_ids)} articles, {len(followers)} follows, '
+            f'{len(likers)} likes and {comments} comments in {time.perf_counter() - started:.1f}s!'
+        ))
+
+    def generate(self, pool, function, seed, total, chunk_size, *args):
+        """Yield (first row index, rows) per chunk in order, keeping a few chunks in flight"""
+        chunks = [(chunk, start, min(chunk_size, total - start)) for chunk, start in enumerate(range(0, total, chunk_size))]
+        if pool is None:
+            for chunk, start, count in chunks:
+                yield start, function(seed, chunk, count, *args)
+            return
+        pending = deque()
+        for chunk, start, count in chunks:
+            pending.append((start, pool.submit(function, seed, chunk, count, *args)))
+            if len(pending) > 2 * self.workers:
+                start, future = pending.popleft()
+                yield start, future.result()
+        while pending:
+            start, future = pending.popleft()
+            yield start, future.result()
+
+    def bulk_insert(self, model, build, chunk_size, *columns):
+        """Insert one row per position of the id arrays in columns, building only a chunk of instances at a time"""
+        for start in range(0, len(columns[0]), chunk_size):
+            chunk = [column[start:start + chunk_size].tolist() for column in columns]
+            model.objects.bulk_create([build(*values) for values in zip(*chunk)], ignore_conflicts=True)
+
+    def bulk_create_users(self, pool, options, seed):
+        """Create users and their profiles; returns their ids"""
+        count = options['users']
+        self.stdout.write(f'👥 Creating {count} users...')
+        now = timezone.now()
+        # Usernames are numbered past every existing user, so reruns never collide
+        first_number = (User.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        user_ids = []
+        for start, rows in self.generate(pool, datagen.user_rows, seed, count, options['chunk_size']):
+            users = []
+            profiles = []
+            for number, (first_name, last_name, bio, location, has_website, dark_mode, joined) in enumerate(rows, first_number + start):
+                username = slugify(f'{first_name} {last_name}').replace('-', '_') + f'_{number}'
+                users.append(User(
+                    username=username, first_name=first_name, last_name=last_name,
+                    email=f'{username}@example.com', password=self.password,
+                    date_joined=now - timedelta(seconds=joined),
+                ))
+                profiles.append(UserProfile(
+                    bio=bio, location=location, dark_mode=dark_mode,
+                    website=f'https://{username}.com' if has_website else '',
+                ))
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                for user, profile in zip(users, profiles):
+                    profile.user_id = user.pk
+                UserProfile.objects.bulk_create(profiles)
+            user_ids.extend(user.pk for user in users)
+            self.stdout.write(f'  ✓ {len(user_ids)} users')
+        return np.array(user_ids)
+
+    def bulk_create_articles(self, pool, options, seed, rng, user_ids):
+        """Create articles with their search documents; returns their ids and author ids"""
+        count = options['articles']
+        self.stdout.write(f'📝 Creating {count} articles...')
+        genres = list(Genre.objects.order_by('pk'))
+        genre_names = [genre.name for genre in genres]
+        now = timezone.now()
+        first_number = (Post.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        authors = user_ids[rng.integers(len(user_ids), size=count)]
+        edits = rng.integers(0, 48 * 60 * 60, size=count)
+        post_ids = []
+        for start, rows in self.generate(pool, datagen.post_rows, seed, count, options['chunk_size'], genre_names):
+            posts = []
+            dates = []
+            for number, (genre_index, title, content, age) in enumerate(rows, first_number + start):
+                created_at = now - timedelta(seconds=age)
+                dates.append((created_at, created_at + timedelta(seconds=int(edits[number - first_number]))))
+                posts.append(Post(
+                    title=title,
+                    # Numbered past every existing post, so never taken
+                    slug=f'{slugify(title)[:180]}-{number}',
+                    content=content,
+                    excerpt=content[:200] + '...' if len(content) > 200 else content,
+                    author_id=int(authors[number - first_number]),
+                    genre=genres[genre_index],
+                    is_published=True,
+                ))
+            with transaction.atomic():
+                Post.objects.bulk_create(posts)
+                # bulk_create stamps auto_now_add fields with the current time
+                for post, (created_at, updated_at) in zip(posts, dates):
+                    post.created_at, post.updated_at = created_at, updated_at
+                Post.objects.bulk_update(posts, ['created_at', 'updated_at'])
+                search.index_posts([post.pk for post in posts])
+            post_ids.extend(post.pk for post in posts)
+            self.stdout.write(f'  ✓ {len(post_ids)} articles')
+        return np.array(post_ids), authors
+
+    def bulk_create_comments(self, rng, count, activity, post_popularity, user_ids, post_ids, chunk_size):
+        """Create top-level comments, most of them on the most popular posts"""
+        authors = user_ids[rng.choice(len(user_ids), size=count, p=activity)].tolist()
+        posts = post_ids[rng.choice(len(post_ids), size=count, p=post_popularity)].tolist()
+        contents = rng.choice(len(datagen.COMMENT_TEMPLATES), size=count).tolist()
+        for start in range(0, count, chunk_size):
+            comments = [
+                Comment(post_id=post_id, author_id=author_id, content=datagen.COMMENT_TEMPLATES[content])
+                for post_id, author_id, content in zip(
+                    posts[start:start + chunk_size], authors[start:start + chunk_size], contents[start:start + chunk_size]
+                )
+            ]
+            with transaction.atomic():
+                Comment.objects.bulk_create(comments)
+                # Comment.save() normally derives the thread path from the new id
+                for comment in comments:
+                    comment.path = Comment.path_segment(comment.pk)
+                    comment.depth = 0
+                Comment.objects.bulk_update(comments, ['path', 'depth'])
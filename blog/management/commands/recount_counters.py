@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from blog.models import Post, Comment
+from blog.counters import recount_posts, recount_comments
+
+
+class Command(BaseCommand):
+    help = 'Repair drift in the denormalized like/comment counters on posts and comments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of rows checked per transaction (default: 1000)',
+        )
+        parser.add_argument(
+            '--model',
+            choices=['post', 'comment', 'all'],
+            default='all',
+            help='Which counters to repair (default: all)',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        self.stdout.write(self.style.SUCCESS('🔢 Recounting counters...'))
+
+        if options['model'] in ('post', 'all'):
+            fixed = self.recount_in_chunks(Post, recount_posts, chunk_size)
+            self.stdout.write(f'  ✓ Posts: repaired {fixed} drifted rows')
+
+        if options['model'] in ('comment', 'all'):
+            fixed = self.recount_in_chunks(Comment, recount_comments, chunk_size)
+            self.stdout.write(f'  ✓ Comments: repaired {fixed} drifted rows')
+
+        self.stdout.write(self.style.SUCCESS('✅ Counters are up to date!'))
+
+    def recount_in_chunks(self, model, recount, chunk_size):
+        """Walk the table in primary key order, one short transaction per chunk"""
+        fixed = 0
+        last_pk = 0
+        while True:
+            ids = list(
+                model.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:chunk_size]
+            )
+            if not ids:
+                return fixed
+            with transaction.atomic():
+                fixed += recount(ids)
+            last_pk = ids[-1]
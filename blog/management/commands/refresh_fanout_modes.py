@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from blog import timeline
+
+
+class Command(BaseCommand):
+    help = 'Switch authors between fan-out-on-write and fan-out-on-read feeds by follower count'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=None,
+            help='Keep running, refreshing every this many seconds (default: refresh once)',
+        )
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            self.refresh()
+            return
+        self.stdout.write(self.style.SUCCESS(f'🔁 Refreshing feed fan-out modes every {interval} s (Ctrl+C to stop)...'))
+        try:
+            while True:
+                started = time.monotonic()
+                self.refresh(quiet=True)
+                time.sleep(max(interval - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('✅ Stopped'))
+
+    def refresh(self, quiet=False):
+        to_read, to_write = timeline.refresh_fanout_modes()
+        if to_read or to_write or not quiet:
+            self.stdout.write(f'  ✓ {to_read} authors switched to fan-out-on-read, {to_write} back to fan-out-on-write')
@@ -0,0 +1,369 @@
+"""
+Request metrics in the Prometheus text format, aggregated across workers.
+
+MetricsMiddleware measures every request and labels it with its URL name
+(``view``, e.g. ``blog:like_post``):
+
+- request count by method and status,
+- latency and response size histograms,
+- database queries and the time spent in them,
+- template render time,
+- and reads from the default cache, split into hits and misses.
+
+Each worker process keeps its own totals in memory. At most every
+``METRICS_FLUSH_INTERVAL`` seconds it writes them to a file of its own in
+``METRICS_DIR``, which must be shared by every worker on the host. The
+``blog:metrics`` view (``/metrics``) adds up those files. Files of exited
+workers are merged into one archive file, so counters never go backwards
+while gunicorn recycles workers. Clear the directory on deploy, as with
+prometheus_client's multiprocess mode.
+
+The endpoint is for staff, or for a scraper sending
+``Authorization: Bearer <METRICS_TOKEN>``. Measuring is off unless
+``METRICS_ENABLED`` is set.
+"""
+import atexit
+import functools
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the development server runs a single process
+    fcntl = None
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.urls import Resolver404, resolve
+
+ENABLED = getattr(settings, 'METRICS_ENABLED', False)
+DIRECTORY = Path(getattr(settings, 'METRICS_DIR', Path(settings.BASE_DIR) / '.cache' / 'metrics'))
+FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+TOKEN = getattr(settings, 'METRICS_TOKEN', '')
+
+PREFIX = 'tori'
+ARCHIVE = 'archive.json'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+UNRESOLVED = '<unresolved>'
+
+# name: (type, help, buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by URL name, method and status', None),
+    'http_request_duration_seconds': ('histogram', 'Request latency', LATENCY_BUCKETS),
+    'http_response_size_bytes': ('histogram', 'Response body size', SIZE_BUCKETS),
+    'db_queries_total': ('counter', 'Database statements run', None),
+    'db_query_duration_seconds_total': ('counter', 'Time spent in database statements', None),
+    'template_render_seconds_total': ('counter', 'Time spent rendering templates', None),
+    'cache_reads_total': ('counter', 'Default cache reads by result', None),
+}
+
+_local = threading.local()
+
+
+class Registry:
+    """
+    One process's metric totals, keyed by name and label values
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+        self.pid = None
+        self.flushed_at = 0.0
+
+    @property
+    def path(self):
+        """
+        This process's file; a worker forked from a preloaded master gets its own
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._path = DIRECTORY / f'worker-{self.pid}-{uuid.uuid4().hex[:8]}.json'
+        return self._path
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self.counters[name, labels] += amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        with self._lock:
+            totals = self.histograms.setdefault((name, labels), [0] * (len(buckets) + 1) + [0.0])
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                index = len(buckets)
+            totals[index] += 1
+            totals[-1] += value
+
+    def dump(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), totals] for (name, labels), totals in self.histograms.items()],
+            }
+
+    def flush(self, force=False):
+        """
+        Write this process's totals to its file, at most every FLUSH_INTERVAL seconds
+        """
+        now = time.monotonic()
+        if not force and now - self.flushed_at < FLUSH_INTERVAL:
+            return
+        self.flushed_at = now
+        _write_json(self.path, self.dump())
+
+
+registry = Registry()
+
+
+def _write_json(path, data):
+    DIRECTORY.mkdir(parents=True, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=DIRECTORY, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(totals, data):
+    counters, histograms = totals
+    for name, labels, value in data['counters']:
+        counters[name, tuple(labels)] += value
+    for name, labels, values in data['histograms']:
+        merged = histograms.setdefault((name, tuple(labels)), [0] * len(values))
+        for index, value in enumerate(values):
+            merged[index] += value
+
+
+def _is_running(path):
+    pid = int(path.name.split('-')[1])
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _directory_lock():
+    DIRECTORY.mkdir(parents=True, exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+    with open(DIRECTORY / '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def collect():
+    """
+    Totals of every worker on this host: ``(counters, histograms)``
+    """
+    registry.flush(force=True)
+    totals = (defaultdict(float), {})
+    with _directory_lock():
+        archive = _read_json(DIRECTORY / ARCHIVE) or {'counters': [], 'histograms': []}
+        dead = [path for path in DIRECTORY.glob('worker-*.json') if not _is_running(path)]
+        for path in dead:
+            data = _read_json(path)
+            if data is not None:
+                _merge(totals, data)
+        if dead:
+            # Fold exited workers into the archive, so their files can go
+            _merge(totals, archive)
+            archive = {
+                'counters': [[name, list(labels), value] for (name, labels), value in totals[0].items()],
+                'histograms': [[name, list(labels), values] for (name, labels), values in totals[1].items()],
+            }
+            _write_json(DIRECTORY / ARCHIVE, archive)
+            for path in dead:
+                path.unlink(missing_ok=True)
+            totals = (defaultdict(float), {})
+        _merge(totals, archive)
+        for path in DIRECTORY.glob('worker-*.json'):
+            data = _read_json(path)
+            if data is not None:
+                _merge(totals, data)
+    return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+LABEL_NAMES = {
+    'http_requests_total': ('view', 'method', 'status'),
+    'cache_reads_total': ('view', 'result'),
+}
+
+
+def render():
+    """
+    Every metric in the Prometheus text exposition format
+    """
+    counters, histograms = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        full_name = f'{PREFIX}_{name}'
+        label_names = LABEL_NAMES.get(name, ('view',))
+        lines.append(f'# HELP {full_name} {help_text}')
+        lines.append(f'# TYPE {full_name} {kind}')
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{full_name}{_labels(label_names, labels)} {_number(value)}')
+            continue
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, values):
+                cumulative += count
+                lines.append(f'{full_name}_bucket{_labels(label_names, labels, le=_number(bound))} {_number(cumulative)}')
+            cumulative += values[len(buckets)]
+            lines.append(f'{full_name}_bucket{_labels(label_names, labels, le="+Inf")} {_number(cumulative)}')
+            lines.append(f'{full_name}_sum{_labels(label_names, labels)} {_number(values[-1])}')
+            lines.append(f'{full_name}_count{_labels(label_names, labels)} {_number(cumulative)}')
+    return '\n'.join(lines) + '\n'
+
+
+def is_authorized(request):
+    if TOKEN:
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(credentials.encode(), TOKEN.encode()):
+            return True
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_active and user.is_staff
+
+
+class Sample:
+    """
+    What one request spent its time on; also the execute wrapper counting its queries
+    """
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+        self.rendering = False
+        self.seconds = 0.0
+        self.cache_hits = self.cache_misses = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - started
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        # Responses served by middleware (e.g. the page cache) never reach the resolver
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return UNRESOLVED
+    return match.view_name
+
+
+def record(request, response, sample):
+    view = view_name(request)
+    registry.inc('http_requests_total', (view, request.method, str(response.status_code)))
+    registry.observe('http_request_duration_seconds', (view,), sample.seconds)
+    if not response.streaming:
+        registry.observe('http_response_size_bytes', (view,), len(response.content))
+    registry.inc('db_queries_total', (view,), sample.queries)
+    registry.inc('db_query_duration_seconds_total', (view,), sample.query_seconds)
+    registry.inc('template_render_seconds_total', (view,), sample.template_seconds)
+    registry.inc('cache_reads_total', (view, 'hit'), sample.cache_hits)
+    registry.inc('cache_reads_total', (view, 'miss'), sample.cache_misses)
+    registry.flush()
+
+
+def _cache_reads():
+    return cache.thread_reads() if hasattr(cache, 'thread_reads') else (0, 0)
+
+
+@contextmanager
+def measuring(sample):
+    """
+    Measure the enclosed request handling into sample
+    """
+    _local.sample = sample
+    hits, misses = _cache_reads()
+    started = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(sample))
+            yield sample
+    finally:
+        sample.seconds = time.perf_counter() - started
+        hits_after, misses_after = _cache_reads()
+        sample.cache_hits, sample.cache_misses = hits_after - hits, misses_after - misses
+        _local.sample = None
+
+
+def install():
+    """
+    Time template rendering: the outermost render of each request, so
+    nested render_to_string calls aren't counted twice
+    """
+    from django.template.backends.django import Template
+
+    render_template = Template.render
+    if getattr(render_template, 'timed', False):
+        return
+
+    @functools.wraps(render_template)
+    def timed_render(self, context=None, request=None):
+        sample = getattr(_local, 'sample', None)
+        if sample is None or sample.rendering:
+            return render_template(self, context, request)
+        sample.rendering = True
+        started = time.perf_counter()
+        try:
+            return render_template(self, context, request)
+        finally:
+            sample.rendering = False
+            sample.template_seconds += time.perf_counter() - started
+
+    timed_render.timed = True
+    Template.render = timed_render
+    atexit.register(registry.flush, force=True)
@@ -0,0 +1,94 @@
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.functional import SimpleLazyObject
+
+from . import conditional, metrics, page_cache, query_budget, viewer_state
+
+
+class AnonymousPageCacheMiddleware:
+    """
+    Serve anonymous GET requests for cacheable pages from blog.page_cache.
+
+    Sits above the session, auth and messages middleware, so a cache hit
+    skips them (and the database) entirely.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not page_cache.is_cacheable(request):
+            return self.get_response(request)
+
+        response, from_cache = page_cache.fetch(request, self.get_response)
+        return conditional.respond(request, response) if from_cache else response
+
+
+class ViewerSnapshotMiddleware:
+    """
+    Resolve ``request.user`` from the session's viewer snapshot.
+
+    Must come right after AuthenticationMiddleware, whose lazy user it
+    replaces; see blog.viewer_state.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.user = SimpleLazyObject(lambda: viewer_state.get_user(request))
+        return self.get_response(request)
+
+
+class ConditionalPageMiddleware:
+    """
+    Answer revalidations of unchanged pages with 304 Not Modified before
+    the view runs, and set ETag/Last-Modified on pages it renders; see
+    blog.conditional. Must come after ViewerSnapshotMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not conditional.applies(request):
+            return self.get_response(request)
+
+        response = conditional.not_modified(request)
+        if response is not None:
+            return response
+
+        conditional.start(request)
+        response = self.get_response(request)
+        conditional.finish(request, response)
+        return response
+
+
+class QueryBudgetMiddleware:
+    """
+    Report requests over their query budget or with N+1 queries; see
+    blog.query_budget. Only active with QUERY_BUDGET_ENABLED (default: DEBUG).
+    """
+    def __init__(self, get_response):
+        if not query_budget.ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with query_budget.recording(query_budget.QueryRecorder()) as recorder:
+            response = self.get_response(request)
+        query_budget.report(request, response, recorder)
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Record latency, queries, render time, cache reads and response size
+    per URL name for the /metrics endpoint; see blog.metrics
+    """
+    def __init__(self, get_response):
+        if not metrics.ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with metrics.measuring(metrics.Sample()) as sample:
+            response = self.get_response(request)
+        metrics.record(request, response, sample)
+        return response
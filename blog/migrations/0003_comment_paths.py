@@ -0,0 +1,47 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:23
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils.http import int_to_base36
+
+PATH_STEP = 8
+
+
+def backfill_paths(apps, schema_editor):
+    Comment = apps.get_model('blog', 'Comment')
+    post_ids = Comment.objects.order_by().values_list('post_id', flat=True).distinct()
+    for post_id in post_ids.iterator():
+        # Parents are always inserted before their replies, so id order is safe
+        thread = list(Comment.objects.filter(post_id=post_id).order_by('pk').only('pk', 'parent_id'))
+        paths = {}
+        for comment in thread:
+            comment.path = paths.get(comment.parent_id, '') + int_to_base36(comment.pk).rjust(PATH_STEP, '0')
+            comment.depth = len(comment.path) // PATH_STEP - 1
+            paths[comment.pk] = comment.path
+        Comment.objects.bulk_update(thread, ['path', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0002_denormalized_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, editable=False, max_length=400),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='blog_comment_thread_idx'),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BACKFILL = 50
+
+
+def backfill_timelines(apps, schema_editor):
+    Follow = apps.get_model('blog', 'Follow')
+    Post = apps.get_model('blog', 'Post')
+    TimelineEntry = apps.get_model('blog', 'TimelineEntry')
+    author_ids = Follow.objects.order_by().values_list('following_id', flat=True).distinct()
+    for author_id in author_ids.iterator():
+        recent = list(
+            Post.objects.filter(author_id=author_id, is_published=True)
+            .order_by('-created_at', '-id')
+            .values_list('id', 'created_at')[:BACKFILL]
+        )
+        if not recent:
+            continue
+        follower_ids = Follow.objects.filter(following_id=author_id).values_list('follower_id', flat=True)
+        for follower_id in follower_ids.iterator():
+            TimelineEntry.objects.bulk_create(
+                [
+                    TimelineEntry(user_id=follower_id, post_id=post_id, author_id=author_id, created_at=created_at)
+                    for post_id, created_at in recent
+                ],
+                ignore_conflicts=True,
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0003_comment_paths'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='fanout_on_read',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to='blog.post')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-created_at', '-post'], name='blog_timeline_feed_idx'), models.Index(fields=['user', 'author'], name='blog_timeline_author_idx')],
+                'unique_together': {('user', 'post')},
+            },
+        ),
+        migrations.RunPython(backfill_timelines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+POSTGRESQL_DOCUMENT = (
+    "setweight(to_tsvector('english', p.title), 'A') || "
+    "setweight(to_tsvector('english', p.content), 'B')"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE blog_postsearch USING fts5(title, content, tokenize='porter unicode61')"
+        )
+        schema_editor.execute(
+            'INSERT INTO blog_postsearch (rowid, title, content) SELECT id, title, content FROM blog_post'
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE blog_postsearch ('
+            'post_id bigint PRIMARY KEY REFERENCES blog_post (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+            'document tsvector NOT NULL)'
+        )
+        schema_editor.execute('CREATE INDEX blog_postsearch_document_idx ON blog_postsearch USING GIN (document)')
+        schema_editor.execute(
+            f'INSERT INTO blog_postsearch (post_id, document) SELECT p.id, {POSTGRESQL_DOCUMENT} FROM blog_post p'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE IF EXISTS blog_postsearch')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0005_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_related_posts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LikeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('post', 'Post'), ('comment', 'Comment')], max_length=7)),
+                ('target_id', models.PositiveBigIntegerField()),
+                ('liked', models.BooleanField()),
+                ('delta', models.SmallIntegerField()),
+                ('previous_id', models.PositiveBigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['kind', 'target_id'], name='blog_likeevent_target_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'kind', 'target_id', 'previous_id'), name='blog_likeevent_sequence_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def create_search_vocabulary(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        # Indexed (stemmed) terms, for expanding search prefixes (see blog/search.py)
+        schema_editor.execute("CREATE VIRTUAL TABLE blog_postsearch_vocab USING fts5vocab(blog_postsearch, 'row')")
+
+
+def drop_search_vocabulary(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS blog_postsearch_vocab')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0010_lock'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_vocabulary, drop_search_vocabulary),
+    ]
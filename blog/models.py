@@ -1,10 +1,31 @@
+from functools import cached_property
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.http import int_to_base36
 from django.utils.text import slugify
 
 
+def _exclude_counter_fields(instance, save_kwargs):
+    """
+    Keep a plain save() of an existing row from writing back stale counters.
+
+    Counters are only ever changed with F() updates, so an edit form that
+    loaded the row before a concurrent like must not overwrite them. The
+    same goes for fields kept up to date by background jobs
+    (``BACKGROUND_FIELDS``).
+    """
+    if instance._state.adding or save_kwargs.get('force_insert') or save_kwargs.get('update_fields') is not None:
+        return
+    skipped = (*instance.COUNTER_FIELDS, *getattr(instance, 'BACKGROUND_FIELDS', ()))
+    save_kwargs['update_fields'] = [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in skipped
+    ]
+
+
 class Genre(models.Model):
     """
     Blog post genres/categories
@@ -43,9 +64,35 @@ class Post(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_published = models.BooleanField(default=True)
     featured_image = models.ImageField(upload_to='post_images/', blank=True, null=True)
+    # Resized WebP/JPEG copies of featured_image, rendered after upload (see blog.images)
+    featured_image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    # Denormalized counters, maintained by blog.signals with atomic F() updates
+    likes_count = models.PositiveIntegerField(default=0, editable=False)
+    comments_count = models.PositiveIntegerField(default=0, editable=False, help_text="Top-level comments only")
+
+    # When blog.related last computed this post's neighbours; older than updated_at means stale
+    related_built_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    COUNTER_FIELDS = ('likes_count', 'comments_count')
+    BACKGROUND_FIELDS = ('related_built_at',)
 
     class Meta:
         ordering = ['-created_at']
+        # Every public list filters on is_published and pages by (created_at, id)
+        indexes = [
+            models.Index(
+                fields=['-created_at', '-id'], name='blog_post_published_idx',
+                condition=models.Q(is_published=True),
+            ),
+            models.Index(
+                fields=['genre', '-created_at', '-id'], name='blog_post_genre_idx',
+                condition=models.Q(is_published=True),
+            ),
+            models.Index(
+                fields=['author', '-created_at', '-id'], name='blog_post_author_idx',
+                condition=models.Q(is_published=True),
+            ),
+        ]
 
     def __str__(self):
         return self.title
@@ -56,19 +103,12 @@ class Post(models.Model):
         if not self.excerpt and self.content:
             # Auto-generate excerpt from content (first 200 chars)
             self.excerpt = self.content[:200] + '...' if len(self.content) > 200 else self.content
+        _exclude_counter_fields(self, kwargs)
         super().save(*args, **kwargs)
 
     def get_absolute_url(self):
         return reverse('blog:post_detail', kwargs={'slug': self.slug})
 
-    @property
-    def likes_count(self):
-        return self.likes.count()
-
-    @property
-    def comments_count(self):
-        return self.comments.filter(parent=None).count()
-
     def is_liked_by(self, user):
         if user.is_authenticated:
             return self.likes.filter(user=user).exists()
@@ -85,6 +125,10 @@ class Follow(models.Model):
 
     class Meta:
         unique_together = ('follower', 'following')
+        indexes = [
+            models.Index(fields=['following', 'created_at'], name='blog_follow_followers_idx'),
+            models.Index(fields=['follower', 'created_at'], name='blog_follow_following_idx'),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=~models.Q(follower=models.F('following')),
@@ -121,16 +165,45 @@ class Comment(models.Model):
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='replies')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Denormalized counter, maintained by blog.signals with atomic F() updates
+    likes_count = models.PositiveIntegerField(default=0, editable=False)
+    # Materialized path: one fixed-width base36 segment per ancestor, then our own id.
+    # Ordering a post's comments by path yields the whole thread depth-first.
+    path = models.CharField(max_length=400, blank=True, editable=False)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ('likes_count',)
+    PATH_STEP = 8
+    MAX_DEPTH = 400 // PATH_STEP
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['post', 'path'], name='blog_comment_thread_idx'),
+            models.Index(fields=['post', 'parent', 'created_at', 'id'], name='blog_comment_roots_idx'),
+        ]
 
     def __str__(self):
         return f'Comment by {self.author.username} on {self.post.title}'
 
-    @property
-    def likes_count(self):
-        return self.likes.count()
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding:
+            # Replies past the deepest level become siblings of their parent
+            while self.parent is not None and self.parent.depth + 1 >= self.MAX_DEPTH:
+                self.parent = self.parent.parent
+        _exclude_counter_fields(self, kwargs)
+        super().save(*args, **kwargs)
+        if adding:
+            # The path ends with our own id, which only exists after the insert
+            prefix = self.parent.path if self.parent is not None else ''
+            self.path = prefix + self.path_segment(self.pk)
+            self.depth = len(self.path) // self.PATH_STEP - 1
+            Comment.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+
+    @classmethod
+    def path_segment(cls, pk):
+        return int_to_base36(pk).rjust(cls.PATH_STEP, '0')
 
     def is_liked_by(self, user):
         if user.is_authenticated:
@@ -156,6 +229,92 @@ class CommentLike(models.Model):
         return f"{self.user.username} likes comment by {self.comment.author.username}"
 
 
+class LikeEvent(models.Model):
+    """
+    A like or unlike waiting to be applied to PostLike/CommentLike (see blog.like_buffer)
+    """
+    POST = 'post'
+    COMMENT = 'comment'
+    KIND_CHOICES = [(POST, 'Post'), (COMMENT, 'Comment')]
+
+    kind = models.CharField(max_length=7, choices=KIND_CHOICES)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    # Post or comment id; targets deleted before the flush are skipped
+    target_id = models.PositiveBigIntegerField()
+    liked = models.BooleanField()
+    # Change to the target's likes_count this event was expected to make
+    delta = models.SmallIntegerField()
+    # The user's latest pending event for the target when this one was recorded (0 for none)
+    previous_id = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['kind', 'target_id'], name='blog_likeevent_target_idx'),
+        ]
+        constraints = [
+            # Two toggles based on the same state can't both be recorded (see blog.like_buffer)
+            models.UniqueConstraint(
+                fields=['user', 'kind', 'target_id', 'previous_id'], name='blog_likeevent_sequence_uniq',
+            ),
+        ]
+
+    def __str__(self):
+        action = 'likes' if self.liked else 'unlikes'
+        return f"{self.user_id} {action} {self.kind} {self.target_id}"
+
+
+class Lock(models.Model):
+    """
+    A named row that processes serialize work on, held for the length of a
+    transaction (see blog.like_buffer)
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    acquired_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class RelatedPost(models.Model):
+    """
+    Precomputed content-similarity neighbours of a post (see blog.related)
+    """
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='related_entries')
+    related = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['rank']
+        unique_together = ('post', 'rank')
+
+    def __str__(self):
+        return f"{self.related.title} is related to {self.post.title}"
+
+
+class TimelineEntry(models.Model):
+    """
+    Materialized following feed: one row per follower for each published post
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries')
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    # Copy of post.created_at so a feed page is a range scan on (user, created_at)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-post'], name='blog_timeline_feed_idx'),
+            models.Index(fields=['user', 'author'], name='blog_timeline_author_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.post.title} in {self.user.username}'s feed"
+
+
 class UserProfile(models.Model):
     """
     Extended user profile model
@@ -163,23 +322,26 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     bio = models.TextField(max_length=500, blank=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    avatar_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     website = models.URLField(blank=True)
     location = models.CharField(max_length=100, blank=True)
     dark_mode = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Authors with very many followers are merged into feeds at read time (see blog.timeline)
+    fanout_on_read = models.BooleanField(default=False, editable=False)
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
-    @property
+    @cached_property
     def followers_count(self):
         return self.user.followers.count()
 
-    @property
+    @cached_property
     def following_count(self):
         return self.user.following.count()
 
-    @property
+    @cached_property
     def posts_count(self):
         return self.user.blog_posts.filter(is_published=True).count()
 
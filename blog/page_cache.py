@@ -0,0 +1,227 @@
+"""
+Full-page cache for anonymous readers, invalidated by dependency tags.
+
+Views tag the pages they render (``home``, ``genre:<slug>``,
+``post:<id>``, ``author:<id>``; every page also depends on ``site``).
+Each tag has a version in the cache: the time it was last purged. A cached
+page stays valid while all of its tags exist and were last purged before
+the page started rendering, so purging a tag lazily expires exactly the
+pages that depend on it, without tracking which pages those are.
+
+Only requests without a session or messages cookie are served from or
+stored in the cache, and responses that set cookies or used the CSRF
+token are never stored, so per-visitor state can't leak between readers.
+Pages are fetched through ``tiered_cache.get_or_compute``, so a missing or
+stale page is rendered by one request at a time.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+
+from . import tiered_cache
+
+CACHE_PREFIX = 'page'
+TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 10)
+URL_NAMES = frozenset(getattr(settings, 'PAGE_CACHE_URL_NAMES', (
+    'blog:home',
+    'blog:genre_posts',
+    'blog:post_detail',
+)))
+SITE_TAG = 'site'
+# How long a page is still served after TIMEOUT while one request re-renders it
+REVALIDATE_TIMEOUT = 30
+MESSAGES_COOKIE_NAME = getattr(settings, 'MESSAGE_COOKIE_NAME', 'messages')
+
+
+def _tag_key(tag):
+    return f'{CACHE_PREFIX}:tag:{tag}'
+
+
+def _page_key(request):
+    digest = hashlib.sha256(request.get_full_path().encode()).hexdigest()
+    return f'{CACHE_PREFIX}:{digest}'
+
+
+def is_cacheable(request):
+    """
+    Whether a request may be answered from, and stored in, the page cache
+    """
+    if request.method != 'GET':
+        return False
+    if settings.SESSION_COOKIE_NAME in request.COOKIES or MESSAGES_COOKIE_NAME in request.COOKIES:
+        return False
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return False
+    return match.view_name in URL_NAMES
+
+
+def tag(request, *tags):
+    """
+    Declare what the page being rendered depends on
+    """
+    tags_seen = getattr(request, '_page_cache_tags', None)
+    if tags_seen is not None:
+        tags_seen.update(tags)
+
+
+def tag_posts(request, posts):
+    """
+    Tag a page with every post (and post author) it shows
+    """
+    for post in posts:
+        tag(request, f'post:{post.pk}', f'author:{post.author_id}')
+
+
+def viewer_tag(user_id):
+    """
+    Tag of what only one signed-in viewer sees: their likes, follows and theme
+    """
+    return f'viewer:{user_id}'
+
+
+def tag_versions(tags):
+    """
+    ``{tag: version}`` for the tags whose version is in the cache
+    """
+    versions = cache.get_many([_tag_key(tag) for tag in tags])
+    return {tag: versions[_tag_key(tag)] for tag in tags if _tag_key(tag) in versions}
+
+
+def is_current(tags, rendered_at):
+    """
+    Whether a document rendered at rendered_at (``time.time_ns()``) is still
+    valid: none of its tags were purged since, or evicted
+    """
+    versions = tag_versions(tags)
+    return len(versions) == len(set(tags)) and max(versions.values(), default=0) <= rendered_at
+
+
+def version_tags(tags, started_at):
+    """
+    Version new (or evicted) tags as of a render that started at started_at:
+    the document is valid, and any older one that may have missed a lost
+    purge is not. Returns ``{tag: version}`` for every tag.
+    """
+    versions = tag_versions(tags)
+    for tag in set(tags) - set(versions):
+        if cache.add(_tag_key(tag), started_at, None):
+            versions[tag] = started_at
+    lost = set(tags) - set(versions)
+    if lost:
+        # Another render or a purge versioned them first
+        versions.update(tag_versions(lost))
+    return versions
+
+
+def purge(*tags):
+    """
+    Expire every cached page carrying any of the tags, once the current
+    transaction commits (so a concurrent render can't cache the old data)
+    """
+    def expire():
+        now = time.time_ns()
+        cache.set_many({_tag_key(tag): now for tag in tags}, None)
+    transaction.on_commit(expire)
+
+
+class _Unshareable(Exception):
+    """
+    A rendered response that must not be stored, even as a marker
+    """
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+
+def _is_current(entry):
+    return is_current(entry['tags'], entry['rendered_at'])
+
+
+def _cached_response(entry, status):
+    response = HttpResponse(entry['content'], status=entry['status'])
+    for header, value in entry['headers']:
+        response[header] = value
+    response['X-Page-Cache'] = status
+    return response
+
+
+def fetch(request, get_response):
+    """
+    ``(response, from_cache)`` for a cacheable request: the cached page, or
+    get_response(request), stored when it is safe to share.
+
+    Goes through ``get_or_compute`` (see blog.tiered_cache): on a cold miss
+    one request renders the page while the others wait for it, and a stale
+    page (one of its tags was purged) is re-rendered by a single request
+    while the others get the stale copy. A page that sets cookies or uses
+    the CSRF token is stored as a marker without content, so later requests
+    render it straight away instead of queueing behind each other.
+    """
+    rendered = []
+    current = []
+
+    def render():
+        start(request)
+        response = get_response(request)
+        rendered.append(response)
+        if response.status_code != 200 or response.streaming:
+            raise _Unshareable(response)
+        return _entry(request, response)
+
+    def is_stale(entry):
+        # A tag whose version was evicted may have been purged since: treat it as stale
+        if _is_current(entry):
+            current.append(True)
+            return False
+        return True
+
+    try:
+        entry = tiered_cache.get_or_compute(
+            _page_key(request), render, timeout=TIMEOUT, stale_timeout=REVALIDATE_TIMEOUT, is_stale=is_stale,
+        )
+    except _Unshareable as unshareable:
+        return unshareable.response, False
+    if rendered:
+        return rendered[0], False
+    if entry['content'] is None:
+        return get_response(request), False
+    return _cached_response(entry, 'HIT' if current else 'STALE'), True
+
+
+def start(request):
+    """
+    Begin collecting tags for a page about to be rendered
+    """
+    request._page_cache_tags = {SITE_TAG}
+    request._page_cache_started_at = time.time_ns()
+
+
+def _entry(request, response):
+    """
+    The cache entry of a freshly rendered page: the response if it is safe
+    to share, else a marker carrying only the page's tags
+    """
+    tags = request._page_cache_tags
+    version_tags(tags, request._page_cache_started_at)
+    entry = {'tags': sorted(tags), 'rendered_at': request._page_cache_started_at, 'content': None}
+    if (
+        response.cookies
+        or request.META.get('CSRF_COOKIE_NEEDS_UPDATE')
+        or 'private' in response.get('Cache-Control', '')
+        or 'no-store' in response.get('Cache-Control', '')
+    ):
+        return entry
+    entry.update(
+        content=response.content,
+        status=response.status_code,
+        headers=[(header, value) for header, value in response.items() if header.lower() != 'set-cookie'],
+    )
+    response['X-Page-Cache'] = 'MISS'
+    return entry
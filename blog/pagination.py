@@ -0,0 +1,158 @@
+import base64
+import binascii
+import heapq
+import json
+from datetime import datetime
+
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(*values):
+    """
+    Pack keyset values into an opaque, URL-safe token
+    """
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, *types):
+    """
+    Unpack a token made by encode_cursor, converting each value to the given type.
+
+    Raises BadRequest (a 400 response) for tampered or malformed tokens.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+        if not isinstance(payload, list) or len(payload) != len(types):
+            raise ValueError(token)
+        values = []
+        for value, kind in zip(payload, types):
+            if kind is datetime:
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError(token)
+            else:
+                value = kind(value)
+            values.append(value)
+        return values
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError):
+        raise BadRequest('Invalid pagination cursor')
+
+
+class CursorPage:
+    """
+    One page of a CursorPaginator, with opaque tokens for its neighbours
+    """
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Keyset paginator over a queryset, newest first.
+
+    Pages are selected with ``WHERE (created_at, id) < (last seen)`` instead
+    of OFFSET, and no COUNT(*) is ever run, so deep pages cost the same as
+    the first one. ``keys`` names a timestamp and a unique tie-breaker
+    (fields or annotations) that the queryset can be ordered by.
+    """
+    def __init__(self, queryset, per_page, keys=('created_at', 'id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = keys
+
+    def page(self, cursor=None):
+        time_key, id_key = self.keys
+        direction = 'next'
+        queryset = self.queryset
+        if cursor:
+            direction, timestamp, pk = decode_cursor(cursor, str, datetime, int)
+            if direction not in ('next', 'previous'):
+                raise BadRequest('Invalid pagination cursor')
+            op = 'lt' if direction == 'next' else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{time_key}__{op}': timestamp}) | Q(**{time_key: timestamp, f'{id_key}__{op}': pk})
+            )
+
+        if direction == 'next':
+            rows = list(queryset.order_by(f'-{time_key}', f'-{id_key}')[:self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_next, has_previous = more, bool(cursor)
+        else:
+            # Walk backwards from the cursor, then restore newest-first order
+            rows = list(queryset.order_by(time_key, id_key)[:self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_next, has_previous = True, more
+
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = self._cursor('next', rows[-1])
+        if rows and has_previous:
+            previous_cursor = self._cursor('previous', rows[0])
+        return CursorPage(rows, next_cursor, previous_cursor)
+
+    def _cursor(self, direction, obj):
+        time_key, id_key = self.keys
+        return encode_cursor(direction, getattr(obj, time_key), getattr(obj, id_key))
+
+
+class KeysetUnion:
+    """
+    The rows of several querysets over one model, for CursorPaginator.
+
+    ``filter()`` and ``order_by()`` apply to every queryset, and a
+    ``[:limit]`` slice runs one LIMIT query per queryset and merges their
+    rows in Python, so each query is a range scan on its own index instead
+    of one query ORing their conditions together. A row found by several
+    querysets is kept once.
+    """
+    def __init__(self, *querysets, ordering=()):
+        self.querysets = querysets
+        self.ordering = ordering
+
+    def filter(self, *args, **kwargs):
+        return KeysetUnion(*(queryset.filter(*args, **kwargs) for queryset in self.querysets), ordering=self.ordering)
+
+    def order_by(self, *fields):
+        return KeysetUnion(*(queryset.order_by(*fields) for queryset in self.querysets), ordering=fields)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.start or key.step or key.stop is None:
+            raise TypeError('KeysetUnion only supports [:limit] slices')
+        names = [field.lstrip('-') for field in self.ordering]
+        merged = heapq.merge(
+            *(list(queryset[:key.stop]) for queryset in self.querysets),
+            key=lambda row: tuple(getattr(row, name) for name in names),
+            reverse=bool(self.ordering) and self.ordering[0].startswith('-'),
+        )
+        rows, seen = [], set()
+        for row in merged:
+            if row.pk not in seen:
+                seen.add(row.pk)
+                rows.append(row)
+            if len(rows) == key.stop:
+                break
+        return rows
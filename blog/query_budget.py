@@ -0,0 +1,182 @@
+"""
+Per-request SQL query budgets and N+1 detection, for development and staging.
+
+QueryBudgetMiddleware records every statement a request runs and
+normalizes each into a query shape: literals and placeholders become
+``?`` and ``IN`` lists collapse to ``IN (...)``. A shape that repeats
+``QUERY_BUDGET_REPEAT_THRESHOLD`` times or more is reported as an N+1,
+with the template line (if a template triggered it) and the project code
+location that ran it. A request whose view (by URL name, e.g.
+``blog:home``) has an entry in ``QUERY_BUDGETS`` and runs more statements
+than that is reported as over budget.
+
+Findings are logged to ``blog.query_budget``. Responses carry
+``X-Query-Count`` (and ``X-Query-Budget`` when one applies), and with
+``QUERY_BUDGET_STRICT`` a violation raises QueryBudgetExceeded instead.
+QueryBudgetAssertions gives tests the same checks.
+"""
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import Node
+from django.urls import resolve
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'QUERY_BUDGET_ENABLED', settings.DEBUG)
+STRICT = getattr(settings, 'QUERY_BUDGET_STRICT', False)
+BUDGETS = getattr(settings, 'QUERY_BUDGETS', {})
+REPEAT_THRESHOLD = getattr(settings, 'QUERY_BUDGET_REPEAT_THRESHOLD', 3)
+
+PROJECT_DIR = str(settings.BASE_DIR) + os.sep
+THIS_FILE = __file__.rsplit('.', 1)[0]
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|\?')
+_IN_LIST = re.compile(r'\bIN \(\?(?:, \?)*\)', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    A request ran more queries than its budget, or repeated a query shape
+    """
+
+
+def normalize(sql):
+    """
+    The shape of a statement: the same query with any parameter values
+    """
+    shape = _STRING.sub('?', sql)
+    shape = _NUMBER.sub('?', shape)
+    shape = _PLACEHOLDER.sub('?', shape)
+    shape = _SPACE.sub(' ', shape).strip()
+    return _IN_LIST.sub('IN (...)', shape)
+
+
+def _caller():
+    """
+    Where the statement came from: the innermost template line being
+    rendered, if any, and the innermost project code outside this module
+    """
+    template = code = None
+    frame = sys._getframe(2)
+    while frame is not None and (template is None or code is None):
+        if template is None:
+            node = frame.f_locals.get('self')
+            # type(), not isinstance(): the latter would evaluate lazy objects (request.user)
+            if issubclass(type(node), Node) and getattr(node, 'token', None) is not None:
+                origin = getattr(node, 'origin', None)
+                if origin is not None:
+                    template = f'{origin.template_name}:{node.token.lineno}'
+        if code is None:
+            filename = frame.f_code.co_filename
+            if (
+                filename.startswith(PROJECT_DIR)
+                and not filename.startswith(THIS_FILE)
+                and f'{os.sep}site-packages{os.sep}' not in filename
+            ):
+                code = f'{filename[len(PROJECT_DIR):]}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return ' via '.join(location for location in (template, code) if location) or 'unknown'
+
+
+class QueryRecorder:
+    """
+    Execute wrapper recording every statement with its shape and caller
+    """
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'shape': normalize(sql),
+                'seconds': time.perf_counter() - started,
+                'caller': _caller(),
+            })
+
+    def __len__(self):
+        return len(self.queries)
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """
+        ``[(shape, count, callers)]`` for every shape run at least threshold times
+        """
+        counts = Counter(query['shape'] for query in self.queries)
+        callers = defaultdict(set)
+        for query in self.queries:
+            if counts[query['shape']] >= threshold:
+                callers[query['shape']].add(query['caller'])
+        return [(shape, counts[shape], sorted(callers[shape])) for shape in callers]
+
+
+@contextmanager
+def recording(recorder):
+    """
+    Record the statements run on every database connection of this thread
+    """
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+def problems(view_name, recorder):
+    """
+    Human-readable budget violations and N+1 findings for one request
+    """
+    found = []
+    budget = BUDGETS.get(view_name)
+    if budget is not None and len(recorder) > budget:
+        found.append(f'{view_name} ran {len(recorder)} queries, over its budget of {budget}')
+    for shape, count, callers in recorder.repeated():
+        found.append(f'{view_name} repeated {count}x: {shape[:200]} (from {"; ".join(callers)})')
+    return found
+
+
+def report(request, response, recorder):
+    """
+    Log (or with QUERY_BUDGET_STRICT, raise) what a request got wrong
+    """
+    match = getattr(request, 'resolver_match', None)
+    view_name = match.view_name if match is not None else request.path
+    response['X-Query-Count'] = str(len(recorder))
+    if view_name in BUDGETS:
+        response['X-Query-Budget'] = str(BUDGETS[view_name])
+    found = problems(view_name, recorder)
+    if found and STRICT:
+        raise QueryBudgetExceeded('\n'.join(found))
+    for problem in found:
+        logger.warning(problem)
+
+
+class QueryBudgetAssertions:
+    """
+    TestCase mixin checking a view against its QUERY_BUDGETS entry
+    """
+    def assertWithinQueryBudget(self, url, method='get', **kwargs):
+        view_name = resolve(url.split('?', 1)[0]).view_name
+        self.assertIn(view_name, BUDGETS, f'No QUERY_BUDGETS entry for {view_name}')
+        with recording(QueryRecorder()) as recorder:
+            response = getattr(self.client, method)(url, **kwargs)
+            if response.streaming:
+                # A streamed body runs its queries while being read
+                response.streaming_content = [b''.join(response.streaming_content)]
+        found = problems(view_name, recorder)
+        if found:
+            statements = '\n'.join(f"  {query['caller']}: {query['sql'][:160]}" for query in recorder.queries)
+            self.fail('\n'.join(found) + f'\nQueries:\n{statements}')
+        return response
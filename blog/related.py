@@ -0,0 +1,446 @@
+"""
+Content-similarity "related posts", computed off the request path.
+
+Published posts are turned into TF-IDF vectors over their title, excerpt
+and content, and each post's top-k cosine neighbours are stored in
+RelatedPost, so the detail page reads a handful of indexed rows.
+
+The ``build_related_posts`` command vectorizes the whole corpus and keeps
+the matrix, with its vocabulary and IDF, in ``RELATED_POSTS_MATRIX``. After
+that, a saved post only has its own row re-vectorized against the stored
+vocabulary, once it commits and in a background thread. Its neighbours are
+recomputed, and so are those of every post it now shares terms with or was
+listed by, so a new post enters other posts' lists straight away. With
+``stale_only`` (``--stale``) the command does the same for every new or
+edited post (``updated_at`` later than ``related_built_at``). Terms first
+seen after the last full build are ignored until the next one.
+
+NumPy and SciPy are imported lazily, so a web process only loads them when
+a post is saved.
+"""
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the development server runs a single process
+    fcntl = None
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Post, RelatedPost
+
+logger = logging.getLogger(__name__)
+
+MATRIX_PATH = getattr(settings, 'RELATED_POSTS_MATRIX', os.path.join(settings.BASE_DIR, '.cache', 'related-posts.npz'))
+# Threads updating saved posts' neighbours per web process; 0 updates inline when the post commits
+WORKERS = getattr(settings, 'RELATED_POSTS_WORKERS', 1)
+# Fields whose changes can move a post's neighbours
+CONTENT_FIELDS = frozenset(('title', 'excerpt', 'content', 'genre', 'genre_id', 'is_published'))
+TOP_K = 6
+BATCH_SIZE = 256
+MIN_SCORE = 0.05
+# Repeat counts so a word in the title outweighs the same word in the body
+FIELD_WEIGHTS = (('title', 3), ('excerpt', 2), ('content', 1))
+CORPUS_FIELDS = ('pk', 'title', 'excerpt', 'content', 'genre_id', 'created_at', 'updated_at', 'related_built_at')
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from has have he her his i in is it its '
+    'of on or our she so that the their them they this to was we were what '
+    'when which who will with you your'.split()
+)
+
+
+def tokenize(text):
+    return [word for word in re.findall(r'[a-z0-9]{2,}', text.lower()) if word not in STOP_WORDS]
+
+
+def term_counts(post):
+    counts = Counter()
+    for field, weight in FIELD_WEIGHTS:
+        for word in tokenize(post[field] or ''):
+            counts[word] += weight
+    return counts
+
+
+def fit_vocabulary(documents, max_df=0.5):
+    """
+    ``(vocabulary, idf)`` for a list of term Counters: the column of each
+    kept term, and its smoothed IDF.
+
+    Terms in more than ``max_df`` of the documents carry little signal and
+    are dropped, unless the corpus is too small for that to be meaningful.
+    """
+    import numpy as np
+
+    n_docs = len(documents)
+    document_frequency = Counter()
+    for counts in documents:
+        document_frequency.update(counts.keys())
+    limit = max(max_df * n_docs, 2)
+    vocabulary = {}
+    for term, df in document_frequency.items():
+        if df <= limit:
+            vocabulary[term] = len(vocabulary)
+
+    idf = np.zeros(len(vocabulary), dtype=np.float32)
+    for term, column in vocabulary.items():
+        idf[column] = math.log((1 + n_docs) / (1 + document_frequency[term])) + 1
+    return vocabulary, idf
+
+
+def tfidf_matrix(documents, max_df=0.5, vocabulary=None, idf=None):
+    """
+    L2-normalized TF-IDF rows (CSR) for a list of term Counters, with
+    sublinear term frequency; over the given vocabulary and IDF, or ones
+    fitted to the documents
+    """
+    import numpy as np
+    from scipy import sparse
+
+    if vocabulary is None:
+        vocabulary, idf = fit_vocabulary(documents, max_df)
+
+    indptr = [0]
+    indices = []
+    data = []
+    for counts in documents:
+        for term, count in counts.items():
+            column = vocabulary.get(term)
+            if column is not None:
+                indices.append(column)
+                data.append(1 + math.log(count))
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix(
+        (np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr)),
+        shape=(len(documents), len(vocabulary)),
+    )
+    matrix = matrix.multiply(idf).tocsr()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(matrix).tocsr()
+
+
+def top_neighbours(matrix, rows, top_k=TOP_K, min_score=MIN_SCORE):
+    """
+    Best ``top_k`` cosine neighbours for the given row numbers.
+
+    Yields ``(row, [(neighbour_row, score), ...])`` with scores descending.
+    The product of the rows with the corpus stays sparse, so memory grows
+    with the pairs of posts sharing a term rather than rows x corpus.
+    """
+    import numpy as np
+
+    similarities = matrix[rows].dot(matrix.T).tocsr()
+    for i, row in enumerate(rows):
+        start, end = similarities.indptr[i], similarities.indptr[i + 1]
+        columns = similarities.indices[start:end]
+        scores = similarities.data[start:end]
+        keep = (columns != row) & (scores >= min_score)  # a post is not its own neighbour
+        columns, scores = columns[keep], scores[keep]
+        if top_k <= 0:
+            columns, scores = columns[:0], scores[:0]
+        elif len(scores) > top_k:
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            columns, scores = columns[best], scores[best]
+        ranked = np.lexsort((columns, -scores))
+        yield row, [(int(columns[j]), float(scores[j])) for j in ranked]
+
+
+class StoredMatrix:
+    """
+    The TF-IDF rows of the published posts, with the vocabulary and IDF
+    they were computed with, as kept in MATRIX_PATH between builds
+    """
+    def __init__(self, matrix, post_ids, vocabulary, idf):
+        self.matrix = matrix
+        self.post_ids = list(post_ids)
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.rows = {post_id: row for row, post_id in enumerate(self.post_ids)}
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        The stored matrix, or None if no full build has stored one yet
+        """
+        import numpy as np
+        from scipy import sparse
+
+        try:
+            stored = np.load(path or MATRIX_PATH, allow_pickle=False)
+        except FileNotFoundError:
+            return None
+        with stored:
+            matrix = sparse.csr_matrix(
+                (stored['data'], stored['indices'], stored['indptr']), shape=tuple(stored['shape']),
+            )
+            vocabulary = {term: column for column, term in enumerate(stored['terms'].tolist())}
+            return cls(matrix, stored['post_ids'].tolist(), vocabulary, stored['idf'])
+
+    def save(self, path=None):
+        import numpy as np
+
+        path = path or MATRIX_PATH
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Written aside and renamed over the old one, so a reader never sees half a file
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.savez(
+                    file,
+                    data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                    shape=np.asarray(self.matrix.shape),
+                    post_ids=np.asarray(self.post_ids, dtype=np.int64),
+                    terms=np.asarray(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str),
+                    idf=self.idf,
+                )
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def similar_ids(self, rows):
+        """
+        Ids of the posts sharing enough terms with any of the rows to be their neighbour
+        """
+        if not rows:
+            return set()
+        similarities = self.matrix[rows].dot(self.matrix.T).tocsr()
+        return {self.post_ids[column] for column in similarities.indices[similarities.data >= MIN_SCORE].tolist()}
+
+    def update(self, posts, post_ids):
+        """
+        Drop the rows of post_ids, then append posts (post_ids still
+        published) vectorized over the stored vocabulary; returns their rows
+        """
+        from scipy import sparse
+
+        kept = [row for row, post_id in enumerate(self.post_ids) if post_id not in post_ids]
+        parts = [self.matrix[kept]]
+        if posts:
+            parts.append(tfidf_matrix([term_counts(post) for post in posts], vocabulary=self.vocabulary, idf=self.idf))
+        self.matrix = sparse.vstack(parts, format='csr')
+        self.post_ids = [self.post_ids[row] for row in kept] + [post['pk'] for post in posts]
+        self.rows = {post_id: row for row, post_id in enumerate(self.post_ids)}
+        return list(range(len(kept), len(self.post_ids)))
+
+
+@contextmanager
+def _matrix_lock():
+    """
+    Serialize builds and updates of the stored matrix across processes
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(MATRIX_PATH), exist_ok=True)
+    with open(f'{MATRIX_PATH}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _store_neighbours(matrix, post_ids, rows, fallback, top_k, batch_size, built_at=None):
+    """
+    Replace the RelatedPost rows of the posts at the given matrix rows, in
+    batches of batch_size; fallback(post_id) gives the posts stored for
+    one without neighbours. With built_at, marks the posts built as of then.
+    """
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        entries = []
+        for row, neighbours in top_neighbours(matrix, batch, top_k):
+            post_id = post_ids[row]
+            if neighbours:
+                neighbours = [(post_ids[column], score) for column, score in neighbours]
+            else:
+                neighbours = [(related_id, 0.0) for related_id in fallback(post_id)]
+            entries.extend(
+                RelatedPost(post_id=post_id, related_id=related_id, score=score, rank=rank)
+                for rank, (related_id, score) in enumerate(neighbours)
+            )
+        batch_ids = [post_ids[row] for row in batch]
+        with transaction.atomic():
+            RelatedPost.objects.filter(post_id__in=batch_ids).delete()
+            RelatedPost.objects.bulk_create(entries)
+            if built_at is not None:
+                # Edits saved after built_at are left stale for the next run
+                Post.objects.filter(pk__in=batch_ids).update(related_built_at=built_at)
+
+
+def _genre_fallbacks(corpus, top_k):
+    """
+    fallback() for _store_neighbours from the corpus: the newest posts of
+    the post's genre
+    """
+    newest = sorted(corpus, key=lambda post: (post['created_at'], post['pk']), reverse=True)
+    by_genre = defaultdict(list)
+    for post in newest:
+        post_ids = by_genre[post['genre_id']]
+        if len(post_ids) <= top_k:
+            post_ids.append(post['pk'])
+    genre_of = {post['pk']: post['genre_id'] for post in corpus}
+    return lambda post_id: [pk for pk in by_genre[genre_of[post_id]] if pk != post_id][:top_k]
+
+
+def _newest_in_genre(top_k):
+    """
+    fallback() for _store_neighbours from the database, for updates
+    """
+    newest = {}
+
+    def fallback(post_id):
+        genre_id = Post.objects.filter(pk=post_id).values_list('genre_id', flat=True).first()
+        if genre_id not in newest:
+            newest[genre_id] = list(
+                Post.objects.filter(genre_id=genre_id, is_published=True)
+                .order_by('-created_at', '-id').values_list('pk', flat=True)[:top_k + 1]
+            )
+        return [pk for pk in newest[genre_id] if pk != post_id][:top_k]
+    return fallback
+
+
+def build_related_posts(stale_only=False, top_k=TOP_K, batch_size=BATCH_SIZE):
+    """
+    Recompute RelatedPost rows; returns the number of posts updated.
+
+    Vectorizes the whole published corpus and stores the matrix for later
+    updates, then computes similarities, in batches of ``batch_size``
+    rows, for the posts being rebuilt. With stale_only and a stored matrix,
+    only the stale posts are re-vectorized (see update_related_posts).
+    Posts sharing no terms with any other get the newest posts of their
+    genre instead, with a score of 0, so the detail page never has to look
+    those up live.
+    """
+    if stale_only:
+        updated = update_related_posts(stale_posts().values_list('pk', flat=True), top_k, batch_size)
+        if updated is not None:
+            return updated
+
+    started_at = timezone.now()
+    with _matrix_lock():
+        corpus = list(Post.objects.filter(is_published=True).order_by('pk').values(*CORPUS_FIELDS))
+        documents = [term_counts(post) for post in corpus]
+        vocabulary, idf = fit_vocabulary(documents)
+        matrix = tfidf_matrix(documents, vocabulary=vocabulary, idf=idf)
+        post_ids = [post['pk'] for post in corpus]
+        StoredMatrix(matrix, post_ids, vocabulary, idf).save()
+        if stale_only:
+            rows = [
+                row for row, post in enumerate(corpus)
+                if post['related_built_at'] is None or post['updated_at'] > post['related_built_at']
+            ]
+        else:
+            rows = list(range(len(corpus)))
+        _store_neighbours(matrix, post_ids, rows, _genre_fallbacks(corpus, top_k), top_k, batch_size, started_at)
+    return len(rows)
+
+
+def update_related_posts(post_ids, top_k=TOP_K, batch_size=BATCH_SIZE):
+    """
+    Re-vectorize the given posts against the stored matrix and recompute
+    their neighbours, and those of every post they share terms with or
+    were listed by; returns the number of posts re-vectorized, or None
+    when no full build has stored a matrix yet.
+
+    Unpublished and deleted posts leave the matrix, so they are no longer
+    anyone's neighbour.
+    """
+    post_ids = set(post_ids)
+    started_at = timezone.now()
+    with _matrix_lock():
+        stored = StoredMatrix.load()
+        if stored is None:
+            return None
+        posts = list(Post.objects.filter(pk__in=post_ids, is_published=True).order_by('pk').values(*CORPUS_FIELDS))
+        # Posts that may list them now or did before (a deleted post's RelatedPost rows are gone)
+        affected = set(RelatedPost.objects.filter(related_id__in=post_ids).values_list('post_id', flat=True))
+        affected.update(stored.similar_ids([stored.rows[pk] for pk in post_ids if pk in stored.rows]))
+        rows = stored.update(posts, post_ids)
+        affected.update(stored.similar_ids(rows))
+        affected = sorted({stored.rows[pk] for pk in affected if pk in stored.rows}.difference(rows))
+
+        fallback = _newest_in_genre(top_k)
+        _store_neighbours(stored.matrix, stored.post_ids, rows, fallback, top_k, batch_size, started_at)
+        _store_neighbours(stored.matrix, stored.post_ids, affected, fallback, top_k, batch_size)
+        stored.save()
+    return len(rows)
+
+
+_lock = threading.Lock()
+_pending = set()
+_threads = None
+
+
+def _update_saved(post_ids):
+    try:
+        update_related_posts(post_ids)
+    except Exception:
+        # The posts stay stale for build_related_posts --stale
+        logger.warning('Could not update related posts of %s', sorted(post_ids), exc_info=True)
+
+
+def _update_pending():
+    with _lock:
+        post_ids = set(_pending)
+        _pending.clear()
+    try:
+        _update_saved(post_ids)
+    finally:
+        close_old_connections()
+
+
+def _enqueue(post_id):
+    global _threads
+    with _lock:
+        # Posts saved while an update is queued join it
+        queued = bool(_pending)
+        _pending.add(post_id)
+        if _threads is None:
+            _threads = ThreadPoolExecutor(WORKERS, thread_name_prefix='related-posts')
+    if not queued:
+        _threads.submit(_update_pending)
+
+
+def schedule(post_id, update_fields=None):
+    """
+    Update a saved or deleted post's neighbours (and its neighbours') once
+    the current transaction commits, unless update_fields leaves its text,
+    genre and publication alone
+    """
+    if update_fields is not None and not CONTENT_FIELDS & set(update_fields):
+        return
+    if WORKERS <= 0:
+        transaction.on_commit(lambda: _update_saved([post_id]))
+    else:
+        transaction.on_commit(lambda: _enqueue(post_id))
+
+
+def stale_posts():
+    """
+    Published posts whose neighbours are missing or older than their last edit
+    """
+    return Post.objects.filter(is_published=True).filter(
+        Q(related_built_at__isnull=True) | Q(updated_at__gt=F('related_built_at'))
+    )
+
+
+def related_posts(post, limit=3):
+    """
+    Published neighbours of a post, best first, in one indexed query
+    """
+    entries = (
+        RelatedPost.objects.filter(post=post, related__is_published=True)
+        .select_related('related__author__profile', 'related__genre')[:limit]
+    )
+    return [entry.related for entry in entries]
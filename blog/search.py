@@ -0,0 +1,273 @@
+"""
+Full-text post search backed by the database's own inverted index.
+
+The ``blog_postsearch`` table (see migration 0006) holds one document per
+post: an FTS5 virtual table keyed by rowid on SQLite, and a weighted
+``tsvector`` with a GIN index on PostgreSQL. Signals keep it in sync with
+Post saves and deletes. Other backends fall back to ``icontains`` filters.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import Post
+from .pagination import decode_cursor, encode_cursor
+
+SEARCH_PAGE_SIZE = 10
+SNIPPET_WORDS = 24
+# Decimals of the relevance scores that results and cursors are ordered by
+SCORE_DIGITS = 6
+# Indexed terms a search prefix is expanded to, most common first
+PREFIX_EXPANSIONS = 20
+
+# Private-use characters mark matches inside snippets until they are escaped
+MATCH_START = '\ue000'
+MATCH_END = '\ue001'
+
+POSTGRESQL_DOCUMENT = (
+    "setweight(to_tsvector('english', p.title), 'A') || "
+    "setweight(to_tsvector('english', p.content), 'B')"
+)
+
+
+def is_supported():
+    return connection.vendor in ('sqlite', 'postgresql')
+
+
+def search_terms(query):
+    """
+    Split free text into plain words, dropping any query syntax
+    """
+    return re.findall(r'\w+', query.lower())
+
+
+def _match_expression(terms):
+    """
+    FTS5 query ANDing quoted terms; the last one also matches as a prefix.
+
+    The porter tokenizer stems a prefix like any other term ("jelly" is
+    looked up as "jelli*", which misses "jellyfish"), so the last term is
+    also matched against the indexed terms it is a prefix of, read from
+    the blog_postsearch_vocab table (migration 0011).
+    """
+    *words, prefix = terms
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT term FROM blog_postsearch_vocab WHERE term >= %s AND term < %s ORDER BY doc DESC LIMIT %s',
+            [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1), PREFIX_EXPANSIONS],
+        )
+        completions = [term for (term,) in cursor.fetchall()]
+    alternatives = ' OR '.join([f'"{prefix}"*', *(f'"{term}"' for term in completions)])
+    return ' AND '.join([*(f'"{word}"' for word in words), f'({alternatives})'])
+
+
+def index_post(post):
+    """
+    Insert or refresh a post's search document
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('DELETE FROM blog_postsearch WHERE rowid = %s', [post.pk])
+            cursor.execute(
+                'INSERT INTO blog_postsearch (rowid, title, content) VALUES (%s, %s, %s)',
+                [post.pk, post.title, post.content],
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f'INSERT INTO blog_postsearch (post_id, document) '
+                f'SELECT p.id, {POSTGRESQL_DOCUMENT} FROM blog_post p WHERE p.id = %s '
+                f'ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document',
+                [post.pk],
+            )
+
+
+def index_posts(post_ids):
+    """
+    Insert or refresh the search documents of many posts in a few
+    statements, e.g. after bulk_create (which sends no post_save)
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    placeholders = ', '.join(['%s'] * len(post_ids))
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM blog_postsearch WHERE rowid IN ({placeholders})', post_ids)
+            cursor.execute(
+                f'INSERT INTO blog_postsearch (rowid, title, content) '
+                f'SELECT id, title, content FROM blog_post WHERE id IN ({placeholders})',
+                post_ids,
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f'INSERT INTO blog_postsearch (post_id, document) '
+                f'SELECT p.id, {POSTGRESQL_DOCUMENT} FROM blog_post p WHERE p.id IN ({placeholders}) '
+                f'ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document',
+                post_ids,
+            )
+
+
+def remove_post(post_id):
+    """
+    Drop a deleted post's search document
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM blog_postsearch WHERE rowid = %s', [post_id])
+    # On PostgreSQL the row goes with the post (ON DELETE CASCADE)
+
+
+def matching_ids(query):
+    """
+    Subquery expression for the ids of every post matching ``query``, for
+    use as ``filter(pk__in=...)``. Returns None when nothing can match.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return None
+    if connection.vendor == 'sqlite':
+        return RawSQL('SELECT rowid FROM blog_postsearch WHERE blog_postsearch MATCH %s', [_match_expression(terms)])
+    return RawSQL(
+        "SELECT post_id FROM blog_postsearch WHERE document @@ plainto_tsquery('english', %s)",
+        [' '.join(terms)],
+    )
+
+
+def _ranked_sql(terms, genre_id=None, author_id=None, match=None):
+    """
+    SQL and params selecting ``(id, score)`` for published matches, best first.
+
+    Scores are rounded to SCORE_DIGITS decimals, as doubles on both
+    backends, so the score in a cursor compares equal to the row it came
+    from (PostgreSQL's ts_rank_cd is a float4, never equal to the double
+    read back from it).
+    """
+    if connection.vendor == 'sqlite':
+        sql = (
+            # bm25() is lower-is-better; negate it so both backends sort descending
+            'SELECT p.id AS id, ROUND(-bm25(blog_postsearch, 10.0, 1.0), %s) AS score '
+            'FROM blog_postsearch JOIN blog_post p ON p.id = blog_postsearch.rowid '
+            'WHERE blog_postsearch MATCH %s AND p.is_published'
+        )
+        params = [SCORE_DIGITS, match or _match_expression(terms)]
+    else:
+        sql = (
+            'SELECT p.id AS id, ROUND(ts_rank_cd(s.document, q.query)::numeric, %s)::float8 AS score '
+            "FROM blog_postsearch s CROSS JOIN plainto_tsquery('english', %s) q(query) "
+            'JOIN blog_post p ON p.id = s.post_id '
+            'WHERE s.document @@ q.query AND p.is_published'
+        )
+        params = [SCORE_DIGITS, ' '.join(terms)]
+    if genre_id is not None:
+        sql += ' AND p.genre_id = %s'
+        params.append(genre_id)
+    if author_id is not None:
+        sql += ' AND p.author_id = %s'
+        params.append(author_id)
+    return sql, params
+
+
+def _snippets(terms, post_ids, match=None):
+    """
+    Highlighted excerpts for a page of results, computed for that page only
+    """
+    if not post_ids:
+        return {}
+    placeholders = ', '.join(['%s'] * len(post_ids))
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                f"SELECT rowid, snippet(blog_postsearch, 1, %s, %s, '…', {SNIPPET_WORDS}) "
+                f'FROM blog_postsearch WHERE blog_postsearch MATCH %s AND rowid IN ({placeholders})',
+                [MATCH_START, MATCH_END, match or _match_expression(terms), *post_ids],
+            )
+        else:
+            cursor.execute(
+                "SELECT p.id, ts_headline('english', p.content, plainto_tsquery('english', %s), %s) "
+                f'FROM blog_post p WHERE p.id IN ({placeholders})',
+                [
+                    ' '.join(terms),
+                    f'StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords={SNIPPET_WORDS}, MinWords=10',
+                    *post_ids,
+                ],
+            )
+        return {post_id: highlight(snippet) for post_id, snippet in cursor.fetchall()}
+
+
+def highlight(snippet):
+    """
+    Escape a snippet, then turn the match markers into <mark> tags
+    """
+    html = escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+    return mark_safe(html)
+
+
+def search_posts(query, genre=None, author=None, cursor=None, page_size=SEARCH_PAGE_SIZE):
+    """
+    Ranked keyset page of published posts matching ``query``.
+
+    Results are ordered by relevance, then id; ``cursor`` is the
+    ``next_cursor`` of the previous page. Each post gets a ``snippet`` with
+    the matched words in <mark> tags. Returns ``(posts, next_cursor)``.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return [], None
+    genre_id = genre.pk if genre is not None else None
+    author_id = author.pk if author is not None else None
+
+    if not is_supported():
+        return _search_posts_fallback(terms, genre_id, author_id, cursor, page_size)
+
+    match = _match_expression(terms) if connection.vendor == 'sqlite' else None
+    sql, params = _ranked_sql(terms, genre_id, author_id, match)
+    sql = f'SELECT id, score FROM ({sql}) ranked'
+    if cursor:
+        score, pk = decode_cursor(cursor, float, int)
+        sql += ' WHERE score < %s OR (score = %s AND id < %s)'
+        params += [score, score, pk]
+    sql += ' ORDER BY score DESC, id DESC LIMIT %s'
+    params.append(page_size + 1)
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(sql, params)
+        rows = db_cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last_id, last_score = rows[-1]
+        next_cursor = encode_cursor(last_score, last_id)
+    ids = [post_id for post_id, score in rows]
+    posts = Post.objects.filter(pk__in=ids).select_related('author__profile', 'genre').in_bulk()
+    snippets = _snippets(terms, ids, match)
+    results = []
+    for post_id in ids:
+        post = posts[post_id]
+        post.snippet = snippets.get(post_id, '')
+        results.append(post)
+    return results, next_cursor
+
+
+def _search_posts_fallback(terms, genre_id, author_id, cursor, page_size):
+    queryset = Post.objects.filter(is_published=True).select_related('author__profile', 'genre')
+    for term in terms:
+        queryset = queryset.filter(Q(title__icontains=term) | Q(content__icontains=term))
+    if genre_id is not None:
+        queryset = queryset.filter(genre_id=genre_id)
+    if author_id is not None:
+        queryset = queryset.filter(author_id=author_id)
+    if cursor:
+        (pk,) = decode_cursor(cursor, int)
+        queryset = queryset.filter(pk__lt=pk)
+    results = list(queryset.order_by('-id')[:page_size + 1])
+    next_cursor = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        next_cursor = encode_cursor(results[-1].pk)
+    for post in results:
+        post.snippet = post.excerpt
+    return results, next_cursor
@@ -0,0 +1,215 @@
+"""
+Session engine keeping sessions in a shared cache, with a write-behind to
+the database.
+
+Because of SESSION_SAVE_EVERY_REQUEST, SessionMiddleware saves the session
+after every request only to push its expiry forward. This engine drops a
+save that changes nothing unless the expiry stored in the database has
+less than ``SESSION_REFRESH_RATIO`` of the session's age left. A reader's
+row is then rewritten every few days instead of on every page view.
+
+Changed sessions go to the cache straight away and are queued. At the end
+of any request, each process upserts its queue in one statement once it
+holds ``SESSION_WRITE_BEHIND_BATCH`` sessions, or once its oldest entry is
+``SESSION_WRITE_BEHIND_INTERVAL`` seconds old, and again at exit. A failed
+write is logged and retried later; it never fails the request. Creating
+and deleting sessions (login, logout) goes to the database immediately.
+
+While a session is in the cache, the cache is its source of truth, so
+SESSION_CACHE_ALIAS must name a cache every worker shares.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import caches
+from django.core.signals import request_finished
+from django.db import DatabaseError
+from django.dispatch import receiver
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'session:'
+REFRESH_RATIO = getattr(settings, 'SESSION_REFRESH_RATIO', 0.9)
+BATCH_SIZE = getattr(settings, 'SESSION_WRITE_BEHIND_BATCH', 100)
+FLUSH_INTERVAL = getattr(settings, 'SESSION_WRITE_BEHIND_INTERVAL', 5)
+
+
+class WriteBehindQueue:
+    """
+    Session rows waiting to be written by this process, one per session key
+    """
+    def __init__(self, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, session_key, session_data, expire_date):
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.monotonic()
+            # A newer save of the same session replaces the queued one
+            self._pending[session_key] = (session_data, expire_date)
+        self.flush_if_due()
+
+    def due(self):
+        with self._lock:
+            return bool(self._pending) and (
+                len(self._pending) >= self.batch_size or time.monotonic() - self._oldest >= self.interval
+            )
+
+    def flush_if_due(self):
+        """
+        flush() once the queue is full or old enough, logging (not raising)
+        a failed write: the sessions are requeued and stay in the cache
+        """
+        if not self.due():
+            return 0
+        try:
+            return self.flush()
+        except DatabaseError:
+            logger.warning('Could not write %d queued sessions, will retry', len(self), exc_info=True)
+            return 0
+
+    def discard(self, session_key):
+        with self._lock:
+            self._pending.pop(session_key, None)
+
+    def flush(self):
+        """
+        Upsert every queued session; returns how many were written
+        """
+        from django.contrib.sessions.models import Session
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            Session.objects.bulk_create(
+                [
+                    Session(session_key=session_key, session_data=session_data, expire_date=expire_date)
+                    for session_key, (session_data, expire_date) in pending.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['session_key'],
+                update_fields=['session_data', 'expire_date'],
+            )
+        except DatabaseError:
+            # Requeue, unless a newer save of the session has been queued since
+            with self._lock:
+                for session_key, row in pending.items():
+                    self._pending.setdefault(session_key, row)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            raise
+        return len(pending)
+
+
+queue = WriteBehindQueue()
+
+
+def flush():
+    """
+    Write this process's queued sessions to the database now
+    """
+    return queue.flush()
+
+
+@receiver(request_finished)
+def _flush_after_request(sender, **kwargs):
+    # Drains the queue in requests that don't save their session, too
+    queue.flush_if_due()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        queue.flush()
+    except DatabaseError:
+        # The sessions remain in the cache until they expire
+        logger.warning('Could not write %d queued sessions at exit', len(queue), exc_info=True)
+
+
+class SessionStore(DBStore):
+    """
+    Cache-first session store that rarely writes to the database
+    """
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        self._cache = caches[settings.SESSION_CACHE_ALIAS]
+        # Expiry last stored for this session (None: unknown, write it)
+        self._stored_expiry = None
+        super().__init__(session_key)
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def _cache_set(self, data, expire_date):
+        timeout = (expire_date - timezone.now()).total_seconds()
+        if timeout > 0:
+            self._cache.set(self.cache_key, {'data': data, 'expire_date': expire_date}, timeout)
+
+    def load(self):
+        try:
+            entry = self._cache.get(self.cache_key)
+        except Exception:
+            # Some backends (e.g. memcache) raise on bad keys; treat as a miss
+            entry = None
+        if entry is not None:
+            self._stored_expiry = entry['expire_date']
+            return entry['data']
+
+        session = self._get_session_from_db()
+        if session is None:
+            return {}
+        data = self.decode(session.session_data)
+        self._stored_expiry = session.expire_date
+        self._cache_set(data, session.expire_date)
+        return data
+
+    def exists(self, session_key):
+        if session_key and self.cache_key_prefix + session_key in self._cache:
+            return True
+        return super().exists(session_key)
+
+    def _needs_refresh(self):
+        if self._stored_expiry is None:
+            return True
+        remaining = (self._stored_expiry - timezone.now()).total_seconds()
+        return remaining < REFRESH_RATIO * self.get_expiry_age()
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        if must_create:
+            super().save(must_create=True)
+        elif not (self.modified or self._needs_refresh()):
+            return
+        data = self._get_session(no_load=must_create)
+        expire_date = self.get_expiry_date()
+        # Cache first, so a failed flush can't lose the session
+        self._cache_set(data, expire_date)
+        self._stored_expiry = expire_date
+        if not must_create:
+            queue.put(self.session_key, self.encode(data), expire_date)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        queue.discard(session_key)
+        self._cache.delete(self.cache_key_prefix + session_key)
+        super().delete(session_key)
@@ -1,7 +1,11 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from .models import UserProfile, Genre, Post, Comment, PostLike, CommentLike, Follow
+from .counters import adjust_counter, recount_comments, recount_posts
+from . import card_cache, genres, images, page_cache, related, search, timeline, viewer_state
 
 
 @receiver(post_save, sender=User)
@@ -21,4 +25,303 @@ def save_user_profile(sender, instance, **kwargs):
     if hasattr(instance, 'profile'):
         instance.profile.save()
     else:
-        UserProfile.objects.create(user=instance)
\ No newline at end of file
+        UserProfile.objects.create(user=instance)
+
+
+@receiver(post_save, sender=User)
+def revoke_viewer_snapshots(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Make the user's sessions reload their auth flags after a save that may
+    have changed them (login only writes last_login)
+    """
+    if not created and (update_fields is None or set(update_fields) & set(viewer_state.AUTH_FIELDS)):
+        viewer_state.revoke_snapshots(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_author_cards(sender, instance, **kwargs):
+    """
+    Re-render the author's post cards after a profile (or name) change
+    """
+    card_cache.bump_author(instance.user_id)
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def invalidate_all_cards(sender, instance, **kwargs):
+    """
+    Re-render every post card after a genre changes
+    """
+    card_cache.bump_generation()
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Post)
+def invalidate_genre_registry(sender, instance, **kwargs):
+    """
+    Reload the genre registry (names, slugs and post counts) in every worker
+    """
+    genres.bump()
+
+
+@receiver(post_save, sender=Post)
+def invalidate_genre_counts(sender, instance, created, **kwargs):
+    """
+    Reload the genre registry when a save changed a genre's published post count
+    """
+    was_published = getattr(instance, '_was_published', not created)
+    previous_genre_id = getattr(instance, '_previous_genre_id', instance.genre_id)
+    if created or was_published != instance.is_published or previous_genre_id != instance.genre_id:
+        genres.bump()
+
+
+def _is_cascade(sender, origin):
+    """
+    Whether rows of sender are being deleted because something else was
+    (a post, comment or user), rather than directly
+    """
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return model is not sender
+
+
+def _recount_once(origin, recount, target_id):
+    """
+    Recount target_id's counters once the cascade from origin commits,
+    together with every other target of the same cascade: one statement
+    instead of one UPDATE per deleted row, and none for targets deleted too
+    """
+    pending = origin.__dict__.setdefault('_counter_targets', {})
+    if recount not in pending:
+        pending[recount] = set()
+        transaction.on_commit(lambda: recount(pending.pop(recount)))
+    pending[recount].add(target_id)
+
+
+@receiver(post_save, sender=PostLike)
+def increment_post_likes(sender, instance, created, **kwargs):
+    """
+    Keep Post.likes_count in step with new likes
+    """
+    if created:
+        adjust_counter(Post, instance.post_id, 'likes_count', 1)
+
+
+@receiver(post_delete, sender=PostLike)
+def decrement_post_likes(sender, instance, origin=None, **kwargs):
+    """
+    Keep Post.likes_count in step with removed likes (including cascades)
+    """
+    if origin is not None and _is_cascade(sender, origin):
+        _recount_once(origin, recount_posts, instance.post_id)
+    else:
+        adjust_counter(Post, instance.post_id, 'likes_count', -1)
+
+
+@receiver(post_save, sender=CommentLike)
+def increment_comment_likes(sender, instance, created, **kwargs):
+    """
+    Keep Comment.likes_count in step with new likes
+    """
+    if created:
+        adjust_counter(Comment, instance.comment_id, 'likes_count', 1)
+
+
+@receiver(post_delete, sender=CommentLike)
+def decrement_comment_likes(sender, instance, origin=None, **kwargs):
+    """
+    Keep Comment.likes_count in step with removed likes (including cascades)
+    """
+    if origin is not None and _is_cascade(sender, origin):
+        _recount_once(origin, recount_comments, instance.comment_id)
+    else:
+        adjust_counter(Comment, instance.comment_id, 'likes_count', -1)
+
+
+@receiver(post_save, sender=Comment)
+def increment_post_comments(sender, instance, created, **kwargs):
+    """
+    Keep Post.comments_count in step with new top-level comments
+    """
+    if created and instance.parent_id is None:
+        adjust_counter(Post, instance.post_id, 'comments_count', 1)
+
+
+@receiver(post_delete, sender=Comment)
+def decrement_post_comments(sender, instance, origin=None, **kwargs):
+    """
+    Keep Post.comments_count in step with removed top-level comments
+    """
+    if instance.parent_id is not None:
+        return
+    if origin is not None and _is_cascade(sender, origin):
+        _recount_once(origin, recount_posts, instance.post_id)
+    else:
+        adjust_counter(Post, instance.post_id, 'comments_count', -1)
+
+
+@receiver(pre_save, sender=Post)
+def remember_published_state(sender, instance, **kwargs):
+    """
+    Record whether the stored row was published and its genre (and the
+    genre's slug, for purging its pages), to detect publish/unpublish and
+    moves between genres
+    """
+    stored = None
+    if instance.pk is not None:
+        stored = sender.objects.filter(pk=instance.pk).values_list('is_published', 'genre_id', 'genre__slug').first()
+    if stored is None:
+        instance._was_published, instance._previous_genre_id, instance._previous_genre_slug = False, None, None
+    else:
+        instance._was_published, instance._previous_genre_id, instance._previous_genre_slug = stored
+
+
+@receiver(post_save, sender=Post)
+def update_timelines(sender, instance, created, **kwargs):
+    """
+    Fan a newly published post out to followers, or retract an unpublished one
+    """
+    was_published = getattr(instance, '_was_published', not created)
+    if instance.is_published and not was_published:
+        transaction.on_commit(lambda: timeline.fan_out(instance))
+    elif was_published and not instance.is_published:
+        timeline.retract(instance)
+
+
+@receiver(post_save, sender=Post)
+def index_post_for_search(sender, instance, **kwargs):
+    """
+    Keep the post's full-text search document in sync
+    """
+    search.index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def remove_post_from_search(sender, instance, **kwargs):
+    """
+    Drop a deleted post from the full-text search index
+    """
+    search.remove_post(instance.pk)
+
+
+@receiver(post_save, sender=Post)
+def render_featured_image_derivatives(sender, instance, **kwargs):
+    """
+    Resize a new featured image in the background
+    """
+    images.schedule('post', instance)
+
+
+@receiver(post_save, sender=Post)
+def update_related_posts(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Recompute the post's related posts, and the lists it now belongs in, in the background
+    """
+    related.schedule(instance.pk, None if created else update_fields)
+
+
+@receiver(post_delete, sender=Post)
+def remove_related_post(sender, instance, **kwargs):
+    """
+    Take a deleted post out of other posts' related posts
+    """
+    related.schedule(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+def render_avatar_derivatives(sender, instance, **kwargs):
+    """
+    Resize a new avatar in the background
+    """
+    images.schedule('avatar', instance)
+
+
+@receiver(post_save, sender=Follow)
+def backfill_timeline(sender, instance, created, **kwargs):
+    """
+    Copy the followed author's recent posts into the new follower's timeline
+    """
+    if created:
+        timeline.backfill(instance.follower_id, instance.following_id)
+
+
+@receiver(post_delete, sender=Follow)
+def trim_timeline(sender, instance, **kwargs):
+    """
+    Drop the unfollowed author's posts from the follower's timeline
+    """
+    timeline.forget(instance.follower_id, instance.following_id)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def purge_follow_pages(sender, instance, **kwargs):
+    """
+    Expire the profiles showing the follower and following counts
+    """
+    page_cache.purge(f'author:{instance.follower_id}', f'author:{instance.following_id}')
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def purge_post_pages(sender, instance, **kwargs):
+    """
+    Expire cached pages showing the post, and the lists it appears in
+    """
+    tags = ['home', f'post:{instance.pk}', f'author:{instance.author_id}']
+    # A post moved between genres leaves the old genre's list too
+    genre_slugs = {getattr(instance, '_previous_genre_slug', None), _genre_slug(instance)}
+    tags.extend(f'genre:{slug}' for slug in genre_slugs if slug is not None)
+    page_cache.purge(*tags)
+
+
+def _genre_slug(post):
+    """
+    The slug of the post's genre: remembered before the save, or already
+    loaded, else looked up (None when the genre's deletion cascaded to the post)
+    """
+    if hasattr(post, '_previous_genre_slug') and post.genre_id == post._previous_genre_id:
+        return post._previous_genre_slug
+    if Post.genre.is_cached(post):
+        return post.genre.slug
+    return Genre.objects.filter(pk=post.genre_id).values_list('slug', flat=True).first()
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=PostLike)
+@receiver(post_delete, sender=PostLike)
+def purge_post_activity_pages(sender, instance, **kwargs):
+    """
+    Expire cached pages showing the post's comments or counters
+    """
+    page_cache.purge(f'post:{instance.post_id}')
+
+
+@receiver(post_save, sender=CommentLike)
+@receiver(post_delete, sender=CommentLike)
+def purge_comment_like_pages(sender, instance, **kwargs):
+    """
+    Expire the cached page showing the comment's like count
+    """
+    post_id = Comment.objects.filter(pk=instance.comment_id).values_list('post_id', flat=True).first()
+    if post_id is not None:
+        page_cache.purge(f'post:{post_id}')
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def purge_genre_pages(sender, instance, **kwargs):
+    """
+    Expire every cached page: genres are listed in the navigation
+    """
+    page_cache.purge(page_cache.SITE_TAG, f'genre:{instance.slug}')
+
+
+@receiver(post_save, sender=UserProfile)
+def purge_author_pages(sender, instance, **kwargs):
+    """
+    Expire cached pages showing the user's name or avatar, including
+    their own pages, which show it in the navigation
+    """
+    page_cache.purge(f'author:{instance.user_id}', page_cache.viewer_tag(instance.user_id))
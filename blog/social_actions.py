@@ -0,0 +1,161 @@
+"""
+Batched likes and follows for the ``bulk_actions`` endpoint.
+
+A client sends a list of ``{"type", "target", "desired_state"}`` actions,
+for example a mobile app replaying interactions it queued while offline.
+Each action sets a state instead of toggling it, so replaying a batch is
+harmless. All actions are applied in one transaction, with a few
+set-based queries per action type, and the resulting states and counts
+come back in one response.
+
+Action types and their targets:
+
+- ``like_post``: a post slug
+- ``like_comment``: a comment id
+- ``follow``: a username
+"""
+import logging
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+from django.db.models import Count
+
+from . import like_buffer, page_cache, timeline
+from .models import Comment, Follow, LikeEvent, Post
+from .viewer_state import update_following
+
+logger = logging.getLogger(__name__)
+
+LIKE_POST = 'like_post'
+LIKE_COMMENT = 'like_comment'
+FOLLOW = 'follow'
+ACTION_TYPES = (LIKE_POST, LIKE_COMMENT, FOLLOW)
+MAX_ACTIONS = 100
+
+
+class InvalidActions(ValueError):
+    """
+    The request body is not a valid list of actions
+    """
+
+
+def parse(payload):
+    """
+    Validate a decoded request body into ``{(type, target): desired_state}``.
+
+    Later actions on the same target override earlier ones, as if they
+    had been sent one by one.
+    """
+    actions = payload.get('actions') if isinstance(payload, dict) else None
+    if not isinstance(actions, list):
+        raise InvalidActions('Expected {"actions": [...]}')
+    if len(actions) > MAX_ACTIONS:
+        raise InvalidActions(f'At most {MAX_ACTIONS} actions per request')
+
+    parsed = {}
+    for index, action in enumerate(actions):
+        if not isinstance(action, dict):
+            raise InvalidActions(f'Action {index} is not an object')
+        action_type = action.get('type')
+        target = action.get('target')
+        desired_state = action.get('desired_state')
+        if action_type not in ACTION_TYPES:
+            raise InvalidActions(f'Action {index} has an unknown type; expected one of {", ".join(ACTION_TYPES)}')
+        if not isinstance(desired_state, bool):
+            raise InvalidActions(f'Action {index} needs a boolean desired_state')
+        if action_type == LIKE_COMMENT:
+            if isinstance(target, bool) or not isinstance(target, (int, str)) or not str(target).isdigit():
+                raise InvalidActions(f'Action {index} needs a comment id as target')
+            target = int(target)
+        elif not isinstance(target, str) or not target:
+            raise InvalidActions(f'Action {index} needs a {"slug" if action_type == LIKE_POST else "username"} as target')
+        parsed.pop((action_type, target), None)
+        parsed[action_type, target] = desired_state
+    return parsed
+
+
+def apply(request, actions):
+    """
+    Apply parsed actions for the signed-in user.
+
+    Returns one result per action: ``{type, target, state, count}``, where
+    count is the target's (optimistic) likes or followers count, or
+    ``{type, target, error}`` for targets that can't be acted on.
+    """
+    user = request.user
+    wanted = defaultdict(dict)
+    for (action_type, target), desired_state in actions.items():
+        wanted[action_type][target] = desired_state
+
+    # Map each action's target to a primary key
+    post_ids = dict(Post.objects.filter(slug__in=wanted[LIKE_POST]).values_list('slug', 'pk'))
+    comment_ids = {pk: pk for pk in Comment.objects.filter(pk__in=wanted[LIKE_COMMENT]).values_list('pk', flat=True)}
+    user_ids = dict(User.objects.filter(username__in=wanted[FOLLOW]).values_list('username', 'pk'))
+    user_ids.pop(user.username, None)
+    resolved = {LIKE_POST: post_ids, LIKE_COMMENT: comment_ids, FOLLOW: user_ids}
+
+    def desired(action_type):
+        ids = resolved[action_type]
+        return {ids[target]: state for target, state in wanted[action_type].items() if target in ids}
+
+    with transaction.atomic():
+        like_buffer.set_states(user, {LikeEvent.POST: desired(LIKE_POST), LikeEvent.COMMENT: desired(LIKE_COMMENT)})
+        followed = set_follows(user, desired(FOLLOW))
+    for following_id, following in followed.items():
+        update_following(request, following_id, following)
+
+    try:
+        like_buffer.maybe_flush()
+    except DatabaseError:
+        logger.warning('Could not flush buffered likes', exc_info=True)
+
+    counts = {
+        LIKE_POST: like_buffer.optimistic_counts(LikeEvent.POST, post_ids.values()),
+        LIKE_COMMENT: like_buffer.optimistic_counts(LikeEvent.COMMENT, comment_ids.values()),
+        FOLLOW: follower_counts(user_ids.values()),
+    }
+    results = []
+    for (action_type, target), desired_state in actions.items():
+        pk = resolved[action_type].get(target)
+        if pk is None:
+            error = 'You cannot follow yourself' if action_type == FOLLOW and target == user.username else 'Not found'
+            results.append({'type': action_type, 'target': target, 'error': error})
+        else:
+            results.append({
+                'type': action_type,
+                'target': target,
+                'state': desired_state,
+                'count': counts[action_type].get(pk, 0),
+            })
+    return results
+
+
+def set_follows(user, wanted):
+    """
+    Follow or unfollow users by id; returns the follows that changed
+    """
+    current = set(Follow.objects.filter(follower=user, following_id__in=wanted).values_list('following_id', flat=True))
+    added = [following_id for following_id, state in wanted.items() if state and following_id not in current]
+    removed = [following_id for following_id, state in wanted.items() if not state and following_id in current]
+
+    Follow.objects.bulk_create([Follow(follower=user, following_id=following_id) for following_id in added], ignore_conflicts=True)
+    if added:
+        # bulk_create skips the post_save receivers that fill the timeline and expire profiles
+        timeline.backfill(user.pk, *added)
+        page_cache.purge(f'author:{user.pk}', *(f'author:{following_id}' for following_id in added))
+    if removed:
+        # Deleting through the ORM still runs the receivers that trim the timeline
+        Follow.objects.filter(follower=user, following_id__in=removed).delete()
+
+    changed = dict.fromkeys(added, True)
+    changed.update(dict.fromkeys(removed, False))
+    return changed
+
+
+def follower_counts(user_ids):
+    counts = (
+        Follow.objects.filter(following_id__in=user_ids).order_by()
+        .values('following_id').annotate(total=Count('*')).values_list('following_id', 'total')
+    )
+    return dict(counts)
@@ -0,0 +1,13 @@
+from django import template
+
+from blog import card_cache
+
+register = template.Library()
+
+
+@register.simple_tag
+def post_card(post):
+    """
+    Render a post card through the fragment cache
+    """
+    return card_cache.render_card(post)
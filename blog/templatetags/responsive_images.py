@@ -0,0 +1,26 @@
+from django import template
+
+from blog import images
+
+register = template.Library()
+
+
+@register.inclusion_tag('partials/responsive_image.html')
+def responsive_image(image, derivatives, sizes, alt='', css_class='', loading='lazy'):
+    """
+    An ``<img>`` with WebP and JPEG srcsets from the image's derivatives
+    (see blog.images), or of the original until they are rendered
+    """
+    return {**images.sources(image, derivatives), 'sizes': sizes, 'alt': alt, 'css_class': css_class, 'loading': loading}
+
+
+@register.inclusion_tag('partials/responsive_image.html')
+def avatar(profile, size, alt='', css_class='', loading='lazy'):
+    """
+    A user's avatar shown size CSS pixels wide
+    """
+    if profile.avatar:
+        context = images.sources(profile.avatar, profile.avatar_derivatives)
+    else:
+        context = {'src': profile.get_avatar_url(), 'srcset': {}, 'width': None, 'height': None}
+    return {**context, 'sizes': f'{size}px', 'alt': alt, 'css_class': css_class, 'loading': loading}
@@ -1,3 +1,1453 @@
-from django.test import TestCase
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
\ No newline at end of file
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    archive, benchmark, card_cache, conditional, genres, images, like_buffer, metrics, page_cache, related, search,
+    session_store, social_actions, tiered_cache, timeline, urls, viewer_state,
+)
+from .models import Comment, CommentLike, Follow, Genre, LikeEvent, Post, PostLike, RelatedPost, TimelineEntry, UserProfile
+from .pagination import CursorPaginator
+from .query_budget import BUDGETS, QueryBudgetAssertions
+from .tiered_cache import LocalLRU, TieredCache
+
+TEST_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+HOT_TABLES = ('blog_post', 'blog_comment', 'blog_follow', 'blog_timelineentry')
+
+
+def build_viewer_snapshot(client, user):
+    """
+    Store the signed-in user's session snapshot, as every request of a
+    session but its first finds it: QUERY_BUDGETS leave out its rebuild
+    """
+    session = client.session
+    session[viewer_state.SNAPSHOT_SESSION_KEY] = viewer_state.build_snapshot(user, time.time())
+    session.save()
+
+
+class CapturedQueries:
+    """
+    Execute wrapper recording the SQL and params of every SELECT
+    """
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT'):
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class QueryPlanTests(TestCase):
+    """
+    Every query the list and detail views run against the hot tables must
+    be answered from an index rather than a full table scan.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.genre = Genre.objects.create(name='Adventure')
+        other_genre = Genre.objects.create(name='Comedy')
+        cls.author = User.objects.create_user(username='sandy', password='pw')
+        cls.reader = User.objects.create_user(username='patrick', password='pw')
+        Follow.objects.create(follower=cls.reader, following=cls.author)
+        for i in range(30):
+            Post.objects.create(
+                title=f'Post {i}', content='Jellyfishing ' * 20, author=cls.author,
+                genre=cls.genre if i % 2 else other_genre, is_published=i % 5 != 0,
+            )
+        cls.post = Post.objects.filter(genre=cls.genre, is_published=True).first()
+        for i in range(12):
+            root = Comment.objects.create(post=cls.post, author=cls.reader, content=f'Comment {i}')
+            Comment.objects.create(post=cls.post, author=cls.author, content='Reply', parent=root)
+
+    def setUp(self):
+        self.client.force_login(self.reader)
+        # Write queued sessions inside the test's transaction, not after the test database is gone
+        self.addCleanup(session_store.flush)
+        build_viewer_snapshot(self.client, self.reader)
+
+    def query_plan(self, sql, params):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Tiny test tables would otherwise always be read sequentially
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                return self._postgresql_scans(cursor.fetchone()[0][0]['Plan'])
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def _postgresql_scans(self, node):
+        steps = []
+        if node['Node Type'] == 'Seq Scan':
+            steps.append(f"SCAN {node['Relation Name']}")
+        for child in node.get('Plans', []):
+            steps.extend(self._postgresql_scans(child))
+        return steps
+
+    def assertViewUsesIndexes(self, url):
+        captured = CapturedQueries()
+        with connection.execute_wrapper(captured):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # A bare "SCAN table" (no USING INDEX) reads every row of the table
+        full_scan = re.compile(r'^SCAN (%s)(?! USING)\b' % '|'.join(HOT_TABLES))
+        for sql, params in captured.queries:
+            if not any(f'"{table}"' in sql for table in HOT_TABLES):
+                continue
+            for step in self.query_plan(sql, params):
+                self.assertIsNone(full_scan.match(step), f'{step}\n{sql}')
+        return response
+
+    def test_home(self):
+        response = self.assertViewUsesIndexes(reverse('blog:home'))
+        self.assertViewUsesIndexes(f"{reverse('blog:home')}?cursor={response.context['page_obj'].next_cursor}")
+
+    def test_genre_posts(self):
+        self.assertViewUsesIndexes(reverse('blog:genre_posts', args=[self.genre.slug]))
+
+    def test_user_profile(self):
+        self.assertViewUsesIndexes(reverse('blog:user_profile', args=[self.author.username]))
+
+    def test_following_feed(self):
+        self.assertViewUsesIndexes(reverse('blog:following_feed'))
+
+    def test_following_feed_with_read_time_authors(self):
+        UserProfile.objects.filter(user=self.author).update(fanout_on_read=True)
+        url = reverse('blog:following_feed')
+        captured = CapturedQueries()
+        with connection.execute_wrapper(captured):
+            response = self.assertViewUsesIndexes(url)
+        self.assertEqual(len(response.context['posts']), 8)
+        # Two range scans, one on each index, rather than one query ORing them
+        feed_queries = [(sql, params) for sql, params in captured.queries if 'ORDER BY' in sql and '"blog_post"."title"' in sql]
+        self.assertEqual(len(feed_queries), 2)
+        plans = ' '.join(' '.join(self.query_plan(sql, params)) for sql, params in feed_queries)
+        if connection.vendor == 'sqlite':
+            self.assertIn('blog_timeline_feed_idx', plans)
+            self.assertIn('blog_post_author_idx', plans)
+        self.assertViewUsesIndexes(f"{url}?cursor={response.context['page_obj'].next_cursor}")
+
+    def test_post_detail(self):
+        self.assertViewUsesIndexes(reverse('blog:post_detail', args=[self.post.slug]))
+
+    def test_comment_pages(self):
+        response = self.assertViewUsesIndexes(reverse('blog:comment_page', args=[self.post.slug]))
+        cursor = json.loads(response.content)['next_cursor']
+        self.assertViewUsesIndexes(f"{reverse('blog:comment_page', args=[self.post.slug])}?cursor={cursor}")
+
+
+LOCAL_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'query-budget-{alias}'}
+    for alias in ('default', 'shared', 'sessions')
+}
+
+# LOCAL_CACHES with the TieredCache in front, for tests of its single-flight
+TIERED_CACHES = {
+    **LOCAL_CACHES,
+    'default': {'BACKEND': 'blog.tiered_cache.TieredCache', 'OPTIONS': {'L2': 'shared', 'LOCK_TIMEOUT': 5}},
+}
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=LOCAL_CACHES)
+class QueryBudgetTests(QueryBudgetAssertions, TestCase):
+    """
+    Every blog URL stays within its QUERY_BUDGETS entry with cold caches,
+    and never repeats a query shape (an N+1). CACHES is pinned to locmem so
+    that clearing them leaves the developer's file caches alone.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        genres = [Genre.objects.create(name=name) for name in ('Adventure', 'Comedy')]
+        cls.genre = genres[0]
+        cls.reader = User.objects.create_user(username='patrick', password='pw', is_staff=True)
+        authors = [User.objects.create_user(username=f'author{i}', password='pw') for i in range(4)]
+        cls.author = authors[0]
+        for author in authors:
+            Follow.objects.create(follower=cls.reader, following=author)
+        for i in range(24):
+            Post.objects.create(
+                title=f'Krabby Patty {i}', content='Secret formula ' * 20,
+                author=authors[i % len(authors)] if i else cls.reader, genre=genres[i % 2],
+            )
+        cls.own_post = Post.objects.get(author=cls.reader)
+        cls.post = Post.objects.filter(genre=cls.genre).exclude(author=cls.reader).first()
+        for i in range(12):
+            root = Comment.objects.create(post=cls.post, author=authors[i % len(authors)], content=f'Comment {i}')
+            for j in range(3):
+                Comment.objects.create(post=cls.post, author=authors[j], content='Reply', parent=root)
+        cls.comment = Comment.objects.filter(post=cls.post, parent=None).first()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.reader)
+        self.addCleanup(session_store.flush)
+        build_viewer_snapshot(self.client, self.reader)
+
+    def requests(self):
+        """
+        ``{url name: (method, url, client kwargs)}`` for every blog URL
+        """
+        post, own_post, comment = self.post, self.own_post, self.comment
+        actions = [
+            {'type': 'like_post', 'target': post.slug, 'desired_state': True},
+            {'type': 'like_comment', 'target': comment.pk, 'desired_state': True},
+            {'type': 'follow', 'target': self.author.username, 'desired_state': False},
+        ]
+        return {
+            'home': ('get', reverse('blog:home'), {}),
+            'post_detail': ('get', reverse('blog:post_detail', args=[post.slug]), {}),
+            'genre_posts': ('get', reverse('blog:genre_posts', args=[self.genre.slug]), {}),
+            'following_feed': ('get', reverse('blog:following_feed'), {}),
+            'search': ('get', f"{reverse('blog:search')}?q=patty", {}),
+            'site_feed': ('get', reverse('blog:site_feed', args=['rss']), {}),
+            'genre_feed': ('get', reverse('blog:genre_feed', args=[self.genre.slug, 'atom']), {}),
+            'author_feed': ('get', reverse('blog:author_feed', args=[self.author.username, 'rss']), {}),
+            'home_posts': ('get', reverse('blog:home_posts'), {}),
+            'genre_posts_fragment': ('get', reverse('blog:genre_posts_fragment', args=[self.genre.slug]), {}),
+            'following_feed_fragment': ('get', reverse('blog:following_feed_fragment'), {}),
+            'create_post': ('get', reverse('blog:create_post'), {}),
+            'edit_post': ('get', reverse('blog:edit_post', args=[own_post.slug]), {}),
+            'delete_post': ('get', reverse('blog:delete_post', args=[own_post.slug]), {}),
+            'user_profile': ('get', reverse('blog:user_profile', args=[self.author.username]), {}),
+            'export_author': ('get', reverse('blog:export_author', args=[self.reader.username]), {}),
+            'like_post': ('post', reverse('blog:like_post', args=[post.slug]), {}),
+            'like_comment': ('post', reverse('blog:like_comment', args=[comment.pk]), {}),
+            'follow_user': ('post', reverse('blog:follow_user', args=[self.author.username]), {}),
+            'bulk_actions': ('post', reverse('blog:bulk_actions'), {
+                'data': json.dumps({'actions': actions}), 'content_type': 'application/json',
+            }),
+            'toggle_dark_mode': ('post', reverse('blog:toggle_dark_mode'), {
+                'data': json.dumps({'dark_mode': True}), 'content_type': 'application/json',
+            }),
+            'cache_stats': ('get', reverse('blog:cache_stats'), {}),
+            'add_comment': ('post', reverse('blog:add_comment', args=[post.slug]), {'data': {'content': 'Tartar sauce!'}}),
+            'comment_page': ('get', reverse('blog:comment_page', args=[post.slug]), {}),
+            'comment_replies': ('get', reverse('blog:comment_replies', args=[post.slug, comment.pk]), {}),
+            'metrics': ('get', reverse('blog:metrics'), {}),
+        }
+
+    def test_every_url_has_a_budget(self):
+        names = {f'{urls.app_name}:{pattern.name}' for pattern in urls.urlpatterns}
+        self.assertEqual(names - set(BUDGETS), set())
+        self.assertEqual({f'{urls.app_name}:{name}' for name in self.requests()}, names)
+
+    def test_query_budgets(self):
+        for name, (method, url, kwargs) in self.requests().items():
+            with self.subTest(name):
+                cache.clear()
+                response = self.assertWithinQueryBudget(url, method, **kwargs)
+                self.assertLess(response.status_code, 400)
+
+
+class LikeBufferStressTests(TransactionTestCase):
+    """
+    Concurrent likes, unlikes and flushes must converge: once the buffer is
+    drained, the like rows match every user's last toggle and each counter
+    matches its rows.
+    """
+    THREADS = 6
+    TOGGLES = 30
+
+    def setUp(self):
+        cache.delete(like_buffer.THROTTLE_KEY)
+        author = User.objects.create_user(username='plankton', password='pw')
+        genre = Genre.objects.create(name='Schemes')
+        self.posts = [
+            Post.objects.create(title=f'Formula {i}', content='Secret', author=author, genre=genre)
+            for i in range(3)
+        ]
+        self.comments = [
+            Comment.objects.create(post=self.posts[0], author=author, content=f'Plan {i}')
+            for i in range(3)
+        ]
+        self.users = [User.objects.create_user(username=f'customer{i}', password='pw') for i in range(self.THREADS)]
+
+    def toggle_randomly(self, user, seed, expected, errors):
+        rng = random.Random(seed)
+        try:
+            for _ in range(self.TOGGLES):
+                target = rng.choice(self.posts + self.comments)
+                target = type(target).objects.get(pk=target.pk)
+                liked, likes_count = like_buffer.toggle(user, target)
+                self.assertGreaterEqual(likes_count, 0)
+                # Read-your-writes: the viewer's next read sees their toggle
+                self.assertEqual(like_buffer.is_liked(user, like_buffer._kind(target), target.pk), liked)
+                expected[type(target), user.pk, target.pk] = liked
+                if rng.random() < 0.2:
+                    try:
+                        like_buffer.flush()
+                    except DatabaseError:
+                        # Lost a lock race (SQLite); the events wait for the next flush
+                        pass
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connection.close()
+
+    def test_concurrent_toggles_converge(self):
+        expected = {}
+        errors = []
+        threads = [
+            threading.Thread(target=self.toggle_randomly, args=(user, seed, expected, errors))
+            for seed, user in enumerate(self.users)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        self.assertIsNotNone(like_buffer.flush())
+        self.assertFalse(LikeEvent.objects.exists())
+
+        for (model, user_id, target_id), liked in expected.items():
+            if model is Post:
+                exists = PostLike.objects.filter(user_id=user_id, post_id=target_id).exists()
+            else:
+                exists = CommentLike.objects.filter(user_id=user_id, comment_id=target_id).exists()
+            self.assertEqual(exists, liked, (model.__name__, user_id, target_id))
+        for post in Post.objects.filter(pk__in=[post.pk for post in self.posts]):
+            self.assertEqual(post.likes_count, PostLike.objects.filter(post=post).count())
+        for comment in Comment.objects.filter(pk__in=[comment.pk for comment in self.comments]):
+            self.assertEqual(comment.likes_count, CommentLike.objects.filter(comment=comment).count())
+
+    def test_overlapping_flushes_apply_each_event_once(self):
+        post, other = self.posts[:2]
+        for user in self.users[:4]:
+            LikeEvent.objects.create(kind=LikeEvent.POST, user=user, target_id=post.pk, liked=True, delta=1)
+        liked = LikeEvent.objects.create(kind=LikeEvent.POST, user=self.users[0], target_id=other.pk, liked=True, delta=1)
+        LikeEvent.objects.create(
+            kind=LikeEvent.POST, user=self.users[0], target_id=other.pk, liked=False, delta=-1, previous_id=liked.pk,
+        )
+
+        # The first flush stops inside its batch, holding the lock, until the second has started
+        paused, release = threading.Event(), threading.Event()
+        apply = like_buffer._apply
+
+        def paused_apply(target, states):
+            paused.set()
+            release.wait(5)
+            return apply(target, states)
+
+        results = {}
+
+        def run(name):
+            try:
+                results[name] = like_buffer.flush()
+            except DatabaseError:
+                # SQLite gave up waiting for the first flush's write lock
+                results[name] = 'busy'
+            finally:
+                connection.close()
+
+        with mock.patch.object(like_buffer, '_apply', paused_apply):
+            first = threading.Thread(target=run, args=('first',))
+            first.start()
+            self.assertTrue(paused.wait(5))
+            second = threading.Thread(target=run, args=('second',))
+            second.start()
+            second.join(0.5)
+            release.set()
+            first.join()
+            second.join()
+
+        self.assertEqual(results['first'], 6)
+        self.assertIn(results['second'], (None, 0, 'busy'))
+        self.assertFalse(LikeEvent.objects.exists())
+        self.assertEqual(Post.objects.get(pk=post.pk).likes_count, 4)
+        self.assertEqual(PostLike.objects.filter(post=post).count(), 4)
+        self.assertFalse(PostLike.objects.filter(post=other).exists())
+        self.assertEqual(Post.objects.get(pk=other.pk).likes_count, 0)
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class ViewerSnapshotTests(TestCase):
+    """
+    Session snapshots of a user are dropped when their auth flags change.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='squidward', password='pw', is_staff=True)
+        self.client.force_login(self.user)
+        self.addCleanup(session_store.flush)
+
+    def test_demoted_user_loses_staff_access(self):
+        self.assertEqual(self.client.get(reverse('blog:cache_stats')).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = False
+            self.user.save()
+        self.assertEqual(self.client.get(reverse('blog:cache_stats')).status_code, 302)
+
+    def test_deactivated_user_is_signed_out(self):
+        self.client.get(reverse('blog:home'))
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.get(pk=self.user.pk).save(update_fields=['last_login'])
+        self.assertIsNotNone(self.client.session.get(viewer_state.SNAPSHOT_SESSION_KEY))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save(update_fields=['is_active'])
+        response = self.client.get(reverse('blog:following_feed'))
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(viewer_state.SNAPSHOT_SESSION_KEY, self.client.session)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=LOCAL_CACHES)
+class ConditionalPageTests(TestCase):
+    """
+    Revalidations of unchanged pages are answered with 304 Not Modified,
+    and any change the page depends on gives it new validators.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        genre = Genre.objects.create(name='Adventure')
+        cls.reader = User.objects.create_user(username='patrick', password='pw')
+        author = User.objects.create_user(username='sandy', password='pw')
+        cls.post = Post.objects.create(title='Karate', content='Hi-yah!', author=author, genre=genre)
+        cls.url = reverse('blog:post_detail', args=[cls.post.slug])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.reader)
+        self.addCleanup(session_store.flush)
+
+    def test_unchanged_page_is_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_viewer_purge_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            page_cache.purge(page_cache.viewer_tag(self.reader.pk))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_new_csrf_secret_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = 'b' * 32
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_pending_message_bypasses_validators(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.cookies[page_cache.MESSAGES_COOKIE_NAME] = 'flash'
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+    def test_unchanged_tags_are_not_rewritten(self):
+        self.client.get(self.url)
+        with mock.patch.object(conditional, 'cache', wraps=cache) as spy:
+            self.client.get(self.url)
+        self.assertEqual(spy.set.call_count, 0)
+
+    def test_anonymous_page_is_cached_on_first_render(self):
+        self.client.logout()
+        home = reverse('blog:home')
+        self.assertEqual(self.client.get(home)['X-Page-Cache'], 'MISS')
+        response = self.client.get(home)
+        self.assertEqual(response['X-Page-Cache'], 'HIT')
+        self.assertEqual(self.client.get(home, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TIERED_CACHES)
+class PageCacheTests(TestCase):
+    """
+    Anonymous pages are served from the cache until one of their tags is
+    purged, a stale page is re-rendered by one request at a time, and
+    nothing personal is stored.
+    """
+    def setUp(self):
+        cache.clear()
+        self.renders = 0
+
+    def view(self, request, **headers):
+        page_cache.tag(request, 'post:1')
+        self.renders += 1
+        response = HttpResponse(f'Render {self.renders}')
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    def fetch(self, view=None, path='/'):
+        return page_cache.fetch(RequestFactory().get(path), view or self.view)
+
+    def purge(self, *tags):
+        with self.captureOnCommitCallbacks(execute=True):
+            page_cache.purge(*tags)
+
+    def test_page_is_served_until_a_tag_is_purged(self):
+        response, from_cache = self.fetch()
+        self.assertEqual((response['X-Page-Cache'], from_cache), ('MISS', False))
+        response, from_cache = self.fetch()
+        self.assertEqual((response['X-Page-Cache'], response.content, from_cache), ('HIT', b'Render 1', True))
+
+        self.purge('post:2')
+        self.assertEqual(self.fetch()[0].content, b'Render 1')
+        self.purge('post:1')
+        response, from_cache = self.fetch()
+        self.assertEqual((response.content, from_cache), (b'Render 2', False))
+        self.assertEqual(self.fetch()[0]['X-Page-Cache'], 'HIT')
+        self.assertEqual(self.renders, 2)
+
+    def test_personal_responses_are_not_stored(self):
+        def sets_cookie(request):
+            response = self.view(request)
+            response.set_cookie('theme', 'dark')
+            return response
+
+        def uses_csrf(request):
+            request.META['CSRF_COOKIE_NEEDS_UPDATE'] = True
+            return self.view(request)
+
+        def private(request):
+            return self.view(request, **{'Cache-Control': 'private'})
+
+        for view in (sets_cookie, uses_csrf, private):
+            with self.subTest(view.__name__):
+                self.renders = 0
+                for _ in range(2):
+                    response, from_cache = self.fetch(view, path=f'/{view.__name__}/')
+                    self.assertFalse(from_cache)
+                    self.assertNotIn('X-Page-Cache', response)
+                self.assertEqual(self.renders, 2)
+
+    def test_stale_page_is_served_while_one_request_revalidates(self):
+        self.fetch()
+        self.purge('post:1')
+        rendering, release = threading.Event(), threading.Event()
+        revalidated = []
+
+        def slow_view(request):
+            rendering.set()
+            release.wait(5)
+            return self.view(request)
+
+        revalidating = threading.Thread(target=lambda: revalidated.append(self.fetch(slow_view)))
+        revalidating.start()
+        self.assertTrue(rendering.wait(5))
+        response, from_cache = self.fetch()
+        release.set()
+        revalidating.join()
+
+        self.assertEqual((response['X-Page-Cache'], response.content, from_cache), ('STALE', b'Render 1', True))
+        self.assertEqual(revalidated[0][0].content, b'Render 2')
+
+        # From another thread, which has its own L1 as another worker would
+        elsewhere = threading.Thread(target=lambda: revalidated.append(self.fetch()))
+        elsewhere.start()
+        elsewhere.join()
+        self.assertEqual((revalidated[1][0]['X-Page-Cache'], revalidated[1][0].content), ('HIT', b'Render 2'))
+        self.assertEqual(self.renders, 2)
+
+    def test_moving_a_post_purges_both_genres(self):
+        adventure, comedy = Genre.objects.create(name='Adventure'), Genre.objects.create(name='Comedy')
+        author = User.objects.create_user(username='sandy', password='pw')
+        post = Post.objects.create(title='Karate', content='Hi-yah!', author=author, genre=adventure)
+        pages = [reverse('blog:genre_posts', args=[genre.slug]) for genre in (adventure, comedy)]
+        for page in pages:
+            self.client.get(page)
+            self.assertEqual(self.client.get(page)['X-Page-Cache'], 'HIT')
+
+        post = Post.objects.get(pk=post.pk)
+        post.genre = comedy
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            post.save()
+        # The stored state and the old genre's slug come from one query
+        self.assertEqual(sum(query['sql'].startswith('SELECT') for query in queries), 1)
+        for page in pages:
+            self.assertEqual(self.client.get(page)['X-Page-Cache'], 'MISS')
+
+    def test_pending_message_bypasses_the_cache(self):
+        home = reverse('blog:home')
+        self.client.get(home)
+        self.assertEqual(self.client.get(home)['X-Page-Cache'], 'HIT')
+        self.client.cookies[page_cache.MESSAGES_COOKIE_NAME] = 'flash'
+        self.assertNotIn('X-Page-Cache', self.client.get(home))
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=LOCAL_CACHES)
+class FeedTests(TestCase):
+    """
+    Feeds list the newest published posts, answer an unchanged poll with
+    304 Not Modified, and change as soon as a post is published.
+    """
+    def setUp(self):
+        cache.clear()
+        self.adventure, comedy = Genre.objects.create(name='Adventure'), Genre.objects.create(name='Comedy')
+        self.sandy = User.objects.create_user(username='sandy', password='pw', first_name='Sandy')
+        patrick = User.objects.create_user(username='patrick', password='pw')
+        Post.objects.create(title='Karate', content='Hi-yah!', author=self.sandy, genre=self.adventure)
+        Post.objects.create(title='Rock', content='Under it', author=patrick, genre=comedy)
+        self.draft = Post.objects.create(
+            title='Treedome', content='Air', author=self.sandy, genre=self.adventure, is_published=False,
+        )
+        self.url = reverse('blog:site_feed', args=['rss'])
+
+    def test_feeds_list_published_posts(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response['Content-Type'].startswith('application/rss+xml'))
+        self.assertContains(response, '<title>Karate</title>')
+        self.assertContains(response, '<title>Rock</title>')
+        self.assertNotContains(response, 'Treedome')
+
+        response = self.client.get(reverse('blog:genre_feed', args=[self.adventure.slug, 'atom']))
+        self.assertTrue(response['Content-Type'].startswith('application/atom+xml'))
+        self.assertContains(response, '<title>Karate</title>')
+        self.assertNotContains(response, '<title>Rock</title>')
+
+        response = self.client.get(reverse('blog:author_feed', args=['patrick', 'rss']))
+        self.assertContains(response, '<title>Rock</title>')
+        self.assertNotContains(response, '<title>Karate</title>')
+        self.assertEqual(self.client.get(reverse('blog:site_feed', args=['json'])).status_code, 404)
+
+    def test_unchanged_feed_is_not_modified(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(
+                self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304,
+            )
+
+    def test_publishing_a_post_changes_its_feeds(self):
+        urls = [self.url, reverse('blog:genre_feed', args=[self.adventure.slug, 'rss'])]
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.draft.is_published = True
+            self.draft.save()
+        for url, etag in zip(urls, etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, '<title>Treedome</title>')
+            self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class CounterTests(TestCase):
+    """
+    Like and comment counters follow every change, a cascade recounts each
+    surviving target once, and recount_counters repairs drift.
+    """
+    def setUp(self):
+        genre = Genre.objects.create(name='Adventure')
+        self.author = User.objects.create_user(username='sandy', password='pw')
+        self.fan = User.objects.create_user(username='spongebob', password='pw')
+        self.other = User.objects.create_user(username='patrick', password='pw')
+        self.posts = [
+            Post.objects.create(title=f'Karate {i}', content='Hi-yah!', author=self.author, genre=genre)
+            for i in range(2)
+        ]
+        self.comment = Comment.objects.create(post=self.posts[0], author=self.other, content='Nice')
+        for user in (self.fan, self.other):
+            for post in self.posts:
+                PostLike.objects.create(user=user, post=post)
+            CommentLike.objects.create(user=user, comment=self.comment)
+        Comment.objects.create(post=self.posts[0], author=self.fan, content='Thanks', parent=self.comment)
+        Comment.objects.create(post=self.posts[1], author=self.fan, content='Wow')
+
+    def counters(self):
+        posts = Post.objects.filter(pk__in=[post.pk for post in self.posts]).order_by('pk')
+        return (
+            [(post.likes_count, post.comments_count) for post in posts],
+            Comment.objects.filter(pk=self.comment.pk).values_list('likes_count', flat=True).first(),
+        )
+
+    def test_direct_changes_adjust_counters(self):
+        self.assertEqual(self.counters(), ([(2, 1), (2, 1)], 2))
+        PostLike.objects.get(user=self.fan, post=self.posts[0]).delete()
+        CommentLike.objects.filter(user=self.fan).delete()
+        Comment.objects.filter(post=self.posts[1]).delete()
+        self.assertEqual(self.counters(), ([(1, 1), (2, 0)], 1))
+
+    def test_cascade_recounts_each_surviving_target_once(self):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.fan.delete()
+        self.assertEqual(self.counters(), ([(1, 1), (1, 0)], 1))
+        post_updates = [query for query in queries if query['sql'].startswith('UPDATE "blog_post"')]
+        self.assertEqual(len(post_updates), 1)
+
+    def test_deleted_post_is_not_updated(self):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.posts[0].delete()
+        self.assertFalse(any(query['sql'].startswith(('UPDATE "blog_post"', 'UPDATE "blog_comment"')) for query in queries))
+        self.assertEqual(self.counters(), ([(2, 1)], None))
+
+    def test_recount_counters_repairs_drift(self):
+        Post.objects.filter(pk=self.posts[0].pk).update(likes_count=7, comments_count=0)
+        Comment.objects.filter(pk=self.comment.pk).update(likes_count=0)
+        stdout = io.StringIO()
+        call_command('recount_counters', chunk_size=1, stdout=stdout)
+        self.assertIn('Posts: repaired 1 drifted rows', stdout.getvalue())
+        self.assertIn('Comments: repaired 1 drifted rows', stdout.getvalue())
+        self.assertEqual(self.counters(), ([(2, 1), (2, 1)], 2))
+
+
+class LikeBufferTests(TestCase):
+    """
+    A toggle costs two queries, survives a racing toggle, and flushes one batch at most.
+    """
+    def setUp(self):
+        cache.delete(like_buffer.THROTTLE_KEY)
+        author = User.objects.create_user(username='plankton', password='pw')
+        self.user = User.objects.create_user(username='karen', password='pw')
+        self.post = Post.objects.create(
+            title='Formula', content='Secret', author=author, genre=Genre.objects.create(name='Schemes'),
+        )
+
+    def assertStatements(self, count, function, *args):
+        """
+        Call function, which must run count statements besides the test transaction's savepoints
+        """
+        with CaptureQueriesContext(connection) as captured:
+            result = function(*args)
+        statements = [query['sql'] for query in captured.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), count, statements)
+        return result
+
+    def test_toggle_reads_state_and_count_in_one_query(self):
+        cache.set(like_buffer.THROTTLE_KEY, 1)
+        self.assertEqual(self.assertStatements(2, like_buffer.toggle, self.user, self.post), (True, 1))
+        self.assertEqual(self.assertStatements(2, like_buffer.toggle, self.user, self.post), (False, 0))
+
+    def test_racing_toggle_is_recorded_on_the_new_state(self):
+        cache.set(like_buffer.THROTTLE_KEY, 1)
+        toggle_state = like_buffer._toggle_state
+        calls = []
+
+        def raced(user, kind, target_id):
+            state = toggle_state(user, kind, target_id)
+            if not calls:
+                # Another request of the same user records its like between our read and insert
+                LikeEvent.objects.create(kind=kind, user=user, target_id=target_id, liked=True, delta=1)
+            calls.append(state)
+            return state
+
+        with mock.patch.object(like_buffer, '_toggle_state', raced):
+            liked, likes_count = like_buffer.toggle(self.user, self.post)
+        self.assertEqual((liked, likes_count, len(calls)), (False, 0, 2))
+        self.assertEqual(list(LikeEvent.objects.values_list('liked', flat=True)), [True, False])
+
+    def test_toggle_applies_at_most_one_batch(self):
+        for user in [User.objects.create_user(username=f'customer{i}', password='pw') for i in range(4)]:
+            LikeEvent.objects.create(kind=LikeEvent.POST, user=user, target_id=self.post.pk, liked=True, delta=1)
+        with mock.patch.object(like_buffer, 'BATCH_SIZE', 2):
+            self.assertEqual(like_buffer.toggle(self.user, self.post), (True, 5))
+        self.assertEqual(LikeEvent.objects.count(), 3)
+        self.assertEqual(like_buffer.flush(), 3)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).likes_count, 5)
+
+
+class SessionStoreTests(TestCase):
+    """
+    The write-behind session engine skips unchanged saves, batches the rest
+    and never loses a session to a failed write.
+    """
+    def setUp(self):
+        session_store.flush()
+        self.addCleanup(session_store.flush)
+        self.sessions = caches[settings.SESSION_CACHE_ALIAS]
+
+    def test_unchanged_session_is_not_rewritten(self):
+        session = session_store.SessionStore()
+        session['krabs'] = 'money'
+        session.create()
+        reloaded = session_store.SessionStore(session.session_key)
+        self.assertEqual(reloaded['krabs'], 'money')
+        with self.assertNumQueries(0):
+            reloaded.save()
+        self.assertEqual(len(session_store.queue), 0)
+
+        # Half the session's age left: under SESSION_REFRESH_RATIO
+        entry = self.sessions.get(reloaded.cache_key)
+        entry['expire_date'] = timezone.now() + timedelta(seconds=reloaded.get_expiry_age() // 2)
+        self.sessions.set(reloaded.cache_key, entry)
+        stale = session_store.SessionStore(session.session_key)
+        stale.load()
+        stale.save()
+        self.assertEqual(len(session_store.queue), 1)
+
+    def test_sessions_are_written_in_batches(self):
+        queue = session_store.WriteBehindQueue(batch_size=3, interval=3600)
+        expire_date = timezone.now() + timedelta(days=1)
+        for i in range(2):
+            queue.put(f'bikini{i}', 'data', expire_date)
+        self.assertFalse(Session.objects.filter(session_key__startswith='bikini').exists())
+        with CaptureQueriesContext(connection) as queries:
+            queue.put('bikini2', 'data', expire_date)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(Session.objects.filter(session_key__startswith='bikini').count(), 3)
+        self.assertEqual(len(queue), 0)
+
+    def test_failed_write_is_requeued(self):
+        queue = session_store.WriteBehindQueue(batch_size=1, interval=3600)
+        expire_date = timezone.now() + timedelta(days=1)
+        with mock.patch.object(Session.objects, 'bulk_create', side_effect=DatabaseError('locked')):
+            with self.assertLogs('blog.session_store', 'WARNING'):
+                queue.put('gary', 'meow', expire_date)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.flush(), 1)
+        self.assertEqual(Session.objects.get(session_key='gary').session_data, 'meow')
+
+    @override_settings(STORAGES=TEST_STORAGES)
+    def test_any_request_drains_a_due_queue(self):
+        session_store.queue.put('plankton', 'chum', timezone.now() + timedelta(days=1))
+        self.assertEqual(len(session_store.queue), 1)
+        with mock.patch.object(session_store.queue, 'interval', 0):
+            self.client.get(reverse('blog:home'))
+        self.assertTrue(Session.objects.filter(session_key='plankton').exists())
+
+    def test_login_and_logout_write_through(self):
+        user = User.objects.create_user(username='pearl', password='pw')
+        self.client.login(username=user.username, password='pw')
+        session_key = self.client.session.session_key
+        self.assertTrue(Session.objects.filter(session_key=session_key).exists())
+        self.client.logout()
+        self.assertFalse(Session.objects.filter(session_key=session_key).exists())
+        self.assertEqual(len(session_store.queue), 0)
+
+
+class SearchTests(TestCase):
+    """
+    Posts are found through the full-text index, best match first, and
+    paged by (score, id) without gaps or repeats.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.genre = Genre.objects.create(name='Adventure')
+        cls.author = User.objects.create_user(username='sandy', password='pw')
+
+    def post(self, title, content='Treedome'):
+        return Post.objects.create(title=title, content=content, author=self.author, genre=self.genre)
+
+    def found(self, query, **kwargs):
+        return [post.pk for post in search.search_posts(query, **kwargs)[0]]
+
+    def test_saves_and_deletes_update_the_index(self):
+        post = self.post('Karate chop')
+        self.assertEqual(self.found('karate'), [post.pk])
+        post.title = 'Squirrel jokes'
+        post.save()
+        self.assertEqual(self.found('karate'), [])
+        self.assertEqual(self.found('squirrel'), [post.pk])
+        post.delete()
+        self.assertEqual(self.found('squirrel'), [])
+
+    def test_last_word_matches_as_prefix(self):
+        post = self.post('Jellyfishing at dawn')
+        self.assertEqual(self.found('jelly'), [post.pk])
+        self.assertEqual(self.found('jelly dawn'), [])
+        self.assertEqual(self.found('dawn jelly'), [post.pk])
+
+    def test_title_matches_rank_first(self):
+        in_content = self.post('Bubbles', content='Karate in the treedome')
+        in_title = self.post('Karate', content='Bubbles in the treedome')
+        self.assertEqual(self.found('karate'), [in_title.pk, in_content.pk])
+
+    def test_cursor_pages_through_tied_scores(self):
+        posts = [self.post(f'Krabby patty {i}', content='Secret formula') for i in range(7)]
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = search.search_posts('formula', cursor=cursor, page_size=3)
+            seen.extend(post.pk for post in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, sorted((post.pk for post in posts), reverse=True))
+
+    def test_snippets_escape_content_and_mark_matches(self):
+        self.post('Recipe', content='<script>krabby</script> patty')
+        (post,), _ = search.search_posts('patty')
+        self.assertIn('<mark>patty</mark>', post.snippet)
+        self.assertNotIn('<script>', post.snippet)
+
+    def test_admin_search_keeps_username_substrings(self):
+        post = self.post('Karate chop')
+        post_admin = admin.site._registry[Post]
+        results, _ = post_admin.get_search_results(None, Post.objects.all(), 'sand karate')
+        self.assertEqual(list(results), [post])
+
+
+@mock.patch.object(timeline, 'MAX_LENGTH', 3)
+@mock.patch.object(timeline, 'BACKFILL', 2)
+@mock.patch.object(timeline, 'FANOUT_LIMIT', 2)
+class TimelineTests(TestCase):
+    """
+    Timelines stay trimmed, and authors switch fan-out mode by follower count.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.genre = Genre.objects.create(name='Adventure')
+        cls.author = User.objects.create_user(username='sandy', password='pw')
+        cls.readers = [User.objects.create_user(username=f'reader{i}', password='pw') for i in range(3)]
+
+    def publish(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(count):
+                Post.objects.create(title=f'Post {i}', content='Jellyfishing', author=self.author, genre=self.genre)
+
+    def test_fan_out_trims_timelines(self):
+        Follow.objects.create(follower=self.readers[0], following=self.author)
+        self.publish(5)
+        newest = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True)[:3])
+        self.assertCountEqual(
+            TimelineEntry.objects.filter(user=self.readers[0]).values_list('post_id', flat=True), newest,
+        )
+
+    def test_refresh_switches_both_ways(self):
+        self.publish(3)
+        for reader in self.readers:
+            Follow.objects.create(follower=reader, following=self.author)
+        self.assertEqual(timeline.refresh_fanout_modes(), (1, 0))
+        self.assertTrue(UserProfile.objects.get(user=self.author).fanout_on_read)
+
+        Follow.objects.filter(following=self.author).delete()
+        Follow.objects.create(follower=self.readers[0], following=self.author)
+        self.assertEqual(timeline.refresh_fanout_modes(), (0, 1))
+        self.assertFalse(UserProfile.objects.get(user=self.author).fanout_on_read)
+        self.assertEqual(TimelineEntry.objects.filter(user=self.readers[0]).count(), 2)
+        self.assertEqual(timeline.feed_queryset(self.readers[0]).count(), 2)
+
+    def test_following_several_authors_backfills_once(self):
+        other = User.objects.create_user(username='gary', password='pw')
+        with self.captureOnCommitCallbacks(execute=True):
+            for author in (self.author, other):
+                for i in range(2):
+                    Post.objects.create(title=f'{author.username} {i}', content='Meow', author=author, genre=self.genre)
+        with CaptureQueriesContext(connection) as queries:
+            social_actions.set_follows(self.readers[0], {self.author.pk: True, other.pk: True})
+        backfills = [query for query in queries if query['sql'].startswith('INSERT INTO blog_timelineentry')]
+        self.assertEqual(len(backfills), 1)
+        newest = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True)[:3])
+        self.assertCountEqual(
+            TimelineEntry.objects.filter(user=self.readers[0]).values_list('post_id', flat=True), newest,
+        )
+
+    def test_feed_merges_read_time_authors(self):
+        reader = self.readers[0]
+        popular = User.objects.create_user(username='krabs', password='pw')
+        UserProfile.objects.filter(user=popular).update(fanout_on_read=True)
+        Follow.objects.create(follower=reader, following=self.author)
+        Follow.objects.create(follower=reader, following=popular)
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3):
+                Post.objects.create(title=f'Money {i}', content='Money', author=popular, genre=self.genre)
+                Post.objects.create(title=f'Karate {i}', content='Karate', author=self.author, genre=self.genre)
+        newest = list(Post.objects.order_by('-created_at', '-id'))
+
+        paginator = CursorPaginator(timeline.feed_queryset(reader), 4, keys=('feed_at', 'id'))
+        first = paginator.page()
+        second = paginator.page(first.next_cursor)
+        self.assertEqual(list(first) + list(second), newest)
+        self.assertFalse(second.has_next())
+
+
+class CardCacheTests(TestCase):
+    """
+    Patching the per-viewer parts into a cached card leaves the post's own text alone.
+    """
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='sandy', password='pw')
+        self.genre = Genre.objects.create(name='Adventure')
+
+    def test_text_resembling_placeholders_is_kept(self):
+        for title in ('Fixing like-icon created-ago bugs', f'Private {card_cache.LIKE_ICON_PLACEHOLDER} use'):
+            post = Post.objects.create(title=title, content='Jellyfishing', author=self.author, genre=self.genre)
+            for _ in range(2):
+                html = card_cache.render_card(Post.objects.get(pk=post.pk))
+                self.assertIn(title, html)
+                self.assertIn(post.slug, html)
+                self.assertNotIn(card_cache.CREATED_AGO_PLACEHOLDER, html)
+
+
+class GenreRegistryTests(TestCase):
+    """
+    Post saves reload the genre registry only when a genre's post count may change.
+    """
+    def test_bumps_only_on_count_changes(self):
+        genre = Genre.objects.create(name='Adventure')
+        other_genre = Genre.objects.create(name='Comedy')
+        author = User.objects.create_user(username='sandy', password='pw')
+        with mock.patch.object(genres, 'bump') as bump:
+            post = Post.objects.create(title='Jellyfishing', content='Jellyfishing', author=author, genre=genre)
+            self.assertEqual(bump.call_count, 1)
+            post.title = 'Jellyfishing, again'
+            post.save()
+            post.likes_count += 1
+            post.save(update_fields=['likes_count'])
+            self.assertEqual(bump.call_count, 1)
+            post.genre = other_genre
+            post.save()
+            self.assertEqual(bump.call_count, 2)
+            post.is_published = False
+            post.save()
+            self.assertEqual(bump.call_count, 3)
+            post.delete()
+            self.assertEqual(bump.call_count, 4)
+
+
+class RelatedPostsTests(TestCase):
+    """
+    Every built post stores neighbours, falling back to its genre's newest
+    posts, and saved posts are updated against the stored matrix.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = mock.patch.object(related, 'MATRIX_PATH', f'{directory}/related-posts.npz')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_posts_without_shared_terms_store_genre_posts(self):
+        genre = Genre.objects.create(name='Adventure')
+        other_genre = Genre.objects.create(name='Comedy')
+        author = User.objects.create_user(username='sandy', password='pw')
+        jellyfishing = [
+            Post.objects.create(title=f'Jellyfishing {i}', content='Jellyfishing nets at dawn', author=author, genre=genre)
+            for i in range(2)
+        ]
+        loner = Post.objects.create(title='Karate', content='Chopping boards', author=author, genre=genre)
+        Post.objects.create(title='Krabby', content='Patties', author=author, genre=other_genre)
+        Post.objects.create(title='Bubbles', content='Blowing', author=author, genre=other_genre)
+
+        self.assertEqual(related.build_related_posts(), 5)
+        self.assertEqual(related.related_posts(jellyfishing[0]), jellyfishing[1:])
+        self.assertEqual(related.related_posts(loner), jellyfishing[::-1])
+        self.assertFalse(RelatedPost.objects.filter(post=loner, score__gt=0).exists())
+
+    @mock.patch.object(related, 'WORKERS', 0)
+    def test_saved_post_joins_neighbour_lists(self):
+        genre = Genre.objects.create(name='Adventure')
+        author = User.objects.create_user(username='sandy', password='pw')
+        nets = Post.objects.create(title='Jellyfishing nets', content='Catching jellyfish', author=author, genre=genre)
+        karate = Post.objects.create(title='Karate', content='Chopping boards', author=author, genre=genre)
+        krabby = Post.objects.create(title='Krabby', content='Patties', author=author, genre=genre)
+        related.build_related_posts()
+
+        # Only the saved post is vectorized, against the stored vocabulary
+        with mock.patch.object(related, 'fit_vocabulary', side_effect=AssertionError), \
+                self.captureOnCommitCallbacks(execute=True):
+            more_nets = Post.objects.create(title='Jellyfishing nets again', content='More jellyfish', author=author, genre=genre)
+        self.assertEqual(related.related_posts(nets), [more_nets])
+        self.assertEqual(related.related_posts(more_nets), [nets])
+        self.assertFalse(related.stale_posts().exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            more_nets.delete()
+        self.assertNotIn(more_nets.pk, related.StoredMatrix.load().post_ids)
+        self.assertEqual(related.related_posts(nets), [krabby, karate])
+
+    def test_edit_form_save_keeps_related_built_at(self):
+        genre = Genre.objects.create(name='Adventure')
+        author = User.objects.create_user(username='sandy', password='pw')
+        post = Post.objects.create(title='Karate', content='Chopping boards', author=author, genre=genre)
+        loaded = Post.objects.get(pk=post.pk)
+        related.build_related_posts()
+        loaded.save()
+        self.assertIsNotNone(Post.objects.get(pk=post.pk).related_built_at)
+
+
+def jpeg_upload(name, width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'yellow').save(buffer, 'JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class ImageDerivativeTests(TestCase):
+    """
+    A committed upload gets resized derivatives (rendered inline with
+    IMAGE_DERIVATIVE_WORKERS = 0), rendered once per image and dropped with
+    it, and the responsive_image tag builds srcsets from them.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        override = override_settings(MEDIA_ROOT=directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        patcher = mock.patch.object(images, 'WORKERS', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        genre = Genre.objects.create(name='Adventure')
+        author = User.objects.create_user(username='sandy', password='pw')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post = Post.objects.create(
+                title='Karate', content='Hi-yah!', author=author, genre=genre,
+                featured_image=jpeg_upload('karate.jpg', 700, 400),
+            )
+        self.post.refresh_from_db()
+
+    def test_upload_renders_derivatives(self):
+        derivatives = self.post.featured_image_derivatives
+        self.assertEqual(derivatives['source'], self.post.featured_image.name)
+        self.assertEqual((derivatives['width'], derivatives['height']), (700, 400))
+        storage = self.post.featured_image.storage
+        for fmt, extension in (('webp', 'webp'), ('jpeg', 'jpg')):
+            self.assertEqual([width for width, _ in derivatives[fmt]], [320, 640, 700])
+            for width, name in derivatives[fmt]:
+                self.assertTrue(name.startswith(f'post_images/karate-{width}w'))
+                self.assertTrue(name.endswith(f'.{extension}'))
+                self.assertTrue(storage.exists(name))
+        with Image.open(storage.path(derivatives['jpeg'][0][1])) as image:
+            self.assertEqual(image.size, (320, 183))
+
+    def test_current_derivatives_are_not_rendered_again(self):
+        with mock.patch.object(images, 'derive') as derive, self.captureOnCommitCallbacks(execute=True):
+            self.post.title = 'Karate chop'
+            self.post.save()
+        derive.assert_not_called()
+
+        previous = self.post.featured_image_derivatives
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.featured_image = jpeg_upload('chop.jpg', 300, 200)
+            self.post.save()
+        self.post.refresh_from_db()
+        derivatives = self.post.featured_image_derivatives
+        self.assertEqual(derivatives['source'], self.post.featured_image.name)
+        self.assertEqual([width for width, _ in derivatives['webp']], [300])
+        self.assertFalse(self.post.featured_image.storage.exists(previous['webp'][0][1]))
+
+    def test_removed_image_clears_derivatives(self):
+        names = [name for fmt in ('webp', 'jpeg') for _, name in self.post.featured_image_derivatives[fmt]]
+        storage = self.post.featured_image.storage
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.featured_image = None
+            self.post.save()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.featured_image_derivatives, {})
+        self.assertFalse(any(storage.exists(name) for name in names))
+
+    def test_responsive_image_tag_builds_srcsets(self):
+        template = Template(
+            '{% load responsive_images %}'
+            '{% responsive_image post.featured_image derivatives "100vw" alt="Karate" %}'
+        )
+        html = template.render(Context({'post': self.post, 'derivatives': self.post.featured_image_derivatives}))
+        self.assertIn(
+            'srcset="/media/post_images/karate-320w.webp 320w, /media/post_images/karate-640w.webp 640w, '
+            '/media/post_images/karate-700w.webp 700w"',
+            html,
+        )
+        self.assertIn('src="/media/post_images/karate-700w.jpg"', html)
+        self.assertIn('width="700" height="400"', html)
+
+        # Until its derivatives are rendered, the original is shown
+        html = template.render(Context({'post': self.post, 'derivatives': {}}))
+        self.assertIn(f'src="/media/{self.post.featured_image.name}"', html)
+        self.assertNotIn('srcset', html)
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class ArchiveTests(TestCase):
+    """
+    An export imported into an empty database gives back the same content
+    and counters, and a resumed import never duplicates a chunk.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = f'{directory}/blog.ndjson.gz'
+
+        adventure, comedy = Genre.objects.create(name='Adventure'), Genre.objects.create(name='Comedy')
+        sandy, spongebob, patrick = [
+            User.objects.create_user(username=name, password='pw') for name in ('sandy', 'spongebob', 'patrick')
+        ]
+        Follow.objects.create(follower=spongebob, following=sandy)
+        Follow.objects.create(follower=patrick, following=spongebob)
+        karate = Post.objects.create(title='Karate', content='Hi-yah!', author=sandy, genre=adventure)
+        rock = Post.objects.create(title='Rock', content='Under it', author=patrick, genre=comedy, is_published=False)
+        for user in (spongebob, patrick):
+            PostLike.objects.create(user=user, post=karate)
+        for post in (karate, rock):
+            root = Comment.objects.create(post=post, author=spongebob, content=f'First on {post.title}')
+            reply = Comment.objects.create(post=post, author=sandy, content=f'Reply on {post.title}', parent=root)
+            Comment.objects.create(post=post, author=patrick, content=f'Deeper on {post.title}', parent=reply)
+            Comment.objects.create(post=post, author=patrick, content=f'Second on {post.title}')
+            CommentLike.objects.create(user=sandy, comment=root)
+            CommentLike.objects.create(user=patrick, comment=reply)
+
+        call_command('export_blog', self.path, stdout=io.StringIO())
+        self.expected = self.snapshot()
+        User.objects.all().delete()
+        Genre.objects.all().delete()
+
+    def snapshot(self):
+        comments = list(Comment.objects.select_related('post', 'author', 'parent'))
+        for comment in comments:
+            if comment.parent is not None:
+                self.assertTrue(comment.path.startswith(comment.parent.path))
+        return {
+            'counts': {
+                model.__name__: model.objects.count()
+                for model in (Genre, User, UserProfile, Follow, Post, PostLike, Comment, CommentLike)
+            },
+            'follows': sorted(Follow.objects.values_list('follower__username', 'following__username')),
+            'posts': sorted(Post.objects.values_list(
+                'slug', 'author__username', 'genre__slug', 'is_published', 'likes_count', 'comments_count', 'created_at',
+            )),
+            'comments': sorted(
+                (comment.post.slug, comment.author.username, comment.content, comment.depth, comment.likes_count,
+                 comment.parent.content if comment.parent is not None else None, comment.created_at)
+                for comment in comments
+            ),
+        }
+
+    def test_round_trip_into_an_empty_database(self):
+        self.assertEqual(Post.objects.count(), 0)
+        call_command('import_blog', self.path, stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), self.expected)
+        self.assertTrue(User.objects.get(username='sandy').check_password('pw'))
+
+    def test_resumed_import_skips_committed_comments(self):
+        checkpoint = f'{self.path}.checkpoint'
+        write_checkpoint = archive.write_checkpoint
+
+        def crash_after_a_comment_chunk(path, state):
+            # The chunk committed, but the process died before recording it
+            if state['thread_comments']:
+                raise KeyboardInterrupt
+            write_checkpoint(path, state)
+
+        with mock.patch.object(archive, 'write_checkpoint', crash_after_a_comment_chunk):
+            with self.assertRaises(KeyboardInterrupt), archive.open_archive(self.path) as file:
+                archive.load(file, archive.Importer(chunk_size=3), checkpoint_path=checkpoint)
+        self.assertEqual(Comment.objects.count(), 3)
+        with archive.open_archive(self.path) as file:
+            archive.load(file, archive.Importer(chunk_size=3), checkpoint_path=checkpoint)
+
+        self.assertEqual(self.snapshot(), self.expected)
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+class TieredCacheTests(SimpleTestCase):
+    """
+    The default cache backend: L1 bounds, atomic add, single-flight and read counters.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        override = override_settings(CACHES={**settings.CACHES, 'tiered-l2': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory,
+        }})
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def worker_cache(self, **options):
+        """
+        A TieredCache as another worker process would have: its own L1, the shared L2
+        """
+        return TieredCache('', {'OPTIONS': {'L2': 'tiered-l2', 'LOCK_TIMEOUT': 5, **options}})
+
+    def run_threads(self, count, target):
+        errors = []
+
+        def run(index):
+            try:
+                target(index)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_local_lru_evicts_least_recent_and_expires(self):
+        lru = LocalLRU(2, timeout=10)
+        with mock.patch('blog.tiered_cache.time.monotonic', return_value=100):
+            lru.set('bikini', 1)
+            lru.set('bottom', 2)
+            lru.get('bikini')
+            lru.set('goo', 3)
+            self.assertIs(lru.get('bottom'), tiered_cache._MISSING)
+            self.assertEqual((lru.get('bikini'), lru.get('goo')), (1, 3))
+        with mock.patch('blog.tiered_cache.time.monotonic', return_value=110):
+            self.assertIs(lru.get('bikini'), tiered_cache._MISSING)
+
+    def test_add_has_one_winner_across_workers(self):
+        workers = [self.worker_cache() for _ in range(8)]
+        barrier = threading.Barrier(len(workers))
+        winners = [[] for _ in range(20)]
+
+        def add(index):
+            for round_number, round_winners in enumerate(winners):
+                barrier.wait()
+                if workers[index].add(f'race:{round_number}', index, 30):
+                    round_winners.append(index)
+
+        self.run_threads(len(workers), add)
+        self.assertEqual([len(round_winners) for round_winners in winners], [1] * len(winners))
+
+    def test_cold_miss_is_computed_once(self):
+        workers = [self.worker_cache() for _ in range(6)]
+        computed = []
+        results = []
+
+        def compute():
+            computed.append(True)
+            time.sleep(0.2)
+            return 'krabby patty'
+
+        self.run_threads(len(workers), lambda index: results.append(workers[index].get_or_compute('menu:special', compute, 60)))
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(results, ['krabby patty'] * len(workers))
+
+    def test_stale_value_is_served_while_one_caller_recomputes(self):
+        worker, other = self.worker_cache(), self.worker_cache()
+        worker.get_or_compute('menu:special', lambda: 'old', 60)
+        self.assertTrue(other._acquire('menu:special', None))
+        compute = mock.Mock(return_value='new')
+        self.assertEqual(worker.get_or_compute('menu:special', compute, 60, is_stale=lambda value: True), 'old')
+        compute.assert_not_called()
+        self.assertEqual(worker.stats()['menu']['stale'], 1)
+
+        other._release('menu:special', None)
+        self.assertEqual(worker.get_or_compute('menu:special', compute, 60, is_stale=lambda value: value == 'old'), 'new')
+        self.assertEqual(worker.get('menu:special'), 'new')
+
+    def test_reads_are_counted_per_prefix(self):
+        worker, other = self.worker_cache(), self.worker_cache()
+        self.assertIsNone(worker.get('menu:special'))
+        worker.set('menu:special', 'krabby patty', 60)
+        worker.get('menu:special')
+        other.get_many(['menu:special', 'menu:kelp', 'card:1'])
+
+        menu = worker.stats()['menu']
+        self.assertEqual((menu['l1_hits'], menu['l2_hits'], menu['misses'], menu['hit_rate']), (1, 0, 1, 0.5))
+        self.assertEqual(
+            {prefix: (counts['l2_hits'], counts['misses']) for prefix, counts in other.stats().items()},
+            {'menu': (1, 1), 'card': (0, 1)},
+        )
+        self.assertEqual(other.thread_reads(), (1, 2))
+        other.reset_stats()
+        self.assertEqual(other.stats(), {})
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class MetricsTests(TestCase):
+    """
+    /metrics adds up every worker's file, archiving exited workers, and is
+    only served to staff or a scraper with the token.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, value in (('DIRECTORY', metrics.Path(directory)), ('registry', metrics.Registry())):
+            patcher = mock.patch.object(metrics, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(session_store.flush)
+
+    def write_worker(self, pid, requests, seconds):
+        registry = metrics.Registry()
+        registry.inc('http_requests_total', ('blog:home', 'GET', '200'), requests)
+        registry.observe('http_request_duration_seconds', ('blog:home',), seconds)
+        path = metrics.DIRECTORY / f'worker-{pid}-{pid:08x}.json'
+        metrics._write_json(path, registry.dump())
+        return path
+
+    def test_collect_sums_workers_and_archives_exited_ones(self):
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        self.write_worker(os.getpid(), 2, 0.02)
+        exited_file = self.write_worker(exited.pid, 3, 3.0)
+        requests = ('http_requests_total', ('blog:home', 'GET', '200'))
+        latency = ('http_request_duration_seconds', ('blog:home',))
+
+        for _ in range(2):
+            counters, histograms = metrics.collect()
+            self.assertEqual(counters[requests], 5)
+            self.assertEqual(histograms[latency][2], 1)
+            self.assertEqual(histograms[latency][metrics.LATENCY_BUCKETS.index(5)], 1)
+            self.assertEqual(histograms[latency][-1], 3.02)
+        self.assertFalse(exited_file.exists())
+        self.assertTrue((metrics.DIRECTORY / metrics.ARCHIVE).exists())
+
+        rendered = metrics.render()
+        self.assertIn('tori_http_requests_total{view="blog:home",method="GET",status="200"} 5\n', rendered)
+        self.assertIn('tori_http_request_duration_seconds_bucket{view="blog:home",le="+Inf"} 2\n', rendered)
+
+    def test_staff_and_token_holders_are_authorized(self):
+        url = reverse('blog:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        with mock.patch.object(metrics, 'TOKEN', 'secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer guess').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+        self.client.force_login(User.objects.create_user(username='squidward', password='pw'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_user(username='krabs', password='pw', is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+
+class BenchmarkTests(TestCase):
+    """
+    The view benchmark covers every route and flags regressions.
+    """
+    def setUp(self):
+        self.addCleanup(session_store.flush)
+
+    def test_run_covers_every_route(self):
+        benchmark.build_dataset(users=15, articles=20, seed=7, stdout=io.StringIO())
+        results = benchmark.run(iterations=3, warmup=1)
+
+        self.assertEqual(results['dataset']['posts'], 20)
+        self.assertEqual(set(results['results']), set(benchmark.route_requests(benchmark.Fixtures())))
+        for name, audiences in results['results'].items():
+            self.assertEqual(set(audiences), set(benchmark.AUDIENCES), name)
+            for result in audiences.values():
+                self.assertLess(result['status'], 500, name)
+                self.assertLessEqual(result['p50_ms'], result['p95_ms'], name)
+                self.assertGreater(result['allocated_bytes'], 0, name)
+        self.assertEqual(results['results']['blog:home'][benchmark.SIGNED_IN]['status'], 200)
+        self.assertEqual(results['results']['blog:cache_stats'][benchmark.SIGNED_IN]['status'], 200)
+
+    def test_compare(self):
+        def run_with(p95_ms, queries, allocated_bytes):
+            result = {'p95_ms': p95_ms, 'queries': queries, 'allocated_bytes': allocated_bytes}
+            return {'results': {'blog:home': {benchmark.ANONYMOUS: result}}}
+
+        baseline = run_with(10.0, 5, 100_000)
+        self.assertEqual(benchmark.compare(baseline, run_with(11.5, 6, 110_000), threshold=0.2), [])
+        # Relatively large but sub-millisecond latency changes are noise
+        self.assertEqual(benchmark.compare(run_with(0.2, 5, 100_000), run_with(0.9, 5, 100_000)), [])
+        regressions = benchmark.compare(baseline, run_with(15.0, 8, 150_000), threshold=0.2)
+        self.assertEqual(len(regressions), 3)
+        self.assertIn('blog:home (anonymous): p95 10.00 ms -> 15.00 ms', regressions)
@@ -0,0 +1,386 @@
+"""
+Two-tier cache backend: a small in-process LRU (L1) in front of a shared
+cache (L2, another alias in CACHES such as a file or database cache).
+
+L1 entries live for at most ``L1_TIMEOUT`` seconds, which bounds how long
+a worker can keep serving a value another worker has changed or deleted;
+writes and deletes made through this backend update both tiers at once.
+``get_or_compute`` adds single-flight recomputation with
+stale-while-revalidate. ``add`` is atomic across processes even when L2 is
+a FileBasedCache, whose own ``add`` checks for the key and then writes
+it: the pair runs under an exclusive ``flock`` on one of a few lock files
+in the cache directory. Every read is counted per key prefix (the part
+of the key before the first ``:``), see ``stats()``; ``thread_reads()``
+gives the calling thread's hit and miss totals, for per-request metrics.
+
+Configuration::
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'blog.tiered_cache.TieredCache',
+            'OPTIONS': {'L2': 'shared', 'L1_MAX_ENTRIES': 1000, 'L1_TIMEOUT': 5},
+        },
+        'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/var/tmp/cache'},
+    }
+"""
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the development server runs a single process
+    fcntl = None
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+_MISSING = object()
+# Lock files guarding FileBasedCache.add; keys hash onto one of them
+ADD_LOCK_STRIPES = 64
+
+
+class SoftExpiring:
+    """
+    A value stored by get_or_compute, fresh until ``fresh_until`` and then
+    served stale while one caller recomputes it
+    """
+    __slots__ = ('value', 'fresh_until')
+
+    def __init__(self, value, fresh_until):
+        self.value = value
+        self.fresh_until = fresh_until
+
+    def __reduce__(self):
+        return (SoftExpiring, (self.value, self.fresh_until))
+
+
+def _unwrap(value):
+    return value.value if isinstance(value, SoftExpiring) else value
+
+
+class LocalLRU:
+    """
+    Thread-safe, size-bounded LRU mapping with a fixed per-entry TTL
+    """
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class PrefixStats:
+    """
+    Per key-prefix hit/miss counts and read latency for one process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'stale': 0, 'seconds': 0.0})
+        self._thread = threading.local()
+
+    @staticmethod
+    def prefix(key):
+        return str(key).split(':', 1)[0]
+
+    def record(self, key, outcome=None, seconds=0.0):
+        with self._lock:
+            counts = self._counts[self.prefix(key)]
+            if outcome is not None:
+                counts[outcome] += 1
+            counts['seconds'] += seconds
+        if outcome is not None:
+            thread_counts = self._thread.__dict__.setdefault('counts', defaultdict(int))
+            thread_counts[outcome] += 1
+
+    def thread_reads(self):
+        """
+        ``(hits, misses)`` recorded by the calling thread so far
+        """
+        counts = getattr(self._thread, 'counts', {})
+        return counts.get('l1_hits', 0) + counts.get('l2_hits', 0), counts.get('misses', 0)
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for prefix, counts in self._counts.items():
+                reads = counts['l1_hits'] + counts['l2_hits'] + counts['misses']
+                hits = counts['l1_hits'] + counts['l2_hits']
+                result[prefix] = dict(
+                    counts,
+                    hit_rate=round(hits / reads, 4) if reads else None,
+                    avg_ms=round(counts['seconds'] * 1000 / reads, 3) if reads else None,
+                )
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class TieredCache(BaseCache):
+    """
+    Django cache backend combining a per-process LRU with a shared cache
+    """
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._l2_alias = options.get('L2', 'shared')
+        self._l1 = LocalLRU(int(options.get('L1_MAX_ENTRIES', 1000)), float(options.get('L1_TIMEOUT', 5)))
+        self._stats = PrefixStats()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self.lock_timeout = int(options.get('LOCK_TIMEOUT', 30))
+
+    @property
+    def l2(self):
+        return caches[self._l2_alias]
+
+    def _local_key(self, key, version):
+        return self.l2.make_key(key, version=version)
+
+    # Reads
+
+    def get(self, key, default=None, version=None):
+        value = self._get(key, version)
+        return default if value is _MISSING else _unwrap(value)
+
+    def _get(self, key, version):
+        started = time.perf_counter()
+        local_key = self._local_key(key, version)
+        value = self._l1.get(local_key)
+        if value is not _MISSING:
+            self._stats.record(key, 'l1_hits', time.perf_counter() - started)
+            return value
+        value = self.l2.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self._stats.record(key, 'misses', time.perf_counter() - started)
+            return _MISSING
+        self._l1.set(local_key, value)
+        self._stats.record(key, 'l2_hits', time.perf_counter() - started)
+        return value
+
+    def get_many(self, keys, version=None):
+        started = time.perf_counter()
+        keys = list(keys)
+        found = {}
+        remote = []
+        for key in keys:
+            value = self._l1.get(self._local_key(key, version))
+            if value is _MISSING:
+                remote.append(key)
+            else:
+                found[key] = _unwrap(value)
+                self._stats.record(key, 'l1_hits')
+        if remote:
+            fetched = self.l2.get_many(remote, version=version)
+            for key in remote:
+                if key in fetched:
+                    self._l1.set(self._local_key(key, version), fetched[key])
+                    found[key] = _unwrap(fetched[key])
+                    self._stats.record(key, 'l2_hits')
+                else:
+                    self._stats.record(key, 'misses')
+        if keys:
+            # One round trip for the whole batch, attributed to its first key's prefix
+            self._stats.record(keys[0], seconds=time.perf_counter() - started)
+        return found
+
+    def has_key(self, key, version=None):
+        return self._get(key, version) is not _MISSING
+
+    # Writes
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.l2.set(key, value, timeout=self._timeout(timeout), version=version)
+        self._l1.set(self._local_key(key, version), value)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self._l2_add(key, value, self._timeout(timeout), version)
+        if added:
+            self._l1.set(self._local_key(key, version), value)
+        return added
+
+    def _l2_add(self, key, value, timeout, version):
+        """
+        ``add`` on L2, made atomic across processes for a FileBasedCache
+        """
+        directory = getattr(self.l2, '_dir', None)
+        if directory is None or fcntl is None:
+            return self.l2.add(key, value, timeout=timeout, version=version)
+        stripe = zlib.crc32(self.l2.make_key(key, version=version).encode()) % ADD_LOCK_STRIPES
+        os.makedirs(directory, exist_ok=True)
+        # FileBasedCache only culls and clears *.djcache files, so the lock files stay put
+        with open(os.path.join(directory, f'add-{stripe:02d}.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            return self.l2.add(key, value, timeout=timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout=self._timeout(timeout), version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._l1.set(self._local_key(key, version), value)
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._l1.delete(self._local_key(key, version))
+        return self.l2.touch(key, timeout=self._timeout(timeout), version=version)
+
+    def incr(self, key, delta=1, version=None):
+        # Counters are always read from L2, where the increment happens
+        self._l1.delete(self._local_key(key, version))
+        return self.l2.incr(key, delta, version=version)
+
+    def delete(self, key, version=None):
+        self._l1.delete(self._local_key(key, version))
+        return self.l2.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._l1.delete(self._local_key(key, version))
+        self.l2.delete_many(keys, version=version)
+
+    def clear(self):
+        self._l1.clear()
+        self.l2.clear()
+
+    def _timeout(self, timeout):
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    # Single-flight recomputation
+
+    def get_or_compute(self, key, compute, timeout=DEFAULT_TIMEOUT, stale_timeout=60, version=None, is_stale=None):
+        """
+        Return the cached value, calling ``compute()`` to fill it.
+
+        The value is fresh for ``timeout`` seconds and then kept for another
+        ``stale_timeout`` seconds, during which exactly one caller (holding
+        a lock in L2) recomputes it while everyone else gets the stale
+        value. ``is_stale(value)`` can end freshness early, e.g. when a
+        dependency tag was purged. On a cold miss, one caller computes and
+        the others wait for its result (up to LOCK_TIMEOUT) instead of
+        stampeding the database.
+        """
+        timeout = self._timeout(timeout)
+        entry = self._get(key, version)
+        if entry is not _MISSING:
+            value = _unwrap(entry)
+            fresh = not isinstance(entry, SoftExpiring) or entry.fresh_until > time.time()
+            if fresh and (is_stale is None or not is_stale(value)):
+                return value
+            if not self._acquire(key, version):
+                self._stats.record(key, 'stale')
+                return value
+        else:
+            entry = self._wait_for_flight(key, version)
+            if entry is not _MISSING:
+                return _unwrap(entry)
+
+        try:
+            value = compute()
+            hard_timeout = None if timeout is None else timeout + stale_timeout
+            fresh_until = float('inf') if timeout is None else time.time() + timeout
+            self.set(key, SoftExpiring(value, fresh_until), timeout=hard_timeout, version=version)
+            return value
+        finally:
+            self._release(key, version)
+
+    def _lock_key(self, key):
+        return f'{key}:lock'
+
+    def _acquire(self, key, version):
+        # The process-local lock keeps threads of one worker from all asking L2
+        with self._flights_lock:
+            if key in self._flights:
+                return False
+            self._flights[key] = True
+        if self._l2_add(self._lock_key(key), 1, self.lock_timeout, version):
+            return True
+        with self._flights_lock:
+            self._flights.pop(key, None)
+        return False
+
+    def _release(self, key, version):
+        with self._flights_lock:
+            if self._flights.pop(key, None) is None:
+                return
+        self.l2.delete(self._lock_key(key), version=version)
+
+    def _wait_for_flight(self, key, version):
+        """
+        Become the one caller computing a cold key, or wait for whoever is
+        """
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.01
+        while not self._acquire(key, version):
+            if time.monotonic() >= deadline:
+                # The computing caller died or is very slow; compute without the lock
+                return _MISSING
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+            value = self.l2.get(key, _MISSING, version=version)
+            if value is not _MISSING:
+                return value
+        # The previous holder may have stored the value just before we got the lock
+        value = self.l2.get(key, _MISSING, version=version)
+        if value is not _MISSING:
+            self._release(key, version)
+        return value
+
+    def stats(self):
+        """
+        Per key-prefix read counters for this process
+        """
+        return self._stats.snapshot()
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def thread_reads(self):
+        return self._stats.thread_reads()
+
+
+def get_or_compute(key, compute, timeout=DEFAULT_TIMEOUT, stale_timeout=60, is_stale=None, cache_alias='default'):
+    """
+    ``cache.get_or_compute`` when the cache supports it, else a plain get
+    and set (honouring is_stale, but without single-flight)
+    """
+    cache = caches[cache_alias]
+    if hasattr(cache, 'get_or_compute'):
+        return cache.get_or_compute(key, compute, timeout=timeout, stale_timeout=stale_timeout, is_stale=is_stale)
+    value = cache.get(key, _MISSING)
+    if value is _MISSING or (is_stale is not None and is_stale(value)):
+        value = compute()
+        cache.set(key, value, timeout=timeout)
+    return value
@@ -0,0 +1,213 @@
+"""
+Fan-out-on-write following feeds.
+
+Publishing a post copies its id into the timeline of every follower, so
+reading a feed page is a range scan over TimelineEntry on (user, created_at).
+Authors with more than TIMELINE_FANOUT_LIMIT followers are switched to
+fan-out-on-read: their posts are not copied and are merged into the feeds
+of their followers at query time instead.
+
+Follow counts change on every follow, so modes are not switched in the
+request: ``refresh_fanout_modes`` (run periodically with the command of the
+same name) switches every author whose count crossed the limit in a few
+set-based statements. Until it runs, an author stays in its old mode; both
+modes give the same feed.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+
+from .models import Follow, Post, TimelineEntry, UserProfile
+from .pagination import KeysetUnion
+
+FANOUT_LIMIT = getattr(settings, 'TIMELINE_FANOUT_LIMIT', 5000)
+MAX_LENGTH = getattr(settings, 'TIMELINE_MAX_LENGTH', 1000)
+BACKFILL = getattr(settings, 'TIMELINE_BACKFILL', 50)
+BATCH_SIZE = 1000
+
+
+def _entry(user_id, post):
+    return TimelineEntry(user_id=user_id, post_id=post.pk, author_id=post.author_id, created_at=post.created_at)
+
+
+def fan_out(post):
+    """
+    Push a newly published post into its author's followers' timelines
+    """
+    if not post.is_published or _fans_out_on_read(post.author_id):
+        return
+    follower_ids = Follow.objects.filter(following_id=post.author_id).values_list('follower_id', flat=True)
+    batch = []
+    for follower_id in follower_ids.iterator(chunk_size=BATCH_SIZE):
+        batch.append(_entry(follower_id, post))
+        if len(batch) >= BATCH_SIZE:
+            TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            _trim_many([entry.user_id for entry in batch])
+            batch = []
+    if batch:
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+        _trim_many([entry.user_id for entry in batch])
+
+
+def retract(post):
+    """
+    Remove an unpublished post from every timeline
+    """
+    TimelineEntry.objects.filter(post_id=post.pk).delete()
+
+
+def backfill(follower_id, *author_ids):
+    """
+    Copy the recent posts of authors a user just followed into their
+    timeline, in one statement
+    """
+    if author_ids:
+        _backfill_authors(author_ids, follower_id)
+
+
+def forget(follower_id, author_id):
+    """
+    Drop an unfollowed author's posts from the follower's timeline
+    """
+    TimelineEntry.objects.filter(user_id=follower_id, author_id=author_id).delete()
+
+
+def trim(user_id):
+    """
+    Keep only the newest MAX_LENGTH entries of a timeline
+    """
+    entries = TimelineEntry.objects.filter(user_id=user_id).order_by('-created_at', '-post_id')
+    oldest_kept = entries.values_list('created_at', 'post_id')[MAX_LENGTH - 1:MAX_LENGTH].first()
+    if oldest_kept is not None:
+        created_at, post_id = oldest_kept
+        entries.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, post_id__lt=post_id)).delete()
+
+
+def _trim_many(user_ids=None, followers_of=None):
+    """
+    trim() every timeline at once, or those of user_ids, or of the followers
+    of the authors in followers_of, in one statement
+    """
+    if user_ids is not None:
+        where, params = f'WHERE user_id IN ({", ".join(["%s"] * len(user_ids))})', list(user_ids)
+    elif followers_of is not None:
+        where = (
+            'WHERE user_id IN (SELECT follower_id FROM blog_follow '
+            f'WHERE following_id IN ({", ".join(["%s"] * len(followers_of))}))'
+        )
+        params = list(followers_of)
+    else:
+        where, params = '', []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM blog_timelineentry WHERE id IN ('
+            '  SELECT id FROM ('
+            '    SELECT id, ROW_NUMBER() OVER ('
+            '      PARTITION BY user_id ORDER BY created_at DESC, post_id DESC'
+            f'    ) AS position FROM blog_timelineentry {where}'
+            '  ) ranked WHERE position > %s'
+            ')',
+            params + [MAX_LENGTH],
+        )
+
+
+def _backfill_authors(author_ids=None, follower_id=None):
+    """
+    Copy the BACKFILL newest posts of every followed fan-out-on-write author,
+    or only of author_ids, into their followers' timelines (or only
+    follower_id's), then trim those
+    """
+    authors, params = '', []
+    if author_ids is not None:
+        authors = f'AND p.author_id IN ({", ".join(["%s"] * len(author_ids))}) '
+        params = list(author_ids)
+    followers, follower_params = '', []
+    if follower_id is not None:
+        followers, follower_params = 'AND f.follower_id = %s', [follower_id]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO blog_timelineentry (user_id, post_id, author_id, created_at) '
+            'SELECT f.follower_id, r.id, r.author_id, r.created_at FROM blog_follow f '
+            'JOIN ('
+            '  SELECT p.id, p.author_id, p.created_at, ROW_NUMBER() OVER ('
+            '    PARTITION BY p.author_id ORDER BY p.created_at DESC, p.id DESC'
+            f'  ) AS position FROM blog_post p WHERE p.is_published {authors}'
+            ') r ON r.author_id = f.following_id AND r.position <= %s '
+            'JOIN blog_userprofile a ON a.user_id = f.following_id AND NOT a.fanout_on_read '
+            'WHERE NOT EXISTS ('
+            '  SELECT 1 FROM blog_timelineentry t WHERE t.user_id = f.follower_id AND t.post_id = r.id'
+            f') {followers}',
+            params + [BACKFILL] + follower_params,
+        )
+    if follower_id is not None:
+        trim(follower_id)
+    else:
+        _trim_many(followers_of=author_ids)
+
+
+def refresh_fanout_modes():
+    """
+    Switch every author over TIMELINE_FANOUT_LIMIT followers to fan-out-on-read,
+    and back to fan-out-on-write every author under 90% of it, backfilling
+    their followers' timelines; returns how many switched each way.
+
+    The 10% hysteresis band keeps an author hovering around the limit from
+    flipping back and forth.
+    """
+    follower_counts = Follow.objects.order_by().values('following_id').annotate(followers=Count('*'))
+    popular = follower_counts.filter(followers__gt=FANOUT_LIMIT).values('following_id')
+    to_read = UserProfile.objects.filter(user_id__in=popular, fanout_on_read=False).update(fanout_on_read=True)
+
+    still_popular = follower_counts.filter(followers__gte=FANOUT_LIMIT * 0.9).values('following_id')
+    returning = list(
+        UserProfile.objects.filter(fanout_on_read=True).exclude(user_id__in=still_popular)
+        .values_list('user_id', flat=True)
+    )
+    for start in range(0, len(returning), BATCH_SIZE):
+        author_ids = returning[start:start + BATCH_SIZE]
+        with transaction.atomic():
+            UserProfile.objects.filter(user_id__in=author_ids).update(fanout_on_read=False)
+            _backfill_authors(author_ids)
+    return to_read, len(returning)
+
+
+def backfill_all():
+    """
+    Backfill every timeline at once, as if each follow had just been made:
+    the BACKFILL newest posts of every followed fan-out-on-write author,
+    then trimmed to MAX_LENGTH entries per user
+    """
+    _backfill_authors()
+
+
+def _fans_out_on_read(author_id):
+    return UserProfile.objects.filter(user_id=author_id, fanout_on_read=True).exists()
+
+
+def feed_queryset(user):
+    """
+    Published posts for a user's following feed, newest first by ``feed_at``.
+
+    The timeline is a join driven by the (user, created_at) timeline index.
+    The posts of fan-out-on-read authors come from a second query on the
+    (author, created_at) post index, and each page merges the two (see
+    KeysetUnion).
+    """
+    posts = Post.objects.filter(is_published=True).select_related('author__profile', 'genre')
+    timeline_posts = (
+        posts.filter(timeline_entries__user=user)
+        .annotate(feed_at=F('timeline_entries__created_at'))
+        .order_by('-feed_at', '-id')
+    )
+    read_time_authors = list(
+        Follow.objects.filter(follower=user, following__profile__fanout_on_read=True)
+        .values_list('following_id', flat=True)
+    )
+    if not read_time_authors:
+        return timeline_posts
+    read_time_posts = (
+        posts.filter(author_id__in=read_time_authors)
+        .annotate(feed_at=F('created_at'))
+        .order_by('-feed_at', '-id')
+    )
+    return KeysetUnion(timeline_posts, read_time_posts, ordering=('-feed_at', '-id'))
@@ -9,6 +9,17 @@ urlpatterns = [
     path('post/<slug:slug>/', views.PostDetailView.as_view(), name='post_detail'),
     path('genre/<slug:slug>/', views.GenrePostsView.as_view(), name='genre_posts'),
     path('following/', views.FollowingFeedView.as_view(), name='following_feed'),
+    path('search/', views.post_search, name='search'),
+
+    # RSS and Atom feeds (feed_format is rss or atom)
+    path('feed/<slug:feed_format>/', views.site_feed, name='site_feed'),
+    path('genre/<slug:slug>/feed/<slug:feed_format>/', views.genre_feed, name='genre_feed'),
+    path('user/<str:username>/feed/<slug:feed_format>/', views.author_feed, name='author_feed'),
+
+    # Infinite-scroll fragments (next page of cards as JSON)
+    path('ajax/posts/', views.HomePageView.as_view(fragment=True), name='home_posts'),
+    path('ajax/genre/<slug:slug>/posts/', views.GenrePostsView.as_view(fragment=True), name='genre_posts_fragment'),
+    path('ajax/following/posts/', views.FollowingFeedView.as_view(fragment=True), name='following_feed_fragment'),
 
     # Post CRUD
     path('create/', views.CreatePostView.as_view(), name='create_post'),
@@ -17,13 +28,21 @@ urlpatterns = [
 
     # User profiles
     path('user/<str:username>/', views.UserProfileView.as_view(), name='user_profile'),
+    path('user/<str:username>/export/', views.export_author, name='export_author'),
 
     # AJAX endpoints
     path('ajax/like-post/<slug:slug>/', views.like_post, name='like_post'),
     path('ajax/like-comment/<int:comment_id>/', views.like_comment, name='like_comment'),
     path('ajax/follow/<str:username>/', views.follow_user, name='follow_user'),
+    path('ajax/actions/', views.bulk_actions, name='bulk_actions'),
     path('ajax/toggle-dark-mode/', views.toggle_dark_mode, name='toggle_dark_mode'),
+    path('ajax/cache-stats/', views.cache_stats, name='cache_stats'),
 
     # Comments
     path('post/<slug:slug>/comment/', views.add_comment, name='add_comment'),
+    path('post/<slug:slug>/comments/', views.comment_page, name='comment_page'),
+    path('post/<slug:slug>/comments/<int:comment_id>/replies/', views.comment_replies, name='comment_replies'),
+
+    # Monitoring
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""
+Per-viewer state: like markers for lists of posts and comments, and the
+session-held snapshot of the signed-in user.
+
+The snapshot keeps the user's identity, display name, avatar, theme and
+the set of users they follow in the session, so pages served to a signed-in
+viewer don't load the User and UserProfile rows on every request (see
+ViewerSnapshotMiddleware). It is rebuilt from the database when it is older
+than ``VIEWER_SNAPSHOT_MAX_AGE`` seconds or the session's auth hash has
+changed, and dropped whenever the viewer edits their profile or theme.
+
+The snapshot also carries the auth flags (``is_active``, ``is_staff``,
+``is_superuser``). Saving a User with those fields revokes every snapshot
+of that user, in all their sessions, through a per-user revocation time in
+the cache, so a deactivated or demoted user loses access on their next
+request.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY, get_user as load_session_user
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import router, transaction
+from django.utils.crypto import constant_time_compare
+
+from . import like_buffer, page_cache
+from .models import PostLike, CommentLike, Follow, UserProfile
+
+SNAPSHOT_SESSION_KEY = '_viewer'
+# Bounds how long a password change or profile edit made in another session goes unnoticed
+SNAPSHOT_MAX_AGE = getattr(settings, 'VIEWER_SNAPSHOT_MAX_AGE', 60 * 5)
+AUTH_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+USER_FIELDS = ('id', 'username', 'first_name', 'last_name', *AUTH_FIELDS)
+
+
+def load_viewer_likes(user, posts=(), comments=()):
+    """
+    Mark posts and comments with the viewer's like state.
+
+    Sets ``liked_by_viewer`` on every object using at most one query per
+    model, instead of one ``is_liked_by`` EXISTS query per object, plus one
+    for the likes still in blog.like_buffer (which also adjust
+    ``likes_count``), so viewers see their own likes straight away.
+    Anonymous viewers never hit the database.
+    """
+    posts = [post for post in posts if post is not None]
+    comments = [comment for comment in comments if comment is not None]
+
+    liked_post_ids = set()
+    liked_comment_ids = set()
+    if user.is_authenticated:
+        if posts:
+            liked_post_ids = set(
+                PostLike.objects.filter(user=user, post_id__in={post.pk for post in posts})
+                .values_list('post_id', flat=True)
+            )
+        if comments:
+            liked_comment_ids = set(
+                CommentLike.objects.filter(user=user, comment_id__in={comment.pk for comment in comments})
+                .values_list('comment_id', flat=True)
+            )
+
+    for post in posts:
+        post.liked_by_viewer = post.pk in liked_post_ids
+    for comment in comments:
+        comment.liked_by_viewer = comment.pk in liked_comment_ids
+    if user.is_authenticated:
+        like_buffer.overlay_pending(user, posts, comments)
+
+
+def _access_key(user_id):
+    return f'viewer:access:{user_id}'
+
+
+def revoke_snapshots(user_id):
+    """
+    Rebuild every session's snapshot of the user on its next request, once
+    the current transaction commits (their auth flags may have changed)
+    """
+    transaction.on_commit(lambda: cache.set(_access_key(user_id), time.time(), None))
+
+
+def build_snapshot(user, built_at):
+    """
+    The session snapshot of a signed-in user (two queries), whose User row
+    was loaded after built_at
+    """
+    profile = UserProfile.objects.get(user=user)
+    user.profile = profile
+    return {
+        'id': user.pk,
+        'username': user.username,
+        'display_name': user.get_full_name() or user.username,
+        'avatar_url': profile.get_avatar_url(),
+        'dark_mode': profile.dark_mode,
+        'following_ids': list(Follow.objects.filter(follower=user).values_list('following_id', flat=True)),
+        'user': {field: getattr(user, field) for field in USER_FIELDS},
+        'profile': {
+            'id': profile.pk, 'user_id': user.pk, 'avatar': profile.avatar.name or None,
+            'avatar_derivatives': profile.avatar_derivatives, 'dark_mode': profile.dark_mode,
+        },
+        'session_hash': user.get_session_auth_hash(),
+        'built_at': built_at,
+    }
+
+
+def _is_current(snapshot, session):
+    if not (
+        snapshot is not None
+        and str(snapshot['id']) == str(session.get(SESSION_KEY))
+        and snapshot['built_at'] + SNAPSHOT_MAX_AGE > time.time()
+        and constant_time_compare(snapshot['session_hash'], session.get(HASH_SESSION_KEY) or '')
+    ):
+        return False
+    # A revocation lost to a cache clear is still bounded by SNAPSHOT_MAX_AGE
+    revoked_at = cache.get(_access_key(snapshot['id']))
+    return revoked_at is None or revoked_at <= snapshot['built_at']
+
+
+def _from_snapshot(model, db, values):
+    # Model.from_db expects the loaded fields in the model's own field order
+    field_names = [field.attname for field in model._meta.concrete_fields if field.attname in values]
+    return model.from_db(db, field_names, [values[name] for name in field_names])
+
+
+def user_from_snapshot(snapshot):
+    """
+    A User (with its profile attached) built from a snapshot without queries.
+
+    Fields outside the snapshot are deferred: reading one loads it, and
+    saving the instance only writes the fields that were loaded.
+    """
+    db = router.db_for_read(User)
+    user = _from_snapshot(User, db, snapshot['user'])
+    user.profile = _from_snapshot(UserProfile, db, snapshot['profile'])
+    user.following_ids = frozenset(snapshot['following_ids'])
+    user.viewer_snapshot = snapshot
+    return user
+
+
+def get_user(request):
+    """
+    The request's user, from the session snapshot when it is current
+    """
+    session = request.session
+    snapshot = session.get(SNAPSHOT_SESSION_KEY)
+    if _is_current(snapshot, session):
+        return user_from_snapshot(snapshot)
+
+    started = time.time()
+    user = load_session_user(request)
+    if user.is_authenticated:
+        snapshot = build_snapshot(user, started)
+        session[SNAPSHOT_SESSION_KEY] = snapshot
+        user.following_ids = frozenset(snapshot['following_ids'])
+        user.viewer_snapshot = snapshot
+    elif SNAPSHOT_SESSION_KEY in session:
+        del session[SNAPSHOT_SESSION_KEY]
+    return user
+
+
+def invalidate_snapshot(request):
+    """
+    Rebuild the viewer's snapshot on their next request
+    """
+    request.session.pop(SNAPSHOT_SESSION_KEY, None)
+    page_cache.purge(page_cache.viewer_tag(request.user.pk))
+
+
+def update_following(request, user_id, following):
+    """
+    Keep the snapshot's following set in step with a follow or unfollow
+    """
+    page_cache.purge(page_cache.viewer_tag(request.user.pk))
+    snapshot = request.session.get(SNAPSHOT_SESSION_KEY)
+    if snapshot is None:
+        return
+    following_ids = set(snapshot['following_ids'])
+    if following:
+        following_ids.add(user_id)
+    else:
+        following_ids.discard(user_id)
+    snapshot['following_ids'] = sorted(following_ids)
+    request.session.modified = True
+
+
+def following_ids(user):
+    """
+    IDs of the users a viewer follows, from the snapshot when available
+    """
+    if not user.is_authenticated:
+        return frozenset()
+    ids = getattr(user, 'following_ids', None)
+    if ids is None:
+        ids = frozenset(Follow.objects.filter(follower=user).values_list('following_id', flat=True))
+    return ids
@@ -1,22 +1,60 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.core.paginator import Paginator
+from django.core.cache import cache
 from django.db.models import Q, Count
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
 from django.urls import reverse_lazy, reverse
-from .models import Post, Genre, Comment, PostLike, CommentLike, Follow, UserProfile
+from .models import Post, Comment, Follow, UserProfile
 from .forms import PostForm, CommentForm
+from .viewer_state import load_viewer_likes, following_ids, invalidate_snapshot, update_following
+from .pagination import CursorPaginator, encode_cursor
+from . import archive, card_cache, feeds, genres, like_buffer, metrics, page_cache, related, search, social_actions, timeline
+from .comment_tree import load_comment_page, load_more_replies
 import json
 
 
-class HomePageView(ListView):
+class CursorPaginationMixin:
+    """
+    Keyset pagination for post lists, replacing Django's OFFSET/COUNT Paginator.
+
+    Pages are addressed by an opaque ``?cursor=`` token. A view registered
+    with ``as_view(fragment=True)`` returns only the rendered items and the
+    next cursor as JSON, for infinite scrolling.
+    """
+    cursor_keys = ('created_at', 'id')
+    fragment = False
+    fragment_template_name = 'partials/post_list.html'
+    fragment_url_name = None
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = CursorPaginator(queryset, page_size, keys=self.cursor_keys)
+        page = paginator.page(self.request.GET.get('cursor'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['fragment_url'] = reverse(self.fragment_url_name, kwargs=self.kwargs)
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        if not self.fragment:
+            return super().render_to_response(context, **response_kwargs)
+        return JsonResponse({
+            'html': render_to_string(self.fragment_template_name, context, request=self.request),
+            'next_cursor': context['page_obj'].next_cursor,
+        })
+
+
+class HomePageView(CursorPaginationMixin, ListView):
     """
     Homepage displaying recent blog posts
     """
@@ -24,14 +62,25 @@ class HomePageView(ListView):
     template_name = 'blog/home.html'
     context_object_name = 'posts'
     paginate_by = 6
+    fragment_url_name = 'blog:home_posts'
 
     def get_queryset(self):
-        return Post.objects.filter(is_published=True).select_related('author', 'genre').prefetch_related('likes')
+        return Post.objects.filter(is_published=True).select_related('author__profile', 'genre')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['genres'] = Genre.objects.all()
-        context['featured_posts'] = Post.objects.filter(is_published=True)[:3]
+        context['posts'] = list(context['posts'])
+        if self.fragment:
+            load_viewer_likes(self.request.user, posts=context['posts'])
+            card_cache.prime(context['posts'])
+            return context
+        context['featured_posts'] = list(
+            Post.objects.filter(is_published=True).select_related('author__profile', 'genre')[:3]
+        )
+        load_viewer_likes(self.request.user, posts=context['posts'] + context['featured_posts'])
+        card_cache.prime(context['posts'] + context['featured_posts'])
+        page_cache.tag(self.request, 'home')
+        page_cache.tag_posts(self.request, context['posts'] + context['featured_posts'])
         return context
 
 
@@ -43,29 +92,43 @@ class PostDetailView(DetailView):
     template_name = 'blog/post_detail.html'
     context_object_name = 'post'
 
+    def get_queryset(self):
+        return Post.objects.select_related('author', 'author__profile', 'genre')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        post = self.get_object()
+        post = self.object
 
-        # Get comments (only parent comments, replies loaded via template)
-        comments = Comment.objects.filter(post=post, parent=None).select_related('author').prefetch_related('replies')
+        # First page of the comment thread; later pages load through comment_page
+        comments, thread, next_cursor = load_comment_page(post)
         context['comments'] = comments
+        context['comments_next_cursor'] = next_cursor
         context['comment_form'] = CommentForm()
 
-        # Check if user has liked the post
-        if self.request.user.is_authenticated:
-            context['user_has_liked'] = post.is_liked_by(self.request.user)
+        # Related posts, precomputed by build_related_posts; same-genre posts until its first run
+        context['related_posts'] = related.related_posts(post)
+        if not context['related_posts'] and post.related_built_at is None:
+            context['related_posts'] = list(Post.objects.filter(
+                genre=post.genre,
+                is_published=True
+            ).exclude(id=post.id).select_related('author__profile', 'genre')[:3])
+
+        # Like state for the post, every comment and reply, and the related cards
+        load_viewer_likes(
+            self.request.user,
+            posts=[post] + context['related_posts'],
+            comments=thread,
+        )
+        context['user_has_liked'] = post.liked_by_viewer
+        card_cache.prime(context['related_posts'])
 
-        # Related posts
-        context['related_posts'] = Post.objects.filter(
-            genre=post.genre,
-            is_published=True
-        ).exclude(id=post.id)[:3]
+        page_cache.tag_posts(self.request, [post] + context['related_posts'])
+        page_cache.tag(self.request, *{f'author:{comment.author_id}' for comment in thread})
 
         return context
 
 
-class GenrePostsView(ListView):
+class GenrePostsView(CursorPaginationMixin, ListView):
     """
     Posts filtered by genre
     """
@@ -73,18 +136,23 @@ class GenrePostsView(ListView):
     template_name = 'blog/genre_posts.html'
     context_object_name = 'posts'
     paginate_by = 8
+    fragment_url_name = 'blog:genre_posts_fragment'
 
     def get_queryset(self):
-        self.genre = get_object_or_404(Genre, slug=self.kwargs['slug'])
+        self.genre = genres.registry().get_or_404(self.kwargs['slug'])
         return Post.objects.filter(
             genre=self.genre,
             is_published=True
-        ).select_related('author', 'genre').prefetch_related('likes')
+        ).select_related('author__profile', 'genre')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['genre'] = self.genre
-        context['genres'] = Genre.objects.all()
+        context['posts'] = list(context['posts'])
+        load_viewer_likes(self.request.user, posts=context['posts'])
+        card_cache.prime(context['posts'])
+        page_cache.tag(self.request, f'genre:{self.genre.slug}')
+        page_cache.tag_posts(self.request, context['posts'])
         return context
 
 
@@ -144,26 +212,30 @@ class UserProfileView(DetailView):
     slug_field = 'username'
     slug_url_kwarg = 'username'
 
+    def get_queryset(self):
+        return User.objects.select_related('profile')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = self.get_object()
+        user = self.object
 
-        context['posts'] = Post.objects.filter(
+        context['posts'] = list(Post.objects.filter(
             author=user,
             is_published=True
-        ).select_related('genre').prefetch_related('likes')[:10]
+        ).select_related('author__profile', 'genre')[:10])
+        load_viewer_likes(self.request.user, posts=context['posts'])
+        card_cache.prime(context['posts'])
+        page_cache.tag(self.request, f'author:{user.pk}')
+        page_cache.tag_posts(self.request, context['posts'])
 
         # Check if current user follows this profile user
         if self.request.user.is_authenticated:
-            context['is_following'] = Follow.objects.filter(
-                follower=self.request.user,
-                following=user
-            ).exists()
+            context['is_following'] = user.pk in following_ids(self.request.user)
 
         return context
 
 
-class FollowingFeedView(LoginRequiredMixin, ListView):
+class FollowingFeedView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     """
     Feed showing posts from followed users
     """
@@ -171,20 +243,52 @@ class FollowingFeedView(LoginRequiredMixin, ListView):
     template_name = 'blog/following_feed.html'
     context_object_name = 'posts'
     paginate_by = 8
+    cursor_keys = ('feed_at', 'id')
+    fragment_template_name = 'partials/feed_list.html'
+    fragment_url_name = 'blog:following_feed_fragment'
 
     def get_queryset(self):
-        # Get users that current user follows
-        following_users = Follow.objects.filter(
-            follower=self.request.user
-        ).values_list('following', flat=True)
+        # Materialized timeline of posts from followed users (see blog.timeline)
+        return timeline.feed_queryset(self.request.user)
 
-        return Post.objects.filter(
-            author__in=following_users,
-            is_published=True
-        ).select_related('author', 'genre').prefetch_related('likes')
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['posts'] = list(context['posts'])
+        load_viewer_likes(self.request.user, posts=context['posts'])
+        return context
 
 
 # AJAX Views for likes, comments, follows
+@require_http_methods(["GET"])
+def post_search(request):
+    """
+    Full-text search over published posts, ranked by relevance
+    """
+    query = request.GET.get('q', '').strip()
+    genre = author = None
+    if request.GET.get('genre'):
+        genre = genres.registry().get_or_404(request.GET['genre'])
+    if request.GET.get('author'):
+        author = get_object_or_404(User, username=request.GET['author'])
+
+    posts, next_cursor = search.search_posts(query, genre=genre, author=author, cursor=request.GET.get('cursor'))
+    load_viewer_likes(request.user, posts=posts)
+
+    next_url = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['cursor'] = next_cursor
+        next_url = f"?{params.urlencode()}"
+
+    return render(request, 'blog/search.html', {
+        'query': query,
+        'posts': posts,
+        'selected_genre': genre,
+        'selected_author': author,
+        'next_url': next_url,
+    })
+
+
 @login_required
 @require_http_methods(["POST"])
 @csrf_exempt
@@ -193,20 +297,12 @@ def like_post(request, slug):
     AJAX view to like/unlike posts
     """
     post = get_object_or_404(Post, slug=slug)
-    like, created = PostLike.objects.get_or_create(
-        user=request.user,
-        post=post
-    )
-
-    if not created:
-        like.delete()
-        liked = False
-    else:
-        liked = True
+    # Buffered and applied in batches (see blog.like_buffer); the count is optimistic
+    liked, likes_count = like_buffer.toggle(request.user, post)
 
     return JsonResponse({
         'liked': liked,
-        'likes_count': post.likes_count
+        'likes_count': likes_count
     })
 
 
@@ -218,20 +314,43 @@ def like_comment(request, comment_id):
     AJAX view to like/unlike comments
     """
     comment = get_object_or_404(Comment, id=comment_id)
-    like, created = CommentLike.objects.get_or_create(
-        user=request.user,
-        comment=comment
-    )
-
-    if not created:
-        like.delete()
-        liked = False
-    else:
-        liked = True
+    liked, likes_count = like_buffer.toggle(request.user, comment)
 
     return JsonResponse({
         'liked': liked,
-        'likes_count': comment.likes_count
+        'likes_count': likes_count
+    })
+
+
+@require_http_methods(["GET"])
+def comment_page(request, slug):
+    """
+    AJAX view returning the next page of top-level comments as an HTML fragment
+    """
+    post = get_object_or_404(Post, slug=slug)
+    comments, thread, next_cursor = load_comment_page(post, cursor=request.GET.get('cursor'))
+    load_viewer_likes(request.user, comments=thread)
+
+    return JsonResponse({
+        'html': render_to_string('partials/comment_list.html', {'comments': comments, 'post': post}, request=request),
+        'next_cursor': next_cursor,
+    })
+
+
+@require_http_methods(["GET"])
+def comment_replies(request, slug, comment_id):
+    """
+    AJAX view returning the next batch of replies in a comment thread
+    """
+    post = get_object_or_404(Post, slug=slug)
+    root = get_object_or_404(Comment, id=comment_id, post=post, parent__isnull=True)
+    cursor = request.GET.get('cursor') or encode_cursor(root.path)
+    replies, thread, next_cursor = load_more_replies(root, cursor)
+    load_viewer_likes(request.user, comments=thread)
+
+    return JsonResponse({
+        'html': render_to_string('partials/comment_list.html', {'comments': replies, 'post': post}, request=request),
+        'next_cursor': next_cursor,
     })
 
 
@@ -248,7 +367,7 @@ def add_comment(request, slug):
     if content:
         parent = None
         if parent_id:
-            parent = get_object_or_404(Comment, id=parent_id)
+            parent = get_object_or_404(Comment, id=parent_id, post=post)
 
         comment = Comment.objects.create(
             post=post,
@@ -288,6 +407,7 @@ def follow_user(request, username):
         following = False
     else:
         following = True
+    update_following(request, user_to_follow.pk, following)
 
     return JsonResponse({
         'following': following,
@@ -295,6 +415,92 @@ def follow_user(request, username):
     })
 
 
+@login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+def bulk_actions(request):
+    """
+    AJAX view applying a batch of likes and follows in one request
+    """
+    try:
+        actions = social_actions.parse(json.loads(request.body))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'results': social_actions.apply(request, actions)})
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def cache_stats(request):
+    """
+    AJAX view exposing post card hit/miss counters and this worker's
+    per-prefix cache statistics
+    """
+    if request.GET.get('reset'):
+        card_cache.reset_stats()
+        if hasattr(cache, 'reset_stats'):
+            cache.reset_stats()
+    return JsonResponse({
+        'post_cards': card_cache.stats(),
+        'prefixes': cache.stats() if hasattr(cache, 'stats') else {},
+    })
+
+
+@require_http_methods(["GET"])
+def prometheus_metrics(request):
+    """
+    Request metrics of every worker in the Prometheus text format, for
+    staff or a scraper holding METRICS_TOKEN
+    """
+    if not metrics.is_authorized(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_http_methods(["GET"])
+def site_feed(request, feed_format):
+    """
+    RSS or Atom feed of the latest posts (see blog.feeds)
+    """
+    return feeds.serve(request, feeds.SiteFeed, feed_format)
+
+
+@require_http_methods(["GET"])
+def genre_feed(request, slug, feed_format):
+    """
+    RSS or Atom feed of a genre's latest posts
+    """
+    return feeds.serve(request, feeds.GenreFeed, feed_format, slug=slug)
+
+
+@require_http_methods(["GET"])
+def author_feed(request, username, feed_format):
+    """
+    RSS or Atom feed of an author's latest posts
+    """
+    return feeds.serve(request, feeds.AuthorFeed, feed_format, username=username)
+
+
+@login_required
+@require_http_methods(["GET"])
+def export_author(request, username):
+    """
+    Stream everything a user created as an NDJSON archive (see blog.archive),
+    for that user or staff
+    """
+    author = get_object_or_404(User, username=username)
+    if author != request.user and not request.user.is_staff:
+        return HttpResponseForbidden()
+    response = StreamingHttpResponse(
+        archive.lines(archive.records(author=author, include_passwords=False)),
+        content_type='application/x-ndjson; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{author.username}.ndjson"'
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
 @login_required
 @require_http_methods(["POST"])
 @csrf_exempt
@@ -309,6 +515,7 @@ def toggle_dark_mode(request):
         profile, created = UserProfile.objects.get_or_create(user=request.user)
         profile.dark_mode = dark_mode
         profile.save()
+        invalidate_snapshot(request)
 
         return JsonResponse({'success': True, 'dark_mode': dark_mode})
     except Exception as e:
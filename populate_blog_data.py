@@ -12,12 +12,20 @@ Options:
     --users N       Number of users to create (default: 15)
     --articles N    Number of articles to create (default: 50)
     --clear         Clear existing data before populating
+    --seed N        Random seed, for the same dataset on every run
+    --bulk          Generate rows in chunks with bulk_create (for large datasets)
+    --likes N       Post likes to create in bulk mode (default: 10 per article)
+    --follows N     Follows to create in bulk mode (default: 20 per user)
+    --comments N    Comments to create in bulk mode (default: 2 per article)
+    --chunk-size N  Rows per bulk_create in bulk mode (default: 5000)
+    --workers N     Processes generating text in bulk mode (default: CPU count)
     --help          Show this help message
 
 Examples:
     python populate_blog_data.py
     python populate_blog_data.py --users 20 --articles 100
     python populate_blog_data.py --clear --users 15 --articles 50
+    python populate_blog_data.py --bulk --seed 1 --users 50000 --articles 1000000
 """
 
 import os
@@ -45,12 +53,20 @@ def main():
     parser.add_argument('--users', type=int, default=15, help='Number of users to create')
     parser.add_argument('--articles', type=int, default=50, help='Number of articles to create')
     parser.add_argument('--clear', action='store_true', help='Clear existing data')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    parser.add_argument('--bulk', action='store_true', help='Generate rows in chunks with bulk_create')
+    parser.add_argument('--likes', type=int, help='Post likes to create in bulk mode')
+    parser.add_argument('--follows', type=int, help='Follows to create in bulk mode')
+    parser.add_argument('--comments', type=int, help='Comments to create in bulk mode')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Rows per bulk_create in bulk mode')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes generating text in bulk mode')
 
     args = parser.parse_args()
 
     print(f"Users to create: {args.users}")
     print(f"Articles to create: {args.articles}")
     print(f"Clear existing data: {'Yes' if args.clear else 'No'}")
+    print(f"Bulk mode: {'Yes' if args.bulk else 'No'}")
     print("-" * 40)
 
     try:
@@ -67,7 +83,14 @@ def main():
         call_command('populate_data',
                     users=args.users,
                     articles=args.articles,
-                    clear=args.clear)
+                    clear=args.clear,
+                    seed=args.seed,
+                    bulk=args.bulk,
+                    likes=args.likes,
+                    follows=args.follows,
+                    comments=args.comments,
+                    chunk_size=args.chunk_size,
+                    workers=args.workers)
 
         print("\n🎉 Population completed successfully!")
         print("\nYou can now:")
@@ -42,10 +42,15 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'blog.middleware.MetricsMiddleware',
+    'blog.middleware.QueryBudgetMiddleware',
+    'blog.middleware.AnonymousPageCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'blog.middleware.ViewerSnapshotMiddleware',
+    'blog.middleware.ConditionalPageMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -64,6 +69,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'blog.context_processors.theme_context',
+                'blog.context_processors.genre_context',
             ],
         },
     },
@@ -82,6 +88,10 @@ DATABASES = {
         ssl_require=not DEBUG,
     )
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # A file rather than the shared in-memory database, so tests running threads
+    # wait for SQLite's write lock instead of failing with "table is locked"
+    DATABASES['default']['TEST'] = {'NAME': str(BASE_DIR / 'test_db.sqlite3')}
 
 
 # Password validation
@@ -142,6 +152,123 @@ X_FRAME_OPTIONS = 'DENY'
 # Session configuration
 SESSION_COOKIE_AGE = 60 * 60 * 24 * 30  # 30 days
 SESSION_SAVE_EVERY_REQUEST = True
+# Sessions live in the 'sessions' cache and are written behind to the database in batches;
+# an unchanged session's row is only rewritten once less than SESSION_REFRESH_RATIO of
+# SESSION_COOKIE_AGE is left on it (see blog/session_store.py)
+SESSION_ENGINE = 'blog.session_store'
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_REFRESH_RATIO = 0.9
+SESSION_WRITE_BEHIND_BATCH = 100
+SESSION_WRITE_BEHIND_INTERVAL = 5
+# Signed-in viewers are served from a session snapshot rebuilt at most this often (blog/viewer_state.py)
+VIEWER_SNAPSHOT_MAX_AGE = 60 * 5
+
+# Caching: a per-process LRU in front of a file cache shared by every worker on the host
+# (see blog/tiered_cache.py). L1 entries are kept for at most L1_TIMEOUT seconds, so other
+# workers see changes within that.
+CACHES = {
+    'default': {
+        'BACKEND': 'blog.tiered_cache.TieredCache',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'L2': 'shared',
+            'L1_MAX_ENTRIES': 1000,
+            'L1_TIMEOUT': 5,
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': config('CACHE_DIR', default=str(BASE_DIR / '.cache')),
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': config('SESSION_CACHE_DIR', default=str(BASE_DIR / '.cache' / 'sessions')),
+        'TIMEOUT': SESSION_COOKIE_AGE,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+# Likes are buffered and applied in batches at most this often (see blog/like_buffer.py)
+LIKE_BUFFER_FLUSH_INTERVAL_MS = 500
+LIKE_BUFFER_BATCH_SIZE = 1000
+
+# Full-page cache for anonymous readers (see blog/page_cache.py)
+PAGE_CACHE_TIMEOUT = 60 * 10
+
+# RSS/Atom feeds, kept rendered until a post they list changes (see blog/feeds.py)
+FEED_ITEMS = 20
+FEED_CACHE_TIMEOUT = 60 * 60 * 24
+FEED_MAX_AGE = 60 * 5  # Cache-Control max-age for readers and proxies
+
+# Resized WebP/JPEG copies of uploaded images for srcset (see blog/images.py).
+# Rendered by IMAGE_DERIVATIVE_WORKERS processes per web process; 0 renders them inline.
+IMAGE_DERIVATIVE_WORKERS = 2
+IMAGE_DERIVATIVE_QUALITY = 80
+POST_IMAGE_WIDTHS = (320, 640, 960, 1280, 1920)
+AVATAR_WIDTHS = (32, 64, 128, 256)
+
+# ETag/Last-Modified validators of the main pages, checked before rendering (see blog/conditional.py)
+CONDITIONAL_TIMEOUT = 60 * 60 * 24
+
+# Following feed timelines (see blog/timeline.py)
+TIMELINE_FANOUT_LIMIT = 5000  # Authors with more followers are merged into feeds at read time; run refresh_fanout_modes periodically
+TIMELINE_MAX_LENGTH = 1000  # Entries kept per user
+TIMELINE_BACKFILL = 50  # Recent posts copied into a feed on follow
+
+# Related posts (see blog/related.py): build_related_posts stores the TF-IDF matrix here, and
+# saved posts are re-vectorized against it in the background. Shared by every worker on the host.
+RELATED_POSTS_MATRIX = config('RELATED_POSTS_MATRIX', default=str(BASE_DIR / '.cache' / 'related-posts.npz'))
+RELATED_POSTS_WORKERS = 1  # Threads per web process; 0 updates inline when the post commits
+
+# Per-request query budgets and N+1 detection (see blog/query_budget.py). Budgets are
+# statement counts per URL name with cold caches and a built session snapshot, so the
+# first request of a new session may run three more. blog.tests checks every blog URL
+# with CACHES pinned to locmem (override_settings); TieredCache needs no more queries.
+QUERY_BUDGET_ENABLED = config('QUERY_BUDGET_ENABLED', default=DEBUG, cast=bool)
+QUERY_BUDGET_STRICT = config('QUERY_BUDGET_STRICT', default=False, cast=bool)
+QUERY_BUDGET_REPEAT_THRESHOLD = 3  # Runs of the same query shape reported as an N+1
+QUERY_BUDGETS = {
+    'blog:home': 8,
+    'blog:post_detail': 10,
+    'blog:genre_posts': 5,
+    'blog:following_feed': 6,
+    'blog:search': 7,
+    'blog:site_feed': 3,
+    'blog:genre_feed': 4,
+    'blog:author_feed': 4,
+    'blog:home_posts': 4,
+    'blog:genre_posts_fragment': 4,
+    'blog:following_feed_fragment': 6,
+    'blog:create_post': 2,
+    'blog:edit_post': 3,
+    'blog:delete_post': 3,
+    'blog:user_profile': 8,
+    'blog:export_author': 12,
+    'blog:like_post': 14,
+    'blog:like_comment': 15,
+    'blog:follow_user': 12,
+    'blog:bulk_actions': 21,
+    'blog:toggle_dark_mode': 3,
+    'blog:cache_stats': 4,
+    'blog:add_comment': 8,
+    'blog:comment_page': 6,
+    'blog:comment_replies': 6,
+    'blog:metrics': 4,
+}
+
+# Prometheus metrics at /metrics (see blog/metrics.py). METRICS_DIR must be shared by
+# every gunicorn worker on the host and emptied on deploy; scrapers authenticate with
+# "Authorization: Bearer <METRICS_TOKEN>", staff users with their session. Off unless enabled.
+METRICS_ENABLED = config('METRICS_ENABLED', default=False, cast=bool)
+METRICS_DIR = config('METRICS_DIR', default=str(BASE_DIR / '.cache' / 'metrics'))
+METRICS_FLUSH_INTERVAL = 5  # Seconds between writes of a worker's totals
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
 
 # Message framework settings
 from django.contrib.messages import constants as messages